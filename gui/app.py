@@ -1,21 +1,27 @@
-import tkinter
-from typing import Optional, Tuple, Union
 import customtkinter
-import pandas as pd
-from PIL import Image, ImageTk
-import ratelimit
+from PIL import ImageTk
 import io
-import time
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Callable
 from pathlib import Path
 abs_path = Path(__file__).parent
 
-from src.dataset.preprocessing import preprocess_anime_data, preprocess_ratings_data
-from src.dataset.download_data import get_anime_metadata
-from src.model.train import simple_train
-from src.model.inference import _get_recommendations
+# the recommender modules pull in pandas, scikit-learn, Surprise and the Jikan client, which take longer to import than the window takes to show up,
+# so they are only imported by the background worker once the window is displayed, see App.load_data
+from src.dataset.metadata_cache import MetadataCache
 
 IMAGE_WIDTH = 250
 IMAGE_HEIGHT = 250
+SEARCH_LIMIT = 50
+
+# the main loop handles background results about 60 times per second
+POLL_INTERVAL = 16
+# rows rendered at once, whenever the user scrolls close to the last rendered one
+ROWS_PER_PAGE = 5
+# metadata results displayed per poll, so that building many images at once does not stall the main loop
+METADATA_PER_POLL = 2
 
 customtkinter.set_appearance_mode('system')
 customtkinter.set_default_color_theme('dark-blue')
@@ -34,16 +40,31 @@ class App(customtkinter.CTk):
         """
         super().__init__()
         
-        anime_df = pd.read_csv(abs_path / ('../data/external/anime.csv'))
-        anime_df = preprocess_anime_data(anime_df)
-        self.anime_df = anime_df
-
-        ratings_df = pd.read_csv(abs_path / ('../data/external/rating.csv'))
-        self.ratings_df = ratings_df
-        
         self.new_ratings = {}
         self.isRecommendationsActive = False
         
+        # slow work (loading the data, training the recommender, searching and recommending) runs on a background worker,
+        # whose results are handed back to the main loop through a queue, so the window keeps responding meanwhile.
+        # The worker is a daemon thread, unlike the ones of an executor, so that closing the window does not wait for a running training
+        self.tasks_queue = queue.Queue()
+        threading.Thread(target=self.run_tasks, daemon=True).start()
+        self.results_queue = queue.Queue()
+        self.search_future = None
+        self.view_generation = 0
+        
+        # metadata is fetched in the background and shown in the labels of each anime as it arrives,
+        # unless it was already cached by a previous search. The fetcher is created along with the data, see load_data
+        self.metadata_fetcher = None
+        self.metadata_cache = MetadataCache(thumbnail_size=(IMAGE_WIDTH, IMAGE_HEIGHT))
+        self.metadata_queue = queue.Queue()
+        self.metadata_labels = {}
+        self.metadata_futures = []
+        
+        # result rows are only rendered, and their metadata requested, once the user scrolls down to them
+        self.pending_rows = []
+        self.rendered_rows = 0
+        self.render_row = None
+        
         self.title('Anime Recommender')
         self.geometry('500x350')
         self.wm_iconphoto(True, ImageTk.PhotoImage(file=(abs_path / 'One-Piece-anime.ico')))
@@ -57,67 +78,254 @@ class App(customtkinter.CTk):
         self.search_entry = customtkinter.CTkEntry(master=self.top_frame, placeholder_text="Search")
         self.search_entry.grid(row=1, column=0, padx=(10, 0), pady=12)
 
-        self.search_button = customtkinter.CTkButton(master=self.top_frame, text="Search", command=self.search)
+        self.search_button = customtkinter.CTkButton(master=self.top_frame, text="Search", command=self.search, state='disabled')
         self.search_button.grid(row=1, column=1, padx=(2, 25), pady=(12, 12))
         
+        self.status_label = customtkinter.CTkLabel(master=self.top_frame, text='', font=("Roboto", 14))
+        self.status_label.grid(row=2, column=0, columnspan=3, padx=(10, 0), pady=(0, 12))
+        
         self.bottom_frame = customtkinter.CTkScrollableFrame(master=self)
         self.bottom_frame.pack(pady=5, padx=50, fill="both", expand=True)
+        
+        # idle tasks run in the order they were scheduled, so the data only starts loading once the window has been drawn
+        self.after_idle(self.start_loading)
+        
+        self.after(POLL_INTERVAL, self.poll)
+        self.protocol("WM_DELETE_WINDOW", self.on_closing)
+    
+    
+    def start_loading(self):
+        """Draw the window and start loading the data in the background.
+        """
+        
+        self.status_label.configure(text='Loading...')
+        self.update_idletasks()
+        
+        self.submit(self.load_data, self.on_data_loaded)
+    
+    
+    def load_data(self) -> tuple:
+        """Load the anime data, its search and similarity indexes, the recommender and the metadata fetcher. It runs on the background worker and reports its progress to the main loop.
+        New users are folded into the latest trained recommender when asking for recommendations, which is only trained here if there is none for the current anime data.
+        The modules these depend on are imported here as well, so that importing them does not delay the first frame of the window.
 
+        Returns:
+            tuple: Processed anime dataframe, search index, similarity index, recommender and metadata fetcher
+        """
+        
+        self.report_progress('Loading anime data...')
+        from src.dataset.preprocessing import catalogue_fingerprint
+        from src.dataset.cache import load_anime_data, load_ratings_data
+        from src.dataset.download_data import MetadataFetcher
+        from src.model.registry import load_latest_model
+        from src.model.similarity import get_similarity_index
+        from src.model.search import get_search_index
+        
+        anime_df = load_anime_data()
+        
+        self.report_progress('Building search and similarity indexes...')
+        search_index = get_search_index(anime_df)
+        similarity_index = get_similarity_index(anime_df)
+        
+        self.report_progress('Loading recommender...')
+        model = load_latest_model(catalogue_fingerprint(anime_df))
+        if model is None:
+            self.report_progress('Training recommender, this may take a few minutes...')
+            from src.model.train import train_and_save
+            ratings_df = load_ratings_data(anime_df)
+            model = train_and_save(anime_df, ratings_df)
+        
+        return anime_df, search_index, similarity_index, model, MetadataFetcher()
+    
+    
+    def on_data_loaded(self, data: tuple):
+        """Keep the loaded data and enable the search.
+
+        Args:
+            data (tuple): Processed anime dataframe, search index, similarity index, recommender and metadata fetcher
+        """
+        
+        self.anime_df, self.search_index, self.similarity_index, self.model, self.metadata_fetcher = data
+        self.anime_by_id = self.anime_df.set_index('anime_id', drop=False)
+        
+        self.search_button.configure(state='normal')
+        self.status_label.configure(text='')
+    
+    
+    def submit(self, task: Callable, callback: Callable, *args) -> Future:
+        """Run a task on the background worker and call back with its result from the main loop once it finishes.
+
+        Args:
+            task (Callable): Function to be run in the background
+            callback (Callable): Function to be called with the result of the task, on the main thread
+            args: Arguments of the task
+
+        Returns:
+            Future: Future of the task, which can be cancelled until it starts running
+        """
+        
+        future = Future()
+        self.tasks_queue.put((future, task, args))
+        future.add_done_callback(lambda future: self.results_queue.put((self.complete, (callback, future), {})))
+        
+        return future
+    
+    
+    def run_tasks(self):
+        """Background worker that runs the submitted tasks one at a time, skipping the ones cancelled before they started.
+        """
+        
+        while True:
+            future, task, args = self.tasks_queue.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = task(*args)
+            except BaseException as exception:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+    
+    
+    def complete(self, callback: Callable, future: Future):
+        """Hand the result of a finished background task to its callback, or display its error.
+
+        Args:
+            callback (Callable): Function to be called with the result of the task
+            future (Future): Future of the finished task
+        """
+        
+        if future.cancelled():
+            return
+        
+        exception = future.exception()
+        if exception is not None:
+            self.status_label.configure(text=f'Something went wrong: {exception}')
+            return
+        
+        callback(future.result())
+    
+    
+    def report_progress(self, text: str):
+        """Display a progress message. It can be called from any thread.
+
+        Args:
+            text (str): Progress message
+        """
+        
+        self.results_queue.put((self.status_label.configure, (), {'text': text}))
+    
     
     def search(self):
-        """Search functionality that fetches animes based on the coincidence of the introduced query and the anime names.
-        It displays the search results in rows ordered from most to least popular, displaying: anime id, name, cover image, synopsis and the corresponding widgets add their ratings.
+        """Search functionality that fetches animes whose name or english title matches every word of the introduced query, allowing prefixes and small typos.
+        The search runs in the background and supersedes any previous search or recommendation still in progress, whose results are discarded.
+        """
+        
+        if self.search_future is not None:
+            self.search_future.cancel()
+        
+        self.view_generation += 1
+        generation = self.view_generation
+        
+        # perform query
+        query = self.search_entry.get()
+        self.search_future = self.submit(self.search_index.search, lambda anime_ids: self.show_search_results(anime_ids, generation), query, SEARCH_LIMIT)
+    
+    
+    def show_search_results(self, anime_ids: list, generation: int):
+        """Display the search results in rows ordered from most to least popular, displaying: anime id, name, cover image, synopsis and the corresponding widgets add their ratings.
+
+        Args:
+            anime_ids (list): Animes found, from most to least popular
+            generation (int): View the search was started for, results of superseded searches are discarded
         """
         
+        if generation != self.view_generation:
+            return
+        
         self.search_widgets = []
         
+        search_result = self.anime_by_id.loc[anime_ids]
+        self.show_rows(list(search_result[['anime_id', 'name']].itertuples(index=False)), self.render_search_row)
+        
+        self.status_label.configure(text=f'{len(search_result)} animes found')
+    
+    
+    def render_search_row(self, grid_row: int, row: tuple) -> int:
+        """Create the widgets of a search result.
+
+        Args:
+            grid_row (int): Grid row of the result
+            row (tuple): Anime id and name of the result
+
+        Returns:
+            int: Anime id of the result
+        """
+        
+        anime_id, anime_name = row
+        
+        id_label = customtkinter.CTkLabel(master=self.bottom_frame, text=anime_id, font=("Roboto", 16), wraplength=150)
+        id_label.grid(row=grid_row, column=0, padx=(10, 0), pady=12)
+        
+        name_label = customtkinter.CTkLabel(master=self.bottom_frame, text=anime_name, font=("Roboto", 20), wraplength=250)
+        name_label.grid(row=grid_row, column=1, padx=(5, 0), pady=12)
+        
+        cover_image_label = customtkinter.CTkLabel(master=self.bottom_frame, text='', width=IMAGE_WIDTH, height=IMAGE_HEIGHT)
+        cover_image_label.grid(row=grid_row, column=2, padx=(10, 0), pady=12)
+        
+        synopsis_label = customtkinter.CTkLabel(master=self.bottom_frame, text='', font=("Roboto", 14), wraplength=750)
+        synopsis_label.grid(row=grid_row, column=3, padx=(10, 0), pady=12)
+        
+        self.metadata_labels[anime_id] = (cover_image_label, synopsis_label)
+        
+        values = list(map(str, range(1,11)))
+        rating_menu = customtkinter.CTkOptionMenu(master=self.bottom_frame, values=values)
+        rating_menu.grid(row=grid_row, column=4, padx=(10, 0), pady=12)
+        
+        rating_button = customtkinter.CTkButton(master=self.bottom_frame, text='Save rating')
+        rating_button.grid(row=grid_row, column=5, padx=(10, 0), pady=12)
+        rating_button.bind("<Button-1>", self.save_rating)
+        
+        self.search_widgets.append([id_label, rating_menu, rating_button])
+        
+        return anime_id
+    
+    
+    def show_rows(self, rows: list, render_row: Callable):
+        """Replace the displayed rows with new ones. Only the first page of rows is rendered right away,
+        the following ones are rendered as the user scrolls down to them.
+
+        Args:
+            rows (list): Data of every row
+            render_row (Callable): Function that creates the widgets of a row given its grid row and data, and returns its anime id
+        """
+        
         for widget in self.bottom_frame.winfo_children():
             widget.destroy()
+        self.bottom_frame._parent_canvas.yview_moveto(0)
+        
+        self.metadata_labels = {}
+        self.pending_rows = rows
+        self.rendered_rows = 0
+        self.render_row = render_row
+        
+        self.render_next_page(cancel_pending=True)
     
-        # perform query
-        query = self.search_entry.get().lower()
-        search_result = self.anime_df[self.anime_df['name'].str.lower().str.contains(query)]
-        search_result.sort_values(by="members", ascending=False)
-        
-        grid_row = 0
-        api_counter = 0
-        for i, df_row in search_result.iterrows():
-            anime_id = df_row['anime_id']
-            anime_name = df_row['name']
-
-            if api_counter == 3:
-                time.sleep(1.5)
-                api_counter = 0
-            synopsis, cover_image = get_anime_metadata(anime_id)
-            api_counter += 1
-            
-            id_label = customtkinter.CTkLabel(master=self.bottom_frame, text=anime_id, font=("Roboto", 16), wraplength=150)
-            id_label.grid(row=grid_row, column=0, padx=(10, 0), pady=12)
-            
-            name_label = customtkinter.CTkLabel(master=self.bottom_frame, text=anime_name, font=("Roboto", 20), wraplength=250)
-            name_label.grid(row=grid_row, column=1, padx=(5, 0), pady=12)
-            
-            image = Image.open(cover_image)
-            photo = customtkinter.CTkImage(light_image=image, size=(IMAGE_WIDTH , IMAGE_HEIGHT))
-            cover_image_label = customtkinter.CTkLabel(master=self.bottom_frame, image=photo, text='')
-            cover_image_label.grid(row=grid_row, column=2, padx=(10, 0), pady=12)
-            
-            synopsis_label = customtkinter.CTkLabel(master=self.bottom_frame, text=synopsis, font=("Roboto", 14), wraplength=750)
-            synopsis_label.grid(row=grid_row, column=3, padx=(10, 0), pady=12)
-            
-            values = list(map(str, range(1,11)))
-            rating_menu = customtkinter.CTkOptionMenu(master=self.bottom_frame, values=values)
-            rating_menu.grid(row=grid_row, column=4, padx=(10, 0), pady=12)
-            
-            rating_button = customtkinter.CTkButton(master=self.bottom_frame, text='Save rating')
-            rating_button.grid(row=grid_row, column=5, padx=(10, 0), pady=12)
-            rating_button.bind("<Button-1>", self.save_rating)
-            
-            self.search_widgets.append([id_label, rating_menu, rating_button])
-            
-            grid_row += 1
+    
+    def render_next_page(self, cancel_pending: bool = False):
+        """Render the next page of pending rows and request their metadata.
+
+        Args:
+            cancel_pending (bool, optional): Whether to cancel the metadata requests of the previously displayed rows. Defaults to False.
+        """
         
+        page, self.pending_rows = self.pending_rows[:ROWS_PER_PAGE], self.pending_rows[ROWS_PER_PAGE:]
+        anime_ids = [self.render_row(self.rendered_rows + i, row) for i, row in enumerate(page)]
+        self.rendered_rows += len(page)
         
+        self.request_metadata(anime_ids, cancel_pending)
+    
+    
     def save_rating(self, event):
         """Event function that saves the user new rating of a given anime. When the Save rating button is clicked, the rating from the Option Menu of the same anime row is saved.
         This function also checks if there is any positive review saved by the user and in that case makes the recommend functionality available.
@@ -151,48 +359,156 @@ class App(customtkinter.CTk):
         
         
     def make_recommendations(self):
-        """This function retrieves all of the user's ratings, gets some recommendations based on them and displays them from most to least recommended.
+        """This function retrieves all of the user's ratings and gets some recommendations based on them in the background.
         """
         
-        for widget in self.bottom_frame.winfo_children():
-            widget.destroy()
-            
-        new_ratings_df = self.ratings_df.copy()
+        # already imported along with the recommender, see load_data
+        from src.model.inference import get_new_user_recommendations
         
-        # add new ratings from new user
-        new_user = self.ratings_df.user_id.max() + 1
-        for anime_id, rating in self.new_ratings.items():
-            new_row_df = pd.DataFrame({'user_id': [new_user], 'anime_id': [anime_id], 'rating': [rating]})
-            new_ratings_df = pd.concat([new_ratings_df, new_row_df], ignore_index=True)
-            
-        ratings_dataset = preprocess_ratings_data(new_ratings_df, self.anime_df)
+        self.view_generation += 1
+        generation = self.view_generation
+        
+        self.status_label.configure(text='Computing recommendations...')
+        self.submit(get_new_user_recommendations, lambda recommendations: self.show_recommendations(recommendations, generation),
+                    self.anime_df, self.model, dict(self.new_ratings), self.similarity_index)
+    
+    
+    def show_recommendations(self, recommendations: list, generation: int):
+        """Display the top 10 recommendations from most to least recommended.
+
+        Args:
+            recommendations (list): Recommended anime ids and estimated ratings, from most to least recommended
+            generation (int): View the recommendations were computed for, they are discarded if a search was started meanwhile
+        """
         
-        model = simple_train(ratings_dataset)
+        if generation != self.view_generation:
+            return
         
-        recommendations = _get_recommendations(self.anime_df, ratings_dataset, model, new_user)
         top_10_recommendations = recommendations[:10]
         
-        api_counter = 0
-        for i, (anime_id, est_rating) in enumerate(top_10_recommendations):
-            anime_name = self.anime_df[self.anime_df.anime_id == anime_id].name.values[0]
-            # print(i, anime_id, anime_name, est_rating)
-            
-            if api_counter == 3:
-                time.sleep(1.5)
-                api_counter = 0
-            synopsis, cover_image = get_anime_metadata(anime_id)
-            api_counter += 1
-            
-            name_label = customtkinter.CTkLabel(master=self.bottom_frame, text=anime_name, font=("Roboto", 20), wraplength=350)
-            name_label.grid(row=i, column=0, padx=(5, 0), pady=12)
+        rows = [(anime_id, self.anime_by_id.at[anime_id, 'name']) for anime_id, _ in top_10_recommendations]
+        self.show_rows(rows, self.render_recommendation_row)
+        
+        self.status_label.configure(text='')
+    
+    
+    def render_recommendation_row(self, grid_row: int, row: tuple) -> int:
+        """Create the widgets of a recommendation.
+
+        Args:
+            grid_row (int): Grid row of the recommendation
+            row (tuple): Anime id and name of the recommendation
+
+        Returns:
+            int: Anime id of the recommendation
+        """
+        
+        anime_id, anime_name = row
+        
+        name_label = customtkinter.CTkLabel(master=self.bottom_frame, text=anime_name, font=("Roboto", 20), wraplength=350)
+        name_label.grid(row=grid_row, column=0, padx=(5, 0), pady=12)
+        
+        cover_image_label = customtkinter.CTkLabel(master=self.bottom_frame, text='', width=IMAGE_WIDTH, height=IMAGE_HEIGHT)
+        cover_image_label.grid(row=grid_row, column=1, padx=(10, 0), pady=12)
+        
+        synopsis_label = customtkinter.CTkLabel(master=self.bottom_frame, text='', font=("Roboto", 14), wraplength=850)
+        synopsis_label.grid(row=grid_row, column=2, padx=(10, 0), pady=12)
+        
+        self.metadata_labels[anime_id] = (cover_image_label, synopsis_label)
+        
+        return anime_id
+    
+    
+    def request_metadata(self, anime_ids: list, cancel_pending: bool = True):
+        """Start fetching the synopsis and cover image of the given animes in the background,
+        optionally cancelling the requests of the previously displayed animes that have not started yet.
+
+        Args:
+            anime_ids (list): Animes whose metadata has to be displayed
+            cancel_pending (bool, optional): Whether to cancel the pending requests. Defaults to True.
+        """
+        
+        if cancel_pending:
+            for future in self.metadata_futures:
+                future.cancel()
+            self.metadata_futures = []
+        
+        missing_anime_ids = []
+        for anime_id in anime_ids:
+            metadata = self.metadata_cache.get(anime_id)
+            if metadata is None:
+                missing_anime_ids.append(anime_id)
+            else:
+                self.metadata_queue.put((anime_id, metadata.synopsis, metadata.thumbnail))
+        
+        self.metadata_futures += self.metadata_fetcher.fetch_many(missing_anime_ids, callback=self.cache_metadata)
+    
+    
+    def cache_metadata(self, anime_id: int, synopsis: str, cover_image: io.BytesIO):
+        """Fetcher callback that stores the metadata of an anime in the cache and queues it to be displayed. It runs on a worker thread,
+        so the cover image is also resized into a thumbnail outside of the main loop.
+
+        Args:
+            anime_id (int): Anime the metadata belongs to
+            synopsis (str): Synopsis of the anime
+            cover_image (io.BytesIO): Cover image of the anime
+        """
+        
+        thumbnail = None
+        if synopsis is not None or cover_image is not None:
+            thumbnail = self.metadata_cache.put(anime_id, synopsis, cover_image).thumbnail
+        
+        self.metadata_queue.put((anime_id, synopsis, thumbnail))
+    
+    
+    def poll(self):
+        """Periodic task of the main loop that handles the work done in the background since its last run.
+        Tkinter widgets can only be updated from the main thread, so background tasks and fetcher callbacks just put their results in queues.
+        The work done per run is bounded, so that the window keeps redrawing at about 60 frames per second.
+        """
+        
+        # scheduled first so that an error in a callback does not stop the polling
+        self.after(POLL_INTERVAL, self.poll)
+        
+        while not self.results_queue.empty():
+            function, args, kwargs = self.results_queue.get()
+            function(*args, **kwargs)
+        
+        self.poll_metadata()
+        
+        # render the next page of rows once the user has scrolled close to the last rendered one
+        if len(self.pending_rows) > 0 and self.bottom_frame._parent_canvas.yview()[1] > 0.9:
+            self.render_next_page()
+    
+    
+    def poll_metadata(self):
+        """Display some of the metadata fetched in the background since the last run of the main loop task.
+        """
+        
+        for _ in range(METADATA_PER_POLL):
+            if self.metadata_queue.empty():
+                break
+            anime_id, synopsis, thumbnail = self.metadata_queue.get()
             
-            image = Image.open(cover_image)
-            photo = customtkinter.CTkImage(light_image=image, size=(IMAGE_WIDTH , IMAGE_HEIGHT))
-            cover_image_label = customtkinter.CTkLabel(master=self.bottom_frame, image=photo, text='')
-            cover_image_label.grid(row=i, column=1, padx=(10, 0), pady=12)
+            # results of animes that are not displayed anymore are discarded
+            if anime_id not in self.metadata_labels:
+                continue
+            cover_image_label, synopsis_label = self.metadata_labels[anime_id]
             
-            synopsis_label = customtkinter.CTkLabel(master=self.bottom_frame, text=synopsis, font=("Roboto", 14), wraplength=850)
-            synopsis_label.grid(row=i, column=2, padx=(10, 0), pady=12)
+            if thumbnail is not None:
+                photo = customtkinter.CTkImage(light_image=thumbnail, size=(IMAGE_WIDTH , IMAGE_HEIGHT))
+                cover_image_label.configure(image=photo)
+            synopsis_label.configure(text=synopsis)
+    
+    
+    def on_closing(self):
+        """Close the window without waiting for the background task, which stops along with the process, nor the pending metadata requests.
+        """
+        
+        if self.metadata_fetcher is not None:
+            self.metadata_fetcher.close(wait=False)
+        self.metadata_cache.close()
+        self.destroy()
             
 
 if __name__ == "__main__":
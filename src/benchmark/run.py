@@ -0,0 +1,209 @@
+import numpy as np
+import pandas as pd
+import argparse
+import json
+import platform
+import resource
+import subprocess
+import sys
+import time
+from typing import Callable, Optional, Union
+
+from pathlib import Path
+abs_path = Path(__file__).parent
+
+from src.benchmark.synthetic import write_synthetic_dataset
+from src.dataset.preprocessing import preprocess_anime_data, preprocess_ratings_data
+from src.model.train import simple_train
+from src.model.factors import FactorModel
+from src.model.similarity import SimilarityIndex
+from src.model.inference import get_top_k_most_similar_animes, _get_recommendations, get_new_user_recommendations
+
+SYNTHETIC_PATH = abs_path / '../../data/processed/benchmark'
+
+
+def measure(name: str, function: Callable, repeats: int = 5, items: Union[int, Callable] = 1, setup: Callable = None) -> tuple:
+    """Time several runs of a function and the peak resident memory of the process while they run.
+
+    Args:
+        name (str): Name of the benchmark
+        function (Callable): Function to be timed
+        repeats (int, optional): Number of timed runs. Defaults to 5.
+        items (Union[int, Callable], optional): Number of items processed per run, e.g. rows or queries, to compute the throughput,
+            or a function that counts them from the result of a run. Defaults to 1.
+        setup (Callable, optional): Untimed function called before every run, whose returned tuple is passed as arguments of the timed one. Defaults to None.
+
+    Returns:
+        tuple: Measures of the benchmark, and result of the last run
+    """
+    _reset_peak_rss()
+
+    timings = []
+    result = None
+    for _ in range(repeats):
+        args = setup() if setup is not None else ()
+        start = time.perf_counter()
+        result = function(*args)
+        timings.append(time.perf_counter() - start)
+
+    timings = np.array(timings)
+    if callable(items):
+        items = items(result)
+    measures = {
+        'name': name,
+        'repeats': repeats,
+        'p50': float(np.percentile(timings, 50)),
+        'p95': float(np.percentile(timings, 95)),
+        'mean': float(timings.mean()),
+        'min': float(timings.min()),
+        'throughput': float(items / np.median(timings)),
+        'peak_rss_mb': _peak_rss_mb(),
+    }
+    print(f"{name}: p50 {measures['p50'] * 1e3:.2f}ms, p95 {measures['p95'] * 1e3:.2f}ms, "
+          f"{measures['throughput']:.1f} items/s, peak RSS {measures['peak_rss_mb']:.0f}MB", file=sys.stderr)
+
+    return measures, result
+
+
+def run_benchmarks(anime_path: Path, ratings_path: Path, repeats: int = 5, train_repeats: int = 1, queries: int = 200,
+                   skip: list = (), seed: int = 0) -> list:
+    """Time the preprocessing, training, similarity and recommendation steps of the app on the given dataset.
+    Every step reuses the output of the previous ones, so skipping a step only skips its timing.
+
+    Args:
+        anime_path (Path): Raw anime table
+        ratings_path (Path): Raw ratings table
+        repeats (int, optional): Number of timed runs of the preprocessing steps. Defaults to 5.
+        train_repeats (int, optional): Number of timed runs of the training. Defaults to 1.
+        queries (int, optional): Number of timed similarity and recommendation queries. Defaults to 200.
+        skip (list, optional): Names of the benchmarks that are not timed. Defaults to ().
+        seed (int, optional): Seed of the queries. Defaults to 0.
+
+    Returns:
+        list: Measures of every benchmark
+    """
+    rng = np.random.default_rng(seed)
+    results = []
+
+    def run(name: str, function: Callable, repeats: int = 1, items: Union[int, Callable] = 1, setup: Callable = None):
+        if name in skip:
+            return function(*(setup() if setup is not None else ()))
+        measures, result = measure(name, function, repeats, items, setup)
+        results.append(measures)
+        return result
+
+    raw_anime_df = run('read_anime_csv', lambda: pd.read_csv(anime_path), repeats, len)
+    raw_ratings_df = run('read_ratings_csv', lambda: pd.read_csv(ratings_path), 1, len)
+
+    anime_df = run('preprocess_anime_data', lambda: preprocess_anime_data(raw_anime_df), repeats, len(raw_anime_df))
+    indexed_anime_df = anime_df.set_index('anime_id', drop=True)
+    ratings_dataset = run('preprocess_ratings_data', lambda: preprocess_ratings_data(raw_ratings_df, indexed_anime_df), repeats, len(raw_ratings_df))
+
+    model = run('simple_train', lambda: simple_train(ratings_dataset), train_repeats, len(ratings_dataset.df))
+
+    index = run('build_similarity_index', lambda: SimilarityIndex(anime_df), repeats, len(anime_df))
+    query_ids = iter(rng.choice(anime_df.anime_id.values, queries * 10).tolist())
+    run('get_top_k_most_similar_animes', lambda anime_id: get_top_k_most_similar_animes(anime_df, anime_id, 100, index), queries, 1,
+        lambda: (next(query_ids),))
+
+    factor_model = FactorModel.from_surprise(model)
+
+    # the user with the highest id, who the app used to append with the new ratings
+    user_id = ratings_dataset.df.user_id.max()
+    run('_get_recommendations', lambda: _get_recommendations(anime_df, ratings_dataset, factor_model, user_id, index), queries)
+
+    def random_ratings() -> tuple:
+        anime_ids = rng.choice(anime_df.anime_id.values, 10, replace=False).tolist()
+        return (dict(zip(anime_ids, rng.integers(1, 11, 10).tolist())),)
+
+    run('get_new_user_recommendations', lambda ratings: get_new_user_recommendations(anime_df, factor_model, ratings, index), queries, 1,
+        random_ratings)
+
+    return results
+
+
+def compare(baseline: dict, report: dict) -> pd.DataFrame:
+    """Compare the median latencies of two reports.
+
+    Args:
+        baseline (dict): Report of the reference run
+        report (dict): Report of the new run
+
+    Returns:
+        pd.DataFrame: Median latencies of both runs and their ratio, by benchmark
+    """
+    old = pd.DataFrame(baseline['results']).set_index('name').p50
+    new = pd.DataFrame(report['results']).set_index('name').p50
+
+    return pd.DataFrame({'baseline_p50': old, 'p50': new, 'ratio': new / old})
+
+
+def _reset_peak_rss():
+    # linux resets the peak resident memory of the process when 5 is written to clear_refs
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _peak_rss_mb() -> float:
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    # the lifetime peak of the process, in kilobytes on linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 1024
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=abs_path, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the preprocessing, training, similarity and recommendation steps on synthetic data')
+    parser.add_argument('--ratings', type=int, default=100_000, help='number of synthetic ratings')
+    parser.add_argument('--users', type=int, default=None, help='number of synthetic users, 100 ratings per user by default')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeats', type=int, default=5, help='timed runs of the preprocessing steps')
+    parser.add_argument('--train-repeats', type=int, default=1, help='timed runs of the training')
+    parser.add_argument('--queries', type=int, default=200, help='timed similarity and recommendation queries')
+    parser.add_argument('--skip', nargs='*', default=[], help='benchmarks that are not timed')
+    parser.add_argument('--data-path', type=Path, default=SYNTHETIC_PATH, help='directory of the synthetic datasets')
+    parser.add_argument('--output', type=Path, default=None, help='JSON report file, printed to stdout by default')
+    parser.add_argument('--compare', type=Path, default=None, help='JSON report of a previous run to compare with')
+    args = parser.parse_args()
+
+    anime_path, ratings_path = write_synthetic_dataset(args.data_path, args.ratings, args.users, args.seed)
+    results = run_benchmarks(anime_path, ratings_path, args.repeats, args.train_repeats, args.queries, args.skip, args.seed)
+
+    report = {
+        'commit': _git_commit(),
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'platform': platform.platform(),
+        'ratings': args.ratings,
+        'users': args.users,
+        'seed': args.seed,
+        'results': results,
+    }
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            print(compare(json.load(f), report).to_string(), file=sys.stderr)
@@ -0,0 +1,60 @@
+import argparse
+import statistics
+import subprocess
+import sys
+
+from pathlib import Path
+abs_path = Path(__file__).parent
+
+ROOT_PATH = abs_path / '../..'
+
+# import time allowed for the gui before its window can be displayed, customtkinter alone takes about 60ms
+IMPORT_BUDGET_MS = 300
+# modules that the gui only imports in the background, once its window is displayed
+DEFERRED_MODULES = ['pandas', 'numpy', 'sklearn', 'surprise', 'jikanpy', 'requests']
+
+
+def measure_import_time(module: str = 'gui.app', repeats: int = 5) -> tuple:
+    """Measure how long importing a module takes in a fresh interpreter, as reported by python -X importtime.
+
+    Args:
+        module (str, optional): Module to be imported. Defaults to 'gui.app'.
+        repeats (int, optional): Number of fresh interpreters the import is timed in. Defaults to 5.
+
+    Returns:
+        tuple: Median import time in milliseconds, and top-level packages imported along with the module
+    """
+    timings = []
+    for _ in range(repeats):
+        process = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=ROOT_PATH,
+                                 capture_output=True, text=True, check=True)
+
+        # every line is "import time: self [us] | cumulative | imported package", nested imports being indented
+        packages = set()
+        for line in process.stderr.splitlines():
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+            _, cumulative, name = line.split('|')
+            packages.add(name.strip().split('.')[0])
+            if name.strip() == module:
+                timings.append(int(cumulative) / 1e3)
+
+    return statistics.median(timings), packages
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Check that the gui imports within its startup budget, without the modules it loads in the background')
+    parser.add_argument('--module', default='gui.app')
+    parser.add_argument('--budget', type=float, default=IMPORT_BUDGET_MS, help='maximum import time in milliseconds')
+    parser.add_argument('--repeats', type=int, default=5, help='fresh interpreters the import is timed in')
+    args = parser.parse_args()
+
+    import_time, packages = measure_import_time(args.module, args.repeats)
+    deferred = [package for package in DEFERRED_MODULES if package in packages]
+
+    print(f"{args.module}: {import_time:.1f}ms, budget {args.budget:.0f}ms")
+    if len(deferred) > 0:
+        print(f"Modules that should only be imported in the background: {', '.join(deferred)}")
+
+    if import_time > args.budget or len(deferred) > 0:
+        sys.exit(1)
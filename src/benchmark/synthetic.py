@@ -0,0 +1,177 @@
+import numpy as np
+import pandas as pd
+import os
+from typing import Tuple
+
+from pathlib import Path
+abs_path = Path(__file__).parent
+
+# the release dates table decides which animes survive preprocessing, so synthetic animes reuse its ids
+DATES_PATH = abs_path / '../../data/raw/anime_dates.csv'
+
+GENRES = [
+    'Action', 'Adventure', 'Cars', 'Comedy', 'Dementia', 'Demons', 'Drama', 'Ecchi', 'Fantasy', 'Game', 'Harem', 'Hentai',
+    'Historical', 'Horror', 'Josei', 'Kids', 'Magic', 'Martial Arts', 'Mecha', 'Military', 'Music', 'Mystery', 'Parody',
+    'Police', 'Psychological', 'Romance', 'Samurai', 'School', 'Sci-Fi', 'Seinen', 'Shoujo', 'Shoujo Ai', 'Shounen',
+    'Shounen Ai', 'Slice of Life', 'Space', 'Sports', 'Super Power', 'Supernatural', 'Thriller', 'Vampire', 'Yaoi', 'Yuri',
+]
+TYPES = ['TV', 'Movie', 'OVA', 'Special', 'ONA', 'Music']
+TYPE_WEIGHTS = [0.45, 0.25, 0.12, 0.1, 0.05, 0.03]
+SYLLABLES = ['ka', 'ki', 'ku', 'ko', 'sa', 'shi', 'su', 'ta', 'chi', 'tsu', 'na', 'ni', 'no', 'ha', 'hi', 'ma', 'mi', 'ya', 'yu', 'ra', 'ri', 'ro', 'n', 'to']
+
+
+def generate_anime(seed: int = 0) -> pd.DataFrame:
+    """Generate a synthetic anime table with the schema of anime.csv, one row per anime of the release dates table.
+
+    Args:
+        seed (int, optional): Seed of the generator. Defaults to 0.
+
+    Returns:
+        pd.DataFrame: Synthetic raw anime dataframe
+    """
+    rng = np.random.default_rng(seed)
+    anime_ids = pd.read_csv(DATES_PATH).anime_id.unique()
+    n = len(anime_ids)
+
+    words = [''.join(rng.choice(SYLLABLES, rng.integers(2, 5))) for _ in range(2000)]
+    names = [' '.join(rng.choice(words, rng.integers(1, 5))).title() for _ in range(n)]
+    # a few html entities, as in the real names
+    names = [name + ' &amp; ' + words[i % len(words)].title() if i % 50 == 0 else name for i, name in enumerate(names)]
+
+    genres = [', '.join(sorted(rng.choice(GENRES, rng.integers(1, 6), replace=False))) for _ in range(n)]
+    episodes = rng.integers(1, 60, n).astype(str).astype(object)
+    episodes[rng.random(n) < 0.03] = 'Unknown'
+    rating = np.round(rng.normal(6.5, 1, n).clip(1, 10), 2)
+    rating[rng.random(n) < 0.02] = np.nan
+
+    return pd.DataFrame({
+        'anime_id': anime_ids,
+        'name': names,
+        'genre': genres,
+        'type': rng.choice(TYPES, n, p=TYPE_WEIGHTS),
+        'episodes': episodes,
+        'rating': rating,
+        'members': np.maximum(rng.lognormal(8, 2, n), 10).astype(np.int64),
+    })
+
+
+def generate_ratings(anime_df: pd.DataFrame, n_ratings: int, n_users: int = None, n_factors: int = 10, seed: int = 0, chunk_size: int = 1_000_000):
+    """Generate synthetic ratings with the schema of rating.csv, chunk by chunk so that any number of them fits in memory.
+    Ratings follow a latent factor model, so recommenders can learn something from them, popular animes receive more ratings
+    and about one in five ratings is a -1, as in the real dataset. As in rating.csv, no user rates an anime twice and the ratings
+    are sorted by user and anime.
+
+    Args:
+        anime_df (pd.DataFrame): Synthetic raw anime dataframe
+        n_ratings (int): Number of ratings
+        n_users (int, optional): Number of users. Defaults to None, in which case there are 100 ratings per user on average.
+        n_factors (int, optional): Number of latent factors of the ratings. Defaults to 10.
+        seed (int, optional): Seed of the generator. Defaults to 0.
+        chunk_size (int, optional): Approximate number of ratings per chunk, which never splits the ratings of a user. Defaults to 1_000_000.
+
+    Yields:
+        pd.DataFrame: Chunk of the synthetic raw ratings dataframe
+    """
+    rng = np.random.default_rng(seed)
+    n_users = n_users or max(n_ratings // 100, 1)
+
+    anime_ids = anime_df.anime_id.to_numpy()
+    if n_ratings > n_users * len(anime_ids):
+        raise ValueError(f'{n_users} users rating each of the {len(anime_ids)} animes at most once cannot give {n_ratings} ratings')
+    popularity = anime_df.members.to_numpy(dtype=np.float64)
+    popularity /= popularity.sum()
+
+    user_bias = rng.normal(0, 1, n_users)
+    user_factors = rng.normal(0, 0.5, (n_users, n_factors))
+    item_bias = rng.normal(0, 1, len(anime_ids))
+    item_factors = rng.normal(0, 0.5, (len(anime_ids), n_factors))
+    # users rate more or less animes, following a long tail, but never more than the whole catalogue
+    activity = rng.pareto(1.5, n_users) + 1
+    activity /= activity.sum()
+    counts = rng.multinomial(n_ratings, activity)
+    excess = np.maximum(counts - len(anime_ids), 0).sum()
+    while excess > 0:
+        counts = np.minimum(counts, len(anime_ids))
+        room = activity * (counts < len(anime_ids))
+        counts += rng.multinomial(excess, room / room.sum())
+        excess = np.maximum(counts - len(anime_ids), 0).sum()
+
+    # first user of every chunk, so that each one holds about chunk_size ratings
+    bounds = np.append(np.searchsorted(np.cumsum(counts) - counts, np.arange(0, n_ratings, chunk_size)), n_users)
+    for first_user, end_user in zip(bounds[:-1], bounds[1:]):
+        if first_user == end_user:
+            continue
+        users, items = _sample_animes(rng, counts[first_user:end_user], popularity)
+        order = np.lexsort((anime_ids[items], users))
+        users, items = users[order] + first_user, items[order]
+        size = len(users)
+
+        score = 7 + user_bias[users] + item_bias[items] + np.einsum('ij,ij->i', user_factors[users], item_factors[items]) + rng.normal(0, 1, size)
+        rating = np.clip(np.rint(score), 1, 10).astype(np.int8)
+        rating[rng.random(size) < 0.19] = -1
+
+        yield pd.DataFrame({'user_id': (users + 1).astype(np.int32), 'anime_id': anime_ids[items].astype(np.int32), 'rating': rating})
+
+
+def _sample_animes(rng: np.random.Generator, counts: np.ndarray, popularity: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Sample the animes rated by a group of users, weighted by popularity and without replacement for every user.
+
+    Args:
+        rng (np.random.Generator): Generator of the ratings
+        counts (np.ndarray): Number of ratings of every user of the group
+        popularity (np.ndarray): Probability of every anime to be rated
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Position in the group of the user and index of the anime of every rating
+    """
+    n_items = len(popularity)
+    # users rating a good part of the catalogue would take many redraws, so they sort the whole catalogue
+    # by popularity perturbed with Gumbel noise instead, whose top animes are a sample without replacement too
+    heavy = counts > n_items // 10
+    shortage = np.where(heavy, 0, counts)
+    # sorted user * n_items + anime of the ratings drawn so far
+    keys = np.empty(0, dtype=np.int64)
+    while shortage.any():
+        drawn = np.unique(np.repeat(np.arange(len(counts)), shortage) * n_items + rng.choice(n_items, shortage.sum(), p=popularity))
+        # draws of an anime the user already rated are discarded, which is what drawing without replacement amounts to
+        positions = np.searchsorted(keys, drawn)
+        new = keys[np.minimum(positions, len(keys) - 1)] != drawn if len(keys) else np.ones(len(drawn), dtype=bool)
+        keys = np.insert(keys, positions[new], drawn[new])
+        shortage = np.where(heavy, 0, counts - np.bincount(keys // n_items, minlength=len(counts)))
+
+    log_popularity = np.log(popularity)
+    heavy_users = np.flatnonzero(heavy)
+    heavy_items = [np.argpartition(-(log_popularity + rng.gumbel(size=n_items)), counts[user] - 1)[:counts[user]] for user in heavy_users]
+    users = np.concatenate([keys // n_items, np.repeat(heavy_users, counts[heavy_users])])
+    items = np.concatenate([keys % n_items, *heavy_items])
+
+    return users, items
+
+
+def write_synthetic_dataset(path: Path, n_ratings: int, n_users: int = None, seed: int = 0) -> Tuple[Path, Path]:
+    """Write a synthetic anime.csv and rating.csv into a directory, reusing them if they were already generated with the same settings.
+
+    Args:
+        path (Path): Directory of the synthetic dataset
+        n_ratings (int): Number of ratings
+        n_users (int, optional): Number of users. Defaults to None, in which case there are 100 ratings per user on average.
+        seed (int, optional): Seed of the generator. Defaults to 0.
+
+    Returns:
+        Tuple[Path, Path]: Paths of the anime and ratings tables
+    """
+    path = Path(path) / f'{n_ratings}_{n_users or "auto"}_{seed}'
+    anime_path, ratings_path = path / 'anime.csv', path / 'rating.csv'
+    if anime_path.exists() and ratings_path.exists():
+        return anime_path, ratings_path
+
+    path.mkdir(parents=True, exist_ok=True)
+    anime_df = generate_anime(seed)
+    anime_df.to_csv(anime_path, index=False)
+
+    tmp_path = ratings_path.with_name(ratings_path.name + f'.tmp{os.getpid()}')
+    for i, chunk in enumerate(generate_ratings(anime_df, n_ratings, n_users, seed=seed)):
+        chunk.to_csv(tmp_path, mode='w' if i == 0 else 'a', header=i == 0, index=False)
+    os.replace(tmp_path, ratings_path)
+
+    return anime_path, ratings_path
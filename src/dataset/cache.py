@@ -0,0 +1,162 @@
+import pandas as pd
+import numpy as np
+import json
+import os
+from typing import Optional
+
+from pathlib import Path
+abs_path = Path(__file__).parent
+
+from src.dataset.preprocessing import preprocess_anime_data, filter_ratings_data, catalogue_fingerprint
+from src.dataset.ratings import RatingsMatrix, build_ratings_store
+from src.instrumentation import instrumented, increment
+
+CACHE_PATH = abs_path / '../../data/processed/cache'
+
+ANIME_PATH = abs_path / '../../data/external/anime.csv'
+RATINGS_PATH = abs_path / '../../data/external/rating.csv'
+SIDE_TABLE_PATHS = [
+    abs_path / '../../data/raw/anime_dates.csv',
+    abs_path / '../../data/raw/anime_episodes.csv',
+    abs_path / '../../data/raw/anime_scores.csv',
+]
+
+# bumped whenever the preprocessing or the layout of the cached files changes
+CACHE_VERSION = 2
+
+RATINGS_DTYPES = {'user_id': np.int32, 'anime_id': np.int32, 'rating': np.int8}
+
+
+@instrumented
+def load_anime_data(anime_path: Path = ANIME_PATH, cache_path: Path = CACHE_PATH) -> pd.DataFrame:
+    """Load the processed anime dataset, preprocessing the raw one only if its cached version is missing or outdated.
+
+    Args:
+        anime_path (Path, optional): Raw anime dataset. Defaults to ANIME_PATH.
+        cache_path (Path, optional): Directory of the cached datasets. Defaults to CACHE_PATH.
+
+    Returns:
+        pd.DataFrame: Processed anime dataframe
+    """
+    cache_path = Path(cache_path)
+    signature = _sources_signature([anime_path] + SIDE_TABLE_PATHS)
+
+    if _read_manifest(cache_path / 'anime.json') == signature:
+        increment('dataset.cache.hits')
+        return pd.read_pickle(cache_path / 'anime.pkl')
+    increment('dataset.cache.misses')
+
+    anime_df = pd.read_csv(anime_path)
+    anime_df = preprocess_anime_data(anime_df)
+
+    cache_path.mkdir(parents=True, exist_ok=True)
+    _atomic_write(cache_path / 'anime.pkl', lambda f: anime_df.to_pickle(f))
+    _write_manifest(cache_path / 'anime.json', signature)
+
+    return anime_df
+
+
+@instrumented
+def load_ratings_data(anime_df: pd.DataFrame, ratings_path: Path = RATINGS_PATH, cache_path: Path = CACHE_PATH, mmap_mode: Optional[str] = None) -> pd.DataFrame:
+    """Load the ratings of the processed anime dataset, filtering the raw ones only if their cached version is missing or outdated.
+    The cached ratings are stored column by column as .npy files with compact dtypes (int32 ids and int8 ratings).
+
+    Args:
+        anime_df (pd.DataFrame): Processed anime dataframe
+        ratings_path (Path, optional): Raw ratings dataset. Defaults to RATINGS_PATH.
+        cache_path (Path, optional): Directory of the cached datasets. Defaults to CACHE_PATH.
+        mmap_mode (Optional[str], optional): Memory mapping mode of the cached columns, as in np.load. Defaults to None.
+
+    Returns:
+        pd.DataFrame: Filtered ratings dataframe
+    """
+    cache_path = Path(cache_path)
+    signature = _sources_signature([ratings_path])
+    signature['catalogue'] = catalogue_fingerprint(anime_df)
+
+    if _read_manifest(cache_path / 'ratings.json') == signature:
+        increment('dataset.cache.hits')
+        columns = {column: np.load(cache_path / f'ratings_{column}.npy', mmap_mode=mmap_mode) for column in RATINGS_DTYPES}
+        return pd.DataFrame(columns, copy=False)
+    increment('dataset.cache.misses')
+
+    ratings_df = pd.read_csv(ratings_path, dtype=RATINGS_DTYPES)
+    ratings_df = filter_ratings_data(ratings_df, anime_df).reset_index(drop=True)
+
+    cache_path.mkdir(parents=True, exist_ok=True)
+    for column in RATINGS_DTYPES:
+        values = ratings_df[column].to_numpy()
+        _atomic_write(cache_path / f'ratings_{column}.npy', lambda f: np.save(f, values))
+    _write_manifest(cache_path / 'ratings.json', signature)
+
+    return ratings_df
+
+
+@instrumented
+def load_ratings_matrix(anime_df: pd.DataFrame, ratings_path: Path = RATINGS_PATH, cache_path: Path = CACHE_PATH,
+                        chunk_size: int = 1_000_000) -> RatingsMatrix:
+    """Load the ratings of the processed anime dataset as a memory mapped RatingsMatrix, ingesting the raw ones chunk by chunk
+    only if their cached version is missing or outdated. Unlike load_ratings_data, the raw ratings never need to fit in memory:
+    every chunk is filtered and spilled to disk before the next one is read, see build_ratings_store.
+
+    Args:
+        anime_df (pd.DataFrame): Processed anime dataframe
+        ratings_path (Path, optional): Raw ratings dataset. Defaults to RATINGS_PATH.
+        cache_path (Path, optional): Directory of the cached datasets. Defaults to CACHE_PATH.
+        chunk_size (int, optional): Number of raw ratings read at once. Defaults to 1_000_000.
+
+    Returns:
+        RatingsMatrix: Memory mapped ratings matrix
+    """
+    cache_path = Path(cache_path)
+    signature = _sources_signature([ratings_path])
+    signature['catalogue'] = catalogue_fingerprint(anime_df)
+
+    if _read_manifest(cache_path / 'ratings_matrix.json') == signature:
+        increment('dataset.cache.hits')
+        return RatingsMatrix.load(cache_path / 'ratings_matrix')
+    increment('dataset.cache.misses')
+
+    chunks = (filter_ratings_data(chunk, anime_df) for chunk in pd.read_csv(ratings_path, dtype=RATINGS_DTYPES, chunksize=chunk_size))
+
+    cache_path.mkdir(parents=True, exist_ok=True)
+    matrix = build_ratings_store(chunks, cache_path / 'ratings_matrix', rating_scale=(1, 10), block_ratings=chunk_size)
+    _write_manifest(cache_path / 'ratings_matrix.json', signature)
+
+    return matrix
+
+
+def _sources_signature(paths: list) -> dict:
+    """Describe the current state of the source files a cached dataset is built from, by their size and modification time.
+
+    Args:
+        paths (list): Source files
+
+    Returns:
+        dict: Signature of the sources
+    """
+    signature = {'version': CACHE_VERSION}
+    for path in paths:
+        stat = os.stat(path)
+        signature[Path(path).name] = [stat.st_size, stat.st_mtime_ns]
+
+    return signature
+
+
+def _read_manifest(path: Path) -> Optional[dict]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_manifest(path: Path, signature: dict):
+    _atomic_write(path, lambda f: f.write(json.dumps(signature).encode()))
+
+
+def _atomic_write(path: Path, write):
+    tmp_path = path.with_name(path.name + f'.tmp{os.getpid()}')
+    with open(tmp_path, 'wb') as f:
+        write(f)
+    os.replace(tmp_path, path)
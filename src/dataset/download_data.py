@@ -1,8 +1,22 @@
 import io
+import threading
+import time
 import requests
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from jikanpy import Jikan
-from typing import Tuple
+from jikanpy.exceptions import APIException
+from requests.adapters import HTTPAdapter
+from typing import Callable, Iterable, List, Tuple
 
+from src.instrumentation import instrumented, increment, span
+
+JIKAN_URL = 'https://api.jikan.moe/v4'
+
+# Jikan allows 3 requests per second and 60 requests per minute
+JIKAN_RATE_LIMITS = [(3, 1.0), (60, 60.0)]
+
+@instrumented
 def get_anime_data(anime_id: int, variables: list) -> list:
     """Query Jikan API to ask for the release date, title in english, number of episodes or average score of a given anime.
 
@@ -42,6 +56,7 @@ def get_anime_data(anime_id: int, variables: list) -> list:
     
     return data
 
+@instrumented
 def _get_anime_data(anime_id: int) -> Tuple[str, float]:
     """Query Jikan API to obtain the title in english and release date of a given anime.
 
@@ -78,6 +93,7 @@ def _get_anime_data(anime_id: int) -> Tuple[str, float]:
     
     return title_english, year
 
+@instrumented
 def get_anime_episodes(anime_id: int) -> float:
     """Query Jikan API to obtain the number of episodes of a given anime.
 
@@ -105,6 +121,7 @@ def get_anime_episodes(anime_id: int) -> float:
     
     return nb_episodes
 
+@instrumented
 def get_anime_metadata(anime_id: int) -> Tuple[str, io.BytesIO]:
     """Query Jikan API to obtain the synopsis and cover image of a given anime.
 
@@ -141,4 +158,196 @@ def get_anime_metadata(anime_id: int) -> Tuple[str, io.BytesIO]:
         print(f"There was an error when trying to get information from anime with id {anime_id}")
         print(e)
 
-    return synopsis, cover_image
\ No newline at end of file
+    return synopsis, cover_image
+
+
+class RateLimiter:
+    """Thread-safe sliding window rate limiter: a request is only let through once, for every limit, fewer than the allowed number
+    of requests were made in the last period. All the limits record the same request time, so they can never be exceeded, not even at startup.
+
+    Args:
+        limits (list, optional): Limits in the form of (requests, seconds) tuples. Defaults to JIKAN_RATE_LIMITS.
+    """
+    def __init__(self, limits: list = JIKAN_RATE_LIMITS):
+        """Initializes an empty history of requests per limit
+        """
+        self.limits = limits
+        self.history = [deque() for _ in limits]
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Wait until a request can be made without exceeding any of the limits.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                wait = 0.0
+                for (capacity, period), history in zip(self.limits, self.history):
+                    while len(history) > 0 and history[0] <= now - period:
+                        history.popleft()
+                    if len(history) >= capacity:
+                        wait = max(wait, history[0] + period - now)
+                if wait <= 0:
+                    for history in self.history:
+                        history.append(now)
+                    return
+            time.sleep(wait)
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """HTTP adapter that applies a default timeout to the requests sent without one, such as the ones jikanpy makes through its session.
+
+    Args:
+        timeout (float): Timeout in seconds
+        kwargs: Pool settings, as accepted by HTTPAdapter
+    """
+    def __init__(self, timeout: float, **kwargs):
+        """Initializes the adapter
+        """
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super().send(request, **kwargs)
+
+
+class MetadataFetcher:
+    """Concurrent client of the Jikan API that fetches anime metadata and cover images on a thread pool.
+    All the threads share one pooled HTTP session and one rate limiter, and results are delivered through callbacks as soon as they arrive.
+
+    Args:
+        base_url (str, optional): Base url of the Jikan API. Defaults to JIKAN_URL.
+        max_workers (int, optional): Number of concurrent requests. Defaults to 4.
+        limiter (RateLimiter, optional): Rate limiter of the API requests, cover images are not limited. Defaults to None, in which case Jikan limits are used.
+        timeout (float, optional): Timeout of every request in seconds, API requests included. Defaults to 10.
+        max_retries (int, optional): Number of retries of a request that was rate limited, failed on the server side or timed out. Defaults to 3.
+    """
+    def __init__(self, base_url: str = JIKAN_URL, max_workers: int = 4, limiter: RateLimiter = None, timeout: float = 10, max_retries: int = 3):
+        """Initializes the HTTP session and the thread pool
+        """
+        self.session = requests.Session()
+        adapter = TimeoutHTTPAdapter(timeout, pool_connections=2, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.jikan = Jikan(selected_base=base_url, session=self.session)
+        self.limiter = limiter if limiter is not None else RateLimiter()
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def __enter__(self) -> 'MetadataFetcher':
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self, wait: bool = True):
+        """Cancel the pending requests and close the HTTP session.
+
+        Args:
+            wait (bool, optional): Whether to wait for the running requests to finish. Defaults to True.
+        """
+        self.executor.shutdown(wait=wait, cancel_futures=True)
+        self.session.close()
+
+    @instrumented
+    def get_anime(self, anime_id: int) -> dict:
+        """Query Jikan API for all the information of a given anime, retrying with exponential backoff when rate limited or on server errors.
+
+        Args:
+            anime_id (int): Anime to query about
+
+        Returns:
+            dict: Anime information received from the API
+        """
+        for attempt in range(self.max_retries + 1):
+            with span('dataset.download_data.rate_limit_wait'):
+                self.limiter.acquire()
+            increment('dataset.download_data.api_requests')
+            try:
+                with span('dataset.download_data.api_request'):
+                    return self.jikan.anime(int(anime_id))
+            except APIException as e:
+                increment(f'dataset.download_data.api_errors_{e.status_code}')
+                if attempt == self.max_retries or (e.status_code != 429 and e.status_code < 500):
+                    raise
+            except requests.RequestException:
+                increment('dataset.download_data.api_errors_network')
+                if attempt == self.max_retries:
+                    raise
+            increment('dataset.download_data.api_retries')
+            with span('dataset.download_data.backoff'):
+                time.sleep(2 ** attempt)
+
+    @instrumented
+    def get_cover_image(self, cover_image_url: str) -> io.BytesIO:
+        """Download a cover image through the pooled session.
+
+        Args:
+            cover_image_url (str): Url of the image
+
+        Returns:
+            io.BytesIO: Cover image
+        """
+        response = self.session.get(cover_image_url, timeout=self.timeout)
+        response.raise_for_status()
+        increment('dataset.download_data.image_bytes', len(response.content))
+
+        return io.BytesIO(response.content)
+
+    @instrumented
+    def fetch(self, anime_id: int) -> Tuple[str, io.BytesIO]:
+        """Obtain the synopsis and cover image of a given anime, as get_anime_metadata does.
+
+        Args:
+            anime_id (int): Anime to query about
+
+        Returns:
+            Tuple[str, io.BytesIO]: Synopsis and cover image of the anime
+        """
+        synopsis = None
+        cover_image = None
+
+        try:
+            anime_info = self.get_anime(anime_id)
+
+            try:
+                synopsis = anime_info['data']['synopsis']
+            except Exception as e:
+                print(f"There was an error when trying to get the synopsis from anime with id {anime_id}")
+                print(e)
+
+            try:
+                cover_image = self.get_cover_image(anime_info['data']['images']['jpg']['large_image_url'])
+            except Exception as e:
+                print(f"There was an error when trying to get the cover image from anime with id {anime_id}")
+                print(e)
+
+        except Exception as e:
+            print(f"There was an error when trying to get information from anime with id {anime_id}")
+            print(e)
+
+        return synopsis, cover_image
+
+    def fetch_many(self, anime_ids: Iterable[int], callback: Callable[[int, str, io.BytesIO], None] = None) -> List[Future]:
+        """Fetch the synopsis and cover image of several animes concurrently.
+
+        Args:
+            anime_ids (Iterable[int]): Animes to query about, requests are started in this order
+            callback (Callable[[int, str, io.BytesIO], None], optional): Function called with the anime id, synopsis and cover image of every anime
+                as soon as they are fetched. It runs on a worker thread. Defaults to None.
+
+        Returns:
+            List[Future]: One future per anime with its synopsis and cover image, they can be cancelled while they have not started
+        """
+        futures = []
+        for anime_id in anime_ids:
+            future = self.executor.submit(self.fetch, anime_id)
+            if callback is not None:
+                future.add_done_callback(lambda f, anime_id=anime_id: f.cancelled() or callback(anime_id, *f.result()))
+            futures.append(future)
+
+        return futures
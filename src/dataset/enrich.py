@@ -0,0 +1,174 @@
+import pandas as pd
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from pathlib import Path
+abs_path = Path(__file__).parent
+
+from src.dataset.download_data import MetadataFetcher
+
+RAW_PATH = abs_path / '../../data/raw'
+CHECKPOINT_PATH = abs_path / '../../data/processed/enrichment.jsonl'
+
+
+def extract_anime_fields(anime_info: dict) -> dict:
+    """Extract the fields used by the side tables from the Jikan API information of an anime.
+
+    Args:
+        anime_info (dict): Anime information received from the API
+
+    Returns:
+        dict: Title in english, year of release, number of episodes and average score of the anime
+    """
+    data = anime_info['data']
+
+    year = data.get('year')
+    if year is None:
+        year = (((data.get('aired') or {}).get('prop') or {}).get('from') or {}).get('year')
+
+    return {
+        'en_title': data.get('title_english'),
+        'year': year,
+        'episodes': data.get('episodes'),
+        'score': data.get('score'),
+    }
+
+
+def enrich_catalogue(anime_df: pd.DataFrame, fetcher: MetadataFetcher = None, checkpoint_path: Path = CHECKPOINT_PATH,
+                     output_path: Path = RAW_PATH, max_workers: int = 4) -> pd.DataFrame:
+    """Query Jikan API once for every anime of the catalogue and write all the side tables of data/raw.
+    Requests run concurrently under the fetcher rate limiter and every answered anime is appended to a checkpoint file,
+    so an interrupted run resumes where it stopped. Animes that failed are retried on the next run, and meanwhile keep
+    the values the side tables already had for them. The checkpoint is deleted once every anime has been fetched and the side tables
+    written, so the next run refreshes the whole catalogue again.
+
+    Args:
+        anime_df (pd.DataFrame): Raw anime dataframe
+        fetcher (MetadataFetcher, optional): Jikan client. Defaults to None, in which case one with the Jikan rate limits is created.
+        checkpoint_path (Path, optional): JSON lines file with the fields of every fetched anime. Defaults to CHECKPOINT_PATH.
+        output_path (Path, optional): Directory where the side tables are written. Defaults to RAW_PATH.
+        max_workers (int, optional): Number of concurrent requests. Defaults to 4.
+
+    Returns:
+        pd.DataFrame: Fetched fields of every anime of the catalogue
+    """
+    owns_fetcher = fetcher is None
+    if owns_fetcher:
+        fetcher = MetadataFetcher(max_workers=max_workers)
+
+    checkpoint_path = Path(checkpoint_path)
+    checkpoint_path.parent.mkdir(parents=True, exist_ok=True)
+    records = _read_checkpoint(checkpoint_path)
+
+    pending = [int(anime_id) for anime_id in anime_df.anime_id.values if int(anime_id) not in records]
+    failed = 0
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor, open(checkpoint_path, 'a') as f:
+            futures = [executor.submit(_fetch_record, fetcher, anime_id) for anime_id in pending]
+            for request_counter, future in enumerate(as_completed(futures), start=1):
+                record = future.result()
+                f.write(json.dumps(record) + '\n')
+                f.flush()
+                if 'error' in record:
+                    failed += 1
+                else:
+                    records[record['anime_id']] = record
+                print(f"{request_counter} out of {len(pending)} requests completed")
+    finally:
+        if owns_fetcher:
+            fetcher.close()
+
+    if failed > 0:
+        print(f"{failed} animes could not be fetched, run the enrichment again to retry them")
+
+    enriched = pd.DataFrame([records.get(int(anime_id), {'anime_id': int(anime_id)}) for anime_id in anime_df.anime_id.values],
+                            columns=['anime_id', 'en_title', 'year', 'episodes', 'score'])
+    write_side_tables(anime_df, enriched[enriched.anime_id.isin(records)], output_path)
+    if failed == 0:
+        checkpoint_path.unlink()
+
+    return enriched
+
+
+def write_side_tables(anime_df: pd.DataFrame, enriched: pd.DataFrame, output_path: Path = RAW_PATH):
+    """Write the side tables used by preprocess_anime_data from the fetched fields, merging them into the existing tables.
+    Episodes are only written for the animes whose number of episodes is unknown in the raw dataset and scores for the ones without rating.
+    The rows of the animes that were not fetched are kept as they are.
+
+    Args:
+        anime_df (pd.DataFrame): Raw anime dataframe
+        enriched (pd.DataFrame): Fetched fields of the animes that were successfully fetched
+        output_path (Path, optional): Directory where the side tables are written. Defaults to RAW_PATH.
+    """
+    output_path = Path(output_path)
+    enriched = enriched.astype({'year': 'float64', 'episodes': 'float64', 'score': 'float64'})
+
+    unknown_episodes = enriched.anime_id.isin(anime_df[anime_df.episodes == 'Unknown'].anime_id)
+    unknown_scores = enriched.anime_id.isin(anime_df[anime_df.rating.isna()].anime_id)
+
+    tables = {
+        'anime_metadata.csv': enriched[['anime_id', 'en_title', 'year']],
+        'anime_dates.csv': enriched[['anime_id', 'year']],
+        'anime_episodes.csv': enriched.loc[unknown_episodes, ['anime_id', 'episodes']],
+        'anime_scores.csv': enriched.loc[unknown_scores, ['anime_id', 'score']].rename(columns={'score': 'scores'}),
+    }
+    for file_name, table in tables.items():
+        if (output_path / file_name).exists():
+            existing = pd.read_csv(output_path / file_name)
+            table = pd.concat([existing[~existing.anime_id.isin(enriched.anime_id)], table]).sort_values('anime_id')
+        tmp_path = output_path / f'{file_name}.tmp{os.getpid()}'
+        table.to_csv(tmp_path, index=False)
+        os.replace(tmp_path, output_path / file_name)
+
+
+def _fetch_record(fetcher: MetadataFetcher, anime_id: int) -> dict:
+    try:
+        record = extract_anime_fields(fetcher.get_anime(anime_id))
+    except Exception as e:
+        print(f"There was an error when trying to get information from anime with id {anime_id}")
+        print(e)
+        return {'anime_id': anime_id, 'error': str(e)}
+
+    record['anime_id'] = anime_id
+
+    return record
+
+
+def _read_checkpoint(checkpoint_path: Path) -> dict:
+    """Read the animes successfully fetched by previous runs. The last line of a run that was killed while writing it is truncated,
+    so that the next record is appended on a line of its own.
+
+    Args:
+        checkpoint_path (Path): JSON lines checkpoint file
+
+    Returns:
+        dict: Fetched fields by anime id
+    """
+    records = {}
+    if not checkpoint_path.exists():
+        return records
+
+    complete_size = 0
+    with open(checkpoint_path, 'rb') as f:
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            complete_size += len(line)
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if 'error' not in record:
+                records[record['anime_id']] = record
+
+    if complete_size < os.path.getsize(checkpoint_path):
+        os.truncate(checkpoint_path, complete_size)
+
+    return records
+
+
+if __name__ == "__main__":
+    anime_df = pd.read_csv(abs_path / ('../../data/external/anime.csv'))
+
+    enrich_catalogue(anime_df)
@@ -0,0 +1,189 @@
+import io
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple, Optional, Tuple
+from PIL import Image
+
+from pathlib import Path
+abs_path = Path(__file__).parent
+
+METADATA_CACHE_PATH = abs_path / '../../data/processed/metadata.sqlite'
+
+
+class CachedMetadata(NamedTuple):
+    """Metadata of an anime as stored in the cache, with its cover image already resized to a thumbnail"""
+    anime_id: int
+    title: Optional[str]
+    title_english: Optional[str]
+    synopsis: Optional[str]
+    thumbnail: Optional[Image.Image]
+    fetched_at: float
+
+
+class MetadataCache:
+    """Persistent cache of anime metadata and cover thumbnails, backed by SQLite and fronted by an in-memory tier of recently used entries.
+    Thumbnails are stored as raw RGB pixels of the requested size, so reading them back does not involve any image decoding.
+    Entries expire after ttl seconds and the least recently used ones are evicted once the stored entries exceed max_bytes.
+    It can be used from several threads at once. Reads never write to the database: access times are kept in memory
+    and written in one batch by the next put, which usually runs on a background thread, or when the cache is closed.
+
+    Args:
+        path (Path, optional): SQLite database file. Defaults to METADATA_CACHE_PATH.
+        thumbnail_size (Tuple[int, int], optional): Width and height the cover images are resized to. Defaults to (250, 250).
+        ttl (float, optional): Seconds after which an entry has to be fetched again. Defaults to 7 days.
+        max_bytes (int, optional): Maximum size of the stored entries. Defaults to 256 MiB.
+        hot_size (int, optional): Number of entries kept in memory. Defaults to 128.
+    """
+    def __init__(self, path: Path = METADATA_CACHE_PATH, thumbnail_size: Tuple[int, int] = (250, 250), ttl: float = 7 * 24 * 3600,
+                 max_bytes: int = 256 * 2 ** 20, hot_size: int = 128):
+        """Initializes the cache by opening or creating its database
+        """
+        self.thumbnail_size = tuple(thumbnail_size)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hot_size = hot_size
+        self.hot = OrderedDict()
+        self.accessed_at = {}
+        self.closed = False
+        self.lock = threading.Lock()
+
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(str(path), check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS metadata ('
+            'anime_id INTEGER PRIMARY KEY, title TEXT, title_english TEXT, synopsis TEXT, '
+            'thumbnail BLOB, width INTEGER, height INTEGER, size INTEGER, fetched_at REAL, accessed_at REAL)'
+        )
+        self.connection.execute('CREATE INDEX IF NOT EXISTS metadata_accessed_at ON metadata (accessed_at)')
+        self.connection.commit()
+        self.total_bytes = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM metadata').fetchone()[0]
+
+    def __enter__(self) -> 'MetadataCache':
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Close the database. Metadata put afterwards, such as the one of requests still running, is not stored.
+        """
+        with self.lock:
+            if self.closed:
+                return
+            self._write_accesses()
+            self.connection.commit()
+            self.connection.close()
+            self.closed = True
+
+    def get(self, anime_id: int) -> Optional[CachedMetadata]:
+        """Get the cached metadata of an anime.
+
+        Args:
+            anime_id (int): Anime to look for
+
+        Returns:
+            Optional[CachedMetadata]: Metadata of the anime, or None if it is not cached or it has expired
+        """
+        anime_id = int(anime_id)
+        now = time.time()
+
+        with self.lock:
+            metadata = self.hot.get(anime_id)
+            if metadata is None:
+                row = self.connection.execute(
+                    'SELECT title, title_english, synopsis, thumbnail, width, height, fetched_at FROM metadata WHERE anime_id = ?', (anime_id,)
+                ).fetchone()
+                if row is None:
+                    return None
+                title, title_english, synopsis, thumbnail, width, height, fetched_at = row
+                if thumbnail is not None:
+                    thumbnail = Image.frombytes('RGB', (width, height), thumbnail)
+                metadata = CachedMetadata(anime_id, title, title_english, synopsis, thumbnail, fetched_at)
+
+            # expired entries are replaced by the next put of the anime, or evicted
+            if now - metadata.fetched_at > self.ttl:
+                self.hot.pop(anime_id, None)
+                return None
+
+            self.accessed_at[anime_id] = now
+            self._remember(metadata)
+
+        return metadata
+
+    def put(self, anime_id: int, synopsis: Optional[str], cover_image: Optional[io.BytesIO], title: str = None, title_english: str = None) -> CachedMetadata:
+        """Store the metadata of an anime, resizing its cover image into a thumbnail.
+
+        Args:
+            anime_id (int): Anime the metadata belongs to
+            synopsis (Optional[str]): Synopsis of the anime
+            cover_image (Optional[io.BytesIO]): Cover image of the anime, as downloaded
+            title (str, optional): Title of the anime. Defaults to None.
+            title_english (str, optional): Title in english of the anime. Defaults to None.
+
+        Returns:
+            CachedMetadata: Stored metadata, with the thumbnail already built
+        """
+        anime_id = int(anime_id)
+        now = time.time()
+
+        thumbnail, blob, width, height = None, None, None, None
+        if cover_image is not None:
+            thumbnail = Image.open(cover_image).convert('RGB').resize(self.thumbnail_size)
+            blob = thumbnail.tobytes()
+            width, height = thumbnail.size
+        size = (len(blob) if blob is not None else 0) + sum(len((text or '').encode()) for text in (title, title_english, synopsis))
+
+        metadata = CachedMetadata(anime_id, title, title_english, synopsis, thumbnail, now)
+        with self.lock:
+            if self.closed:
+                return metadata
+            self._write_accesses()
+            self._delete(anime_id)
+            self.connection.execute(
+                'INSERT INTO metadata VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (anime_id, title, title_english, synopsis, blob, width, height, size, now, now)
+            )
+            self.total_bytes += size
+            self._evict()
+            self.connection.commit()
+            self._remember(metadata)
+
+        return metadata
+
+    def _remember(self, metadata: CachedMetadata):
+        self.hot[metadata.anime_id] = metadata
+        self.hot.move_to_end(metadata.anime_id)
+        while len(self.hot) > self.hot_size:
+            self.hot.popitem(last=False)
+
+    def _write_accesses(self):
+        # eviction relies on the access times, so they are written before any entry is evicted
+        self.connection.executemany('UPDATE metadata SET accessed_at = ? WHERE anime_id = ?',
+                                    [(accessed_at, anime_id) for anime_id, accessed_at in self.accessed_at.items()])
+        self.accessed_at = {}
+
+    def _delete(self, anime_id: int):
+        self.hot.pop(anime_id, None)
+        row = self.connection.execute('SELECT size FROM metadata WHERE anime_id = ?', (anime_id,)).fetchone()
+        if row is not None:
+            self.connection.execute('DELETE FROM metadata WHERE anime_id = ?', (anime_id,))
+            self.total_bytes -= row[0]
+
+    def _evict(self):
+        """Delete the least recently used entries until the stored entries fit in max_bytes.
+        """
+        if self.total_bytes <= self.max_bytes:
+            return
+
+        evicted = []
+        for anime_id, size in self.connection.execute('SELECT anime_id, size FROM metadata ORDER BY accessed_at'):
+            if self.total_bytes <= self.max_bytes:
+                break
+            evicted.append((anime_id,))
+            self.total_bytes -= size
+        self.connection.executemany('DELETE FROM metadata WHERE anime_id = ?', evicted)
+        for (anime_id,) in evicted:
+            self.hot.pop(anime_id, None)
@@ -1,79 +1,226 @@
 import pandas as pd
 import numpy as np
 import html
+import hashlib
+import functools
+import os
+from typing import Tuple, Union
+from sklearn.preprocessing import StandardScaler, QuantileTransformer
 from surprise import Reader, Dataset
 
+from src.dataset.ratings import RatingsMatrix
+from src.instrumentation import instrumented, increment
+
 from pathlib import Path
 abs_path = Path(__file__).parent
 
-def preprocess_anime_data(df: pd.DataFrame) -> pd.DataFrame:
+# side tables of anime metadata fetched from the Jikan API, see src.dataset.enrich
+DATES_PATH = abs_path / '../../data/raw/anime_dates.csv'
+EPISODES_PATH = abs_path / '../../data/raw/anime_episodes.csv'
+SCORES_PATH = abs_path / '../../data/raw/anime_scores.csv'
+
+# genres of the animes that are not recommended
+EXCLUDED_GENRES = ['Hentai', 'Ecchi', 'Harem']
+# types of the animes that are recommended
+KEPT_TYPES = ['Movie', 'TV']
+MAX_EPISODES = 500
+# anime kept despite having more than MAX_EPISODES episodes
+EPISODES_OUTLIER_EXCEPTIONS = [2471]
+
+# columns that identify an anime but do not describe its content
+NON_FEATURE_COLUMNS = ['anime_id', 'name', 'episodes']
+
+
+@instrumented
+def preprocess_anime_data(df: pd.DataFrame, return_features: bool = False) -> Union[pd.DataFrame, Tuple[pd.DataFrame, np.ndarray]]:
     """Preprocess the raw anime dataset and make it suitable for training/inference.
+    Every step works on whole columns: animes are filtered before the output is built, the side tables are joined through
+    binary searches on their sorted ids and the output dataframe is assembled once, with uint8 genre dummies, bool type dummies,
+    float32 numerical columns and categorical names. The input dataframe is not modified.
 
     Args:
         df (pd.DataFrame): Dataframe to be processed
+        return_features (bool, optional): Whether to also return the normalized feature matrix of the processed animes. Defaults to False.
 
     Returns:
-        pd.DataFrame: Processed dataframe
+        Union[pd.DataFrame, Tuple[pd.DataFrame, np.ndarray]]: Processed dataframe, and its feature matrix if requested
     """
-    # convert name to unicode
-    df['name'] = df.name.map(lambda x: html.unescape(x))
+    # get genre dummies, splitting every distinct list of genres only once
+    genre_codes, genre_lists = pd.factorize(df.genre)
+    genre_lists = [genre_list.split(', ') for genre_list in genre_lists]
+    genres = sorted(set(genre for genre_list in genre_lists for genre in genre_list))
+    genre_columns = {genre: column for column, genre in enumerate(genres)}
+    # the last row stands for the animes without genre, whose code is -1
+    list_dummies = np.zeros((len(genre_lists) + 1, len(genres)), dtype=np.uint8)
+    for row, genre_list in enumerate(genre_lists):
+        list_dummies[row, [genre_columns[genre] for genre in genre_list]] = 1
 
-    # get genre dummies
-    genre_dummies = df['genre'].str.get_dummies(', ')
-    genre_dummies = genre_dummies.add_prefix('genre_')
-    genre_dummies.rename(columns=lambda x: x.replace(" ", "_"), inplace=True)
-    df = pd.concat([df, genre_dummies], axis=1)
+    # remove unappropiate genres and keep only movies or TV series
+    excluded_lists = list_dummies[:, [genre_columns[genre] for genre in EXCLUDED_GENRES if genre in genre_columns]].any(axis=1)
+    mask = ~excluded_lists[genre_codes] & df.type.isin(KEPT_TYPES).to_numpy()
+    anime_types = sorted(set(df.type.to_numpy()[mask]))
 
-    # remove unappropiate genres
-    mask = (df.genre_Hentai == 0) & (df.genre_Ecchi == 0) & (df.genre_Harem == 0)
-    df = df[mask]
-    df.drop(columns=['genre', 'genre_Hentai', 'genre_Ecchi', 'genre_Harem'], inplace=True)
+    # concat additional anime metadata - release date, only for the animes in the release dates table
+    anime_ids = df.anime_id.to_numpy()
+    has_year, year = _lookup(_read_side_table(DATES_PATH, 'year'), anime_ids)
+    rows = np.flatnonzero(mask & has_year)
+    anime_ids, year = anime_ids[rows], year[rows]
 
-    # keep only movies or TV series
-    mask = (df.type == 'Movie') | (df.type == 'TV')
-    df = df[mask]
+    # anime metadata - update episodes, and create new stillAiring feature based on the ones that remain unknown
+    episodes = df.episodes.to_numpy()[rows]
+    has_episodes, new_episodes = _lookup(_read_side_table(EPISODES_PATH, 'episodes'), anime_ids)
+    has_episodes &= ~np.isnan(new_episodes)
+    still_airing = (episodes == 'Unknown') & ~has_episodes
+    episodes = np.where(episodes == 'Unknown', np.nan, episodes).astype(np.float64)
+    episodes = np.where(has_episodes, new_episodes, episodes)
+
+    # anime metadata - update rating
+    rating = df.rating.to_numpy(dtype=np.float64)[rows]
+    has_score, score = _lookup(_read_side_table(SCORES_PATH, 'scores'), anime_ids)
+    has_score &= ~np.isnan(score)
+    rating = np.where(has_score, score, rating)
+
+    # remove outliers - animes with too much episodes, and rows without mean rating or release date
+    keep = ((episodes <= MAX_EPISODES) | np.isin(anime_ids, EPISODES_OUTLIER_EXCEPTIONS) | np.isnan(episodes)) & ~np.isnan(rating) & ~np.isnan(year)
+    rows = rows[keep]
+
+    # build the output once, keeping the column order of the raw dataset
+    columns = {}
+    for column in df.columns:
+        if column == 'anime_id':
+            columns[column] = anime_ids[keep]
+        elif column == 'name':
+            columns[column] = _unescape_names(df.name.to_numpy()[rows])
+        elif column == 'episodes':
+            columns[column] = episodes[keep].astype(np.float32)
+        elif column == 'rating':
+            columns[column] = rating[keep].astype(np.float32)
+        elif column == 'members':
+            columns[column] = df.members.to_numpy()[rows].astype(np.int32)
+        elif column not in ('genre', 'type'):
+            columns[column] = df[column].to_numpy()[rows]
+
+    dummies = list_dummies[genre_codes[rows]]
+    for genre, column in genre_columns.items():
+        if genre not in EXCLUDED_GENRES:
+            columns['genre_' + genre.replace(' ', '_')] = dummies[:, column]
 
     # get anime type dummies
-    type_dummies = pd.get_dummies(df.type, prefix='type')
-    df = pd.concat([df, type_dummies], axis=1)
-    df.drop(columns=['type'], inplace=True)
+    types = df.type.to_numpy()[rows]
+    for anime_type in anime_types:
+        columns['type_' + anime_type] = types == anime_type
 
-    # concat additional anime metadata - release date
-    release_dates = pd.read_csv(abs_path / ('../../data/raw/anime_dates.csv'))
-    df = df.merge(release_dates, on='anime_id')
+    columns['year'] = year[keep].astype(np.float32)
+    columns['stillAiring'] = still_airing[keep]
 
-    # set anime_id as df index
-    df.set_index('anime_id', drop=False, inplace=True)
-    
-    # anime metadata - update episodes
-    episode_data = pd.read_csv(abs_path / ('../../data/raw/anime_episodes.csv'))
-    episode_data.set_index('anime_id', inplace=True)
-    df.update(episode_data)
-    
-    # create new stillAiring feature based on episodes
-    df['stillAiring'] = df.episodes.map(lambda x: True if x == 'Unknown' else False)
+    df = pd.DataFrame(columns)
 
-    # cast episodes to float
-    df['episodes'] = df.episodes.replace('Unknown', np.nan)
-    df['episodes'] = df.episodes.astype("float64")
-    
-    # remove outliers - animes with too much episodes
-    df = df[(df.episodes <= 500) | (df.index == 2471) | (df.episodes.isna())]
-    
-    # anime metadata - update rating
-    scores_data = pd.read_csv(abs_path / ('../../data/raw/anime_scores.csv'))
-    scores_data.set_index('anime_id', inplace=True)
-    scores_data.rename(columns={'scores': 'rating'}, inplace=True)
-    df.update(scores_data)
-    
-    # remove rows without mean rating or release date
-    df.dropna(subset=['rating', 'year'], inplace=True)
-    
-    df.reset_index(drop=True, inplace=True)
+    if return_features:
+        return df, build_feature_matrix(df)
 
     return df
 
 
+def build_feature_matrix(anime_df: pd.DataFrame) -> np.ndarray:
+    """Build the normalized content-feature matrix used to compare animes.
+    Numerical features are scaled the same way as in the modelling notebook and every row is L2-normalized,
+    so the cosine similarity between two animes reduces to the dot product of their rows.
+
+    Args:
+        anime_df (pd.DataFrame): Processed anime dataframe
+
+    Returns:
+        np.ndarray: C-contiguous float32 matrix with one row per anime
+    """
+    columns = [column for column in anime_df.columns if column not in NON_FEATURE_COLUMNS]
+    features = np.empty((len(anime_df), len(columns)), dtype=np.float32)
+
+    for j, column in enumerate(columns):
+        values = anime_df[column].to_numpy(dtype=np.float64).reshape(-1, 1)
+        if column in ('rating', 'year'):
+            values = StandardScaler().fit_transform(values)
+        elif column == 'members':
+            values = QuantileTransformer(output_distribution='normal').fit_transform(values)
+        features[:, j] = values[:, 0]
+
+    norms = np.linalg.norm(features, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    features /= norms
+
+    return features
+
+
+@functools.lru_cache(maxsize=8)
+def _read_side_table_cached(path: str, column: str, mtime_ns: int) -> Tuple[np.ndarray, np.ndarray]:
+    table = pd.read_csv(path, usecols=['anime_id', column]).drop_duplicates('anime_id', keep='last')
+    order = np.argsort(table.anime_id.to_numpy(), kind='stable')
+
+    return table.anime_id.to_numpy()[order], table[column].to_numpy(dtype=np.float64)[order]
+
+
+def _read_side_table(path: Path, column: str) -> Tuple[np.ndarray, np.ndarray]:
+    """Read a side table of anime metadata sorted by anime_id, only once for as long as the file does not change.
+
+    Args:
+        path (Path): Side table with an anime_id column
+        column (str): Column of the values
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Sorted anime ids and their values
+    """
+    return _read_side_table_cached(str(path), column, os.stat(path).st_mtime_ns)
+
+
+def _lookup(table: Tuple[np.ndarray, np.ndarray], anime_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Find the values of the given animes in a side table.
+
+    Args:
+        table (Tuple[np.ndarray, np.ndarray]): Sorted anime ids and their values
+        anime_ids (np.ndarray): Animes to look for
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Whether every anime is in the table, and its value, NaN for the missing ones
+    """
+    table_ids, values = table
+    if len(table_ids) == 0:
+        return np.zeros(len(anime_ids), dtype=bool), np.full(len(anime_ids), np.nan)
+
+    positions = np.minimum(np.searchsorted(table_ids, anime_ids), len(table_ids) - 1)
+    found = table_ids[positions] == anime_ids
+
+    return found, np.where(found, values[positions], np.nan)
+
+
+def _unescape_names(names: np.ndarray) -> pd.Categorical:
+    # only the names with an html entity change, the rest are left untouched
+    names = names.copy()
+    escaped = np.flatnonzero(pd.Series(names, dtype=object).str.contains('&', regex=False, na=False).to_numpy())
+    names[escaped] = [html.unescape(name) for name in names[escaped]]
+
+    return pd.Categorical(names)
+
+
+def catalogue_fingerprint(df: pd.DataFrame) -> str:
+    """Compute a short hash that identifies the content of a processed anime dataframe.
+    It is used to key the artifacts derived from the catalogue, so that they are rebuilt whenever the preprocessing output changes.
+
+    Args:
+        df (pd.DataFrame): Processed anime dataframe, indexed either by position or by anime_id
+
+    Returns:
+        str: Hexadecimal fingerprint of the catalogue
+    """
+    if 'anime_id' not in df.columns:
+        df = df.reset_index()
+
+    hasher = hashlib.sha1()
+    hasher.update(','.join(map(str, df.columns)).encode())
+    hasher.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+
+    return hasher.hexdigest()[:16]
+
+
+@instrumented
 def preprocess_ratings_data(ratings: pd.DataFrame, anime: pd.DataFrame):
     """Preprocess the raw ratings dataset and make it suitable for training/inference.
 
@@ -84,14 +231,49 @@ def preprocess_ratings_data(ratings: pd.DataFrame, anime: pd.DataFrame):
     Returns:
         _type_: Ratings Surprise-dataset
     """
+    ratings = filter_ratings_data(ratings, anime)
+    
+    reader = Reader(rating_scale=(1,10))
+    ratings_dataset = Dataset(reader)
+    ratings_dataset = ratings_dataset.load_from_df(ratings, reader)
+
+    return ratings_dataset
+
+
+@instrumented
+def preprocess_ratings_matrix(ratings: pd.DataFrame, anime: pd.DataFrame) -> RatingsMatrix:
+    """Preprocess the raw ratings dataset into a compact sparse matrix. Unlike preprocess_ratings_data, no Python object is created per rating,
+    and the matrix can still be used in place of a Surprise dataset to build a trainset.
+
+    Args:
+        ratings (pd.DataFrame): Raw ratings dataframe
+        anime (pd.DataFrame): Processed anime dataframe
+
+    Returns:
+        RatingsMatrix: Ratings matrix
+    """
+    ratings = filter_ratings_data(ratings, anime)
+
+    return RatingsMatrix.from_frame(ratings, rating_scale=(1, 10))
+
+
+@instrumented
+def filter_ratings_data(ratings: pd.DataFrame, anime: pd.DataFrame) -> pd.DataFrame:
+    """Remove the ratings without score (-1) and the ones of animes that are not part of the processed anime dataset.
+
+    Args:
+        ratings (pd.DataFrame): Raw ratings dataframe
+        anime (pd.DataFrame): Processed anime dataframe
+
+    Returns:
+        pd.DataFrame: Filtered ratings dataframe
+    """
+    increment('dataset.preprocessing.ratings_read', len(ratings))
     ratings = ratings[ratings.rating != -1]
     if anime.index.name == "anime_id":
         ratings = ratings[ratings.anime_id.isin(anime.index)]
     else:
         ratings = ratings[ratings.anime_id.isin(anime.anime_id)]
-    
-    reader = Reader(rating_scale=(1,10))
-    ratings_dataset = Dataset(reader)
-    ratings_dataset = ratings_dataset.load_from_df(ratings, reader)
+    increment('dataset.preprocessing.ratings_kept', len(ratings))
 
-    return ratings_dataset
\ No newline at end of file
+    return ratings
@@ -0,0 +1,437 @@
+import pandas as pd
+import numpy as np
+import json
+import os
+import shutil
+from collections import defaultdict
+from pathlib import Path
+from typing import Iterable, Iterator, Tuple
+from surprise import Trainset
+
+# arrays of a ratings matrix, as saved on disk
+MATRIX_ARRAYS = ['user_ids', 'item_ids', 'user_indptr', 'items', 'ratings', 'item_indptr', 'item_users', 'item_scores']
+# dtypes of the raw columns spilled to disk by build_ratings_store
+SPILL_DTYPES = {'user_id': np.int32, 'anime_id': np.int32, 'rating': np.uint8}
+
+
+class RatingsMatrix:
+    """Sparse user-item ratings matrix stored both by user (CSR) and by item (CSC).
+    Users and items are identified by contiguous inner ids, which index the sorted raw user_id and anime_id arrays,
+    and every rating is stored once per layout as an int32 id plus a uint8 score.
+
+    Args:
+        user_ids (np.ndarray): Sorted raw user id of every inner user id
+        item_ids (np.ndarray): Sorted raw anime id of every inner item id
+        user_indptr (np.ndarray): Offsets of the ratings of every user in items and ratings, of shape (n_users + 1,)
+        items (np.ndarray): Inner item id of every rating, grouped by user
+        ratings (np.ndarray): Score of every rating, grouped by user
+        item_indptr (np.ndarray): Offsets of the ratings of every item in item_users and item_scores, of shape (n_items + 1,)
+        item_users (np.ndarray): Inner user id of every rating, grouped by item
+        item_scores (np.ndarray): Score of every rating, grouped by item
+        rating_scale (Tuple[int, int], optional): Minimum and maximum ratings. Defaults to (1, 10).
+    """
+    def __init__(self, user_ids: np.ndarray, item_ids: np.ndarray, user_indptr: np.ndarray, items: np.ndarray, ratings: np.ndarray,
+                 item_indptr: np.ndarray, item_users: np.ndarray, item_scores: np.ndarray, rating_scale: Tuple[int, int] = (1, 10)):
+        """Initializes the matrix from its already built arrays
+        """
+        self.user_ids = user_ids
+        self.item_ids = item_ids
+        self.user_indptr = user_indptr
+        self.items = items
+        self.ratings = ratings
+        self.item_indptr = item_indptr
+        self.item_users = item_users
+        self.item_scores = item_scores
+        self.rating_scale = rating_scale
+
+    @classmethod
+    def from_arrays(cls, user_ids: np.ndarray, anime_ids: np.ndarray, ratings: np.ndarray, rating_scale: Tuple[int, int] = (1, 10)) -> 'RatingsMatrix':
+        """Build the matrix from parallel arrays of raw user ids, raw anime ids and ratings.
+
+        Args:
+            user_ids (np.ndarray): Raw user id of every rating
+            anime_ids (np.ndarray): Raw anime id of every rating
+            ratings (np.ndarray): Score of every rating
+            rating_scale (Tuple[int, int], optional): Minimum and maximum ratings. Defaults to (1, 10).
+
+        Returns:
+            RatingsMatrix: Ratings matrix
+        """
+        raw_user_ids, users = np.unique(np.asarray(user_ids), return_inverse=True)
+        raw_item_ids, items = np.unique(np.asarray(anime_ids), return_inverse=True)
+        users = users.astype(np.int32)
+        items = items.astype(np.int32)
+        ratings = np.asarray(ratings).astype(np.uint8)
+
+        by_user = np.lexsort((items, users))
+        by_item = np.lexsort((users, items))
+
+        return cls(
+            user_ids=raw_user_ids.astype(np.int32),
+            item_ids=raw_item_ids.astype(np.int32),
+            user_indptr=_indptr(users, len(raw_user_ids)),
+            items=items[by_user],
+            ratings=ratings[by_user],
+            item_indptr=_indptr(items, len(raw_item_ids)),
+            item_users=users[by_item],
+            item_scores=ratings[by_item],
+            rating_scale=rating_scale,
+        )
+
+    @classmethod
+    def from_frame(cls, ratings: pd.DataFrame, rating_scale: Tuple[int, int] = (1, 10)) -> 'RatingsMatrix':
+        """Build the matrix from a filtered ratings dataframe with user_id, anime_id and rating columns.
+
+        Args:
+            ratings (pd.DataFrame): Filtered ratings dataframe
+            rating_scale (Tuple[int, int], optional): Minimum and maximum ratings. Defaults to (1, 10).
+
+        Returns:
+            RatingsMatrix: Ratings matrix
+        """
+        return cls.from_arrays(ratings.user_id.values, ratings.anime_id.values, ratings.rating.values, rating_scale)
+
+    @classmethod
+    def from_trainset(cls, trainset: Trainset) -> 'RatingsMatrix':
+        """Build the matrix from the ratings of a Surprise trainset, keeping its raw ids.
+
+        Args:
+            trainset (Trainset): Surprise trainset
+
+        Returns:
+            RatingsMatrix: Ratings matrix
+        """
+        raw_item_ids = np.array([trainset.to_raw_iid(inner_iid) for inner_iid in trainset.all_items()])
+
+        user_ids = np.empty(trainset.n_ratings, dtype=np.int64)
+        anime_ids = np.empty(trainset.n_ratings, dtype=np.int64)
+        ratings = np.empty(trainset.n_ratings, dtype=np.float64)
+        start = 0
+        for inner_uid, user_ratings in trainset.ur.items():
+            end = start + len(user_ratings)
+            if end > start:
+                inner_iids, scores = zip(*user_ratings)
+                user_ids[start:end] = trainset.to_raw_uid(inner_uid)
+                anime_ids[start:end] = raw_item_ids[list(inner_iids)]
+                ratings[start:end] = scores
+            start = end
+
+        return cls.from_arrays(user_ids, anime_ids, ratings, tuple(trainset.rating_scale))
+
+    @classmethod
+    def load(cls, path: Path, mmap_mode: str = 'r') -> 'RatingsMatrix':
+        """Load a matrix saved with save or built with build_ratings_store.
+
+        Args:
+            path (Path): Directory of the matrix
+            mmap_mode (str, optional): Memory mapping mode of the arrays, as in np.load, None to read them into memory. Defaults to 'r'.
+
+        Returns:
+            RatingsMatrix: Ratings matrix
+        """
+        path = Path(path)
+        with open(path / 'manifest.json') as f:
+            manifest = json.load(f)
+        arrays = {name: np.load(path / f'{name}.npy', mmap_mode=mmap_mode) for name in MATRIX_ARRAYS}
+
+        return cls(**arrays, rating_scale=tuple(manifest['rating_scale']))
+
+    def save(self, path: Path):
+        """Save the matrix as one .npy file per array, so that it can be loaded back memory mapped.
+
+        Args:
+            path (Path): Directory of the matrix
+        """
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        for name in MATRIX_ARRAYS:
+            np.save(path / f'{name}.npy', getattr(self, name))
+        _write_matrix_manifest(path, self)
+
+    @property
+    def n_users(self) -> int:
+        return len(self.user_ids)
+
+    @property
+    def n_items(self) -> int:
+        return len(self.item_ids)
+
+    @property
+    def n_ratings(self) -> int:
+        return len(self.ratings)
+
+    @property
+    def global_mean(self) -> float:
+        return float(self.ratings.mean(dtype=np.float64))
+
+    def users(self) -> np.ndarray:
+        """Get the inner user id of every rating, in the same order as items and ratings.
+
+        Returns:
+            np.ndarray: Inner user ids
+        """
+        return np.repeat(np.arange(self.n_users, dtype=np.int32), np.diff(self.user_indptr))
+
+    def iter_blocks(self, block_ratings: int = 1_000_000) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """Iterate over the ratings by blocks of whole users, so that a memory mapped matrix can be processed without loading all of it at once.
+
+        Args:
+            block_ratings (int, optional): Maximum number of ratings per block, unless a single user has more. Defaults to 1_000_000.
+
+        Yields:
+            Tuple[np.ndarray, np.ndarray, np.ndarray]: Inner user ids, inner item ids and scores of the ratings of a block
+        """
+        start = 0
+        while start < self.n_users:
+            end = np.searchsorted(self.user_indptr, self.user_indptr[start] + block_ratings, side='right') - 1
+            end = min(max(end, start + 1), self.n_users)
+            first, last = self.user_indptr[start], self.user_indptr[end]
+            users = np.repeat(np.arange(start, end, dtype=np.int32), np.diff(self.user_indptr[start:end + 1]))
+            yield users, np.asarray(self.items[first:last]), np.asarray(self.ratings[first:last])
+            start = end
+
+    def user_ratings(self, inner_uid: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Get the ratings of a user.
+
+        Args:
+            inner_uid (int): Inner id of the user
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Inner item ids and scores
+        """
+        start, end = self.user_indptr[inner_uid], self.user_indptr[inner_uid + 1]
+
+        return self.items[start:end], self.ratings[start:end]
+
+    def item_ratings(self, inner_iid: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Get the ratings of an item.
+
+        Args:
+            inner_iid (int): Inner id of the item
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Inner user ids and scores
+        """
+        start, end = self.item_indptr[inner_iid], self.item_indptr[inner_iid + 1]
+
+        return self.item_users[start:end], self.item_scores[start:end]
+
+    def to_inner_uids(self, user_ids: np.ndarray) -> np.ndarray:
+        """Map raw user ids to inner ids, -1 for users that are not part of the matrix.
+
+        Args:
+            user_ids (np.ndarray): Raw user ids
+
+        Returns:
+            np.ndarray: Inner user ids
+        """
+        return _to_inner_ids(self.user_ids, user_ids)
+
+    def to_inner_iids(self, anime_ids: np.ndarray) -> np.ndarray:
+        """Map raw anime ids to inner ids, -1 for animes that are not part of the matrix.
+
+        Args:
+            anime_ids (np.ndarray): Raw anime ids
+
+        Returns:
+            np.ndarray: Inner item ids
+        """
+        return _to_inner_ids(self.item_ids, anime_ids)
+
+    def build_full_trainset(self) -> Trainset:
+        """Convert the matrix into a Surprise trainset with the same inner ids, so that it can be used wherever a Surprise dataset is expected.
+
+        Returns:
+            Trainset: Surprise trainset with all the ratings
+        """
+        ratings = self.ratings.astype(np.float64).tolist()
+        items = self.items.tolist()
+        item_users = self.item_users.tolist()
+        item_scores = self.item_scores.astype(np.float64).tolist()
+
+        ur = defaultdict(list)
+        for inner_uid, (start, end) in enumerate(zip(self.user_indptr[:-1].tolist(), self.user_indptr[1:].tolist())):
+            ur[inner_uid] = list(zip(items[start:end], ratings[start:end]))
+        ir = defaultdict(list)
+        for inner_iid, (start, end) in enumerate(zip(self.item_indptr[:-1].tolist(), self.item_indptr[1:].tolist())):
+            ir[inner_iid] = list(zip(item_users[start:end], item_scores[start:end]))
+
+        return Trainset(
+            ur,
+            ir,
+            self.n_users,
+            self.n_items,
+            self.n_ratings,
+            self.rating_scale,
+            {user_id: inner_uid for inner_uid, user_id in enumerate(self.user_ids.tolist())},
+            {item_id: inner_iid for inner_iid, item_id in enumerate(self.item_ids.tolist())},
+        )
+
+
+def build_ratings_store(chunks: Iterable[pd.DataFrame], path: Path, rating_scale: Tuple[int, int] = (1, 10), block_ratings: int = 1_000_000) -> RatingsMatrix:
+    """Build a ratings matrix on disk from chunks of filtered ratings, for datasets that do not fit in memory.
+    Only one chunk of ratings and the per-user and per-item counters are held in memory at any time:
+    the chunks are first spilled into raw columns on disk, then their ids are encoded into inner ids block by block
+    and every rating is scattered into its place in the memory mapped CSR and CSC arrays. Within a user or an item,
+    ratings are kept in the order they were read. The matrix is written into a temporary directory that replaces path once complete.
+
+    Args:
+        chunks (Iterable[pd.DataFrame]): Filtered ratings dataframes with user_id, anime_id and rating columns
+        path (Path): Directory of the matrix
+        rating_scale (Tuple[int, int], optional): Minimum and maximum ratings. Defaults to (1, 10).
+        block_ratings (int, optional): Number of spilled ratings processed at once. Defaults to 1_000_000.
+
+    Returns:
+        RatingsMatrix: Memory mapped ratings matrix
+    """
+    path = Path(path)
+    tmp_path = path.with_name(path.name + f'.tmp{os.getpid()}')
+    tmp_path.mkdir(parents=True, exist_ok=True)
+
+    # spill the raw columns and collect the distinct ids
+    user_ids, item_ids = _DistinctIds(), _DistinctIds()
+    n_ratings = 0
+    spill_files = {name: open(tmp_path / f'spill_{name}.bin', 'wb') for name in SPILL_DTYPES}
+    try:
+        for chunk in chunks:
+            columns = {name: chunk[name].to_numpy().astype(dtype) for name, dtype in SPILL_DTYPES.items()}
+            for name, values in columns.items():
+                spill_files[name].write(values.tobytes())
+            user_ids.add(columns['user_id'])
+            item_ids.add(columns['anime_id'])
+            n_ratings += len(chunk)
+    finally:
+        for f in spill_files.values():
+            f.close()
+
+    user_ids, item_ids = user_ids.sorted(), item_ids.sorted()
+    spilled = {name: np.memmap(tmp_path / f'spill_{name}.bin', dtype=dtype, mode='r', shape=(n_ratings,))
+               if n_ratings > 0 else np.empty(0, dtype=dtype) for name, dtype in SPILL_DTYPES.items()}
+
+    def encoded_blocks():
+        for start in range(0, n_ratings, block_ratings):
+            users = np.searchsorted(user_ids, spilled['user_id'][start:start + block_ratings]).astype(np.int32)
+            items = np.searchsorted(item_ids, spilled['anime_id'][start:start + block_ratings]).astype(np.int32)
+            yield users, items, np.asarray(spilled['rating'][start:start + block_ratings])
+
+    # count the ratings of every user and item to know where each of them starts
+    user_counts = np.zeros(len(user_ids), dtype=np.int64)
+    item_counts = np.zeros(len(item_ids), dtype=np.int64)
+    for users, items, _ in encoded_blocks():
+        _add_counts(user_counts, users)
+        _add_counts(item_counts, items)
+    user_indptr = np.concatenate([[0], np.cumsum(user_counts)])
+    item_indptr = np.concatenate([[0], np.cumsum(item_counts)])
+
+    arrays = {
+        'user_ids': user_ids.astype(np.int32),
+        'item_ids': item_ids.astype(np.int32),
+        'user_indptr': user_indptr,
+        'item_indptr': item_indptr,
+    }
+    for name, array in arrays.items():
+        np.save(tmp_path / f'{name}.npy', array)
+    outputs = {name: np.lib.format.open_memmap(tmp_path / f'{name}.npy', mode='w+', dtype=dtype, shape=(n_ratings,))
+               for name, dtype in [('items', np.int32), ('ratings', np.uint8), ('item_users', np.int32), ('item_scores', np.uint8)]}
+
+    # scatter every rating into the next free position of its user and of its item
+    next_user_position = user_indptr[:-1].copy()
+    next_item_position = item_indptr[:-1].copy()
+    for users, items, ratings in encoded_blocks():
+        positions = _scatter_positions(users, next_user_position)
+        outputs['items'][positions] = items
+        outputs['ratings'][positions] = ratings
+        positions = _scatter_positions(items, next_item_position)
+        outputs['item_users'][positions] = users
+        outputs['item_scores'][positions] = ratings
+
+    for output in outputs.values():
+        output.flush()
+    del outputs, spilled
+    for name in SPILL_DTYPES:
+        os.remove(tmp_path / f'spill_{name}.bin')
+
+    _write_matrix_manifest(tmp_path, rating_scale=rating_scale, n_ratings=n_ratings)
+
+    # swap the complete matrix in place so that readers never see a partially written one
+    if path.exists():
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+
+    return RatingsMatrix.load(path)
+
+
+class _DistinctIds:
+    """Sorted set of ids that grows chunk by chunk, merging the distinct ids of the pending chunks only once they outnumber the merged ones"""
+    def __init__(self):
+        self.merged = np.empty(0, dtype=np.int64)
+        self.pending = []
+        self.n_pending = 0
+
+    def add(self, ids: np.ndarray):
+        ids = np.unique(ids)
+        self.pending.append(ids)
+        self.n_pending += len(ids)
+        if self.n_pending > max(len(self.merged), 1 << 20):
+            self.sorted()
+
+    def sorted(self) -> np.ndarray:
+        if self.pending:
+            self.merged = np.unique(np.concatenate([self.merged] + self.pending))
+            self.pending = []
+            self.n_pending = 0
+
+        return self.merged
+
+
+def _add_counts(counts: np.ndarray, ids: np.ndarray):
+    # only the ids present in the block are touched, counts can be much longer than a block
+    present, block_counts = np.unique(ids, return_counts=True)
+    counts[present] += block_counts
+
+
+def _scatter_positions(ids: np.ndarray, next_position: np.ndarray) -> np.ndarray:
+    """Assign every rating of a block the next free position of its row, in the order the ratings come, and advance those positions.
+
+    Args:
+        ids (np.ndarray): Inner row id of every rating of the block
+        next_position (np.ndarray): Next free position of every row, updated in place
+
+    Returns:
+        np.ndarray: Position of every rating
+    """
+    order = np.argsort(ids, kind='stable')
+    sorted_ids = ids[order]
+    present, first, block_counts = np.unique(sorted_ids, return_index=True, return_counts=True)
+
+    positions = np.empty(len(ids), dtype=np.int64)
+    positions[order] = next_position[sorted_ids] + np.arange(len(ids)) - np.repeat(first, block_counts)
+    next_position[present] += block_counts
+
+    return positions
+
+
+def _write_matrix_manifest(path: Path, matrix: RatingsMatrix = None, rating_scale: Tuple[int, int] = None, n_ratings: int = None):
+    if matrix is not None:
+        rating_scale, n_ratings = matrix.rating_scale, matrix.n_ratings
+    with open(Path(path) / 'manifest.json', 'w') as f:
+        json.dump({'rating_scale': list(rating_scale), 'n_ratings': int(n_ratings)}, f)
+
+
+def _indptr(ids: np.ndarray, n: int) -> np.ndarray:
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(ids, minlength=n), out=indptr[1:])
+
+    return indptr
+
+
+def _to_inner_ids(sorted_raw_ids: np.ndarray, raw_ids: np.ndarray) -> np.ndarray:
+    raw_ids = np.asarray(raw_ids)
+    if len(sorted_raw_ids) == 0 or len(raw_ids) == 0:
+        return np.full(len(raw_ids), -1, dtype=np.int64)
+
+    inner_ids = np.searchsorted(sorted_raw_ids, raw_ids)
+    inner_ids = np.minimum(inner_ids, len(sorted_raw_ids) - 1)
+    found = sorted_raw_ids[inner_ids] == raw_ids
+
+    return np.where(found, inner_ids, -1)
@@ -0,0 +1,289 @@
+import cProfile
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+from typing import Callable, Optional
+
+from pathlib import Path
+abs_path = Path(__file__).parent
+
+# instrumentation is configured from these environment variables when this module is imported:
+# ANIMEREC_INSTRUMENT=1 enables the spans and counters
+# ANIMEREC_METRICS_LOG=<file> appends one JSON line per finished span
+# ANIMEREC_PROFILE=cprofile|tracemalloc also profiles every outermost span, into ANIMEREC_PROFILE_DIR for cProfile
+INSTRUMENT_ENV = 'ANIMEREC_INSTRUMENT'
+METRICS_LOG_ENV = 'ANIMEREC_METRICS_LOG'
+PROFILE_ENV = 'ANIMEREC_PROFILE'
+PROFILE_DIR_ENV = 'ANIMEREC_PROFILE_DIR'
+
+PROFILES_PATH = abs_path / '../data/processed/profiles'
+PROFILE_MODES = ('cprofile', 'tracemalloc')
+
+_enabled = False
+_log_file = None
+_profile_mode = None
+_profile_path = PROFILES_PATH
+
+_lock = threading.Lock()
+# cProfile can only profile one span at a time
+_profiler_lock = threading.Lock()
+_local = threading.local()
+# span name -> [count, total seconds, max seconds, errors]
+_spans = {}
+# counter name -> value
+_counters = {}
+
+
+def enable(log_path: Optional[Path] = None, profile: Optional[str] = None, profile_path: Path = PROFILES_PATH):
+    """Start recording spans and counters.
+
+    Args:
+        log_path (Optional[Path], optional): JSON lines file where every finished span is appended. Defaults to None.
+        profile (Optional[str], optional): Profiling mode of the outermost spans, 'cprofile' or 'tracemalloc'. Defaults to None.
+        profile_path (Path, optional): Directory of the cProfile captures. Defaults to PROFILES_PATH.
+    """
+    global _enabled, _log_file, _profile_mode, _profile_path
+
+    if profile is not None and profile not in PROFILE_MODES:
+        raise ValueError(f"Unknown profiling mode {profile}, it must be one of {PROFILE_MODES}")
+
+    with _lock:
+        if _log_file is not None:
+            _log_file.close()
+        _log_file = open(log_path, 'a') if log_path is not None else None
+        _profile_mode = profile
+        _profile_path = Path(profile_path)
+        _enabled = True
+
+    if profile == 'tracemalloc' and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable():
+    """Stop recording spans and counters, keeping the ones recorded so far.
+    """
+    global _enabled, _log_file
+
+    with _lock:
+        _enabled = False
+        if _log_file is not None:
+            _log_file.close()
+            _log_file = None
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def reset():
+    """Forget the recorded spans and counters.
+    """
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+
+
+class _NullSpan:
+    """Span used while instrumentation is disabled, entering and exiting it does nothing"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    """Timed region of code, see span"""
+    __slots__ = ('name', 'start', 'parent', 'profiler', 'profiling')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.profiler = None
+        self.profiling = False
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        self.parent = stack[-1] if stack else None
+        stack.append(self.name)
+
+        if self.parent is None and _profile_mode is not None:
+            self._start_profiling()
+
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.perf_counter() - self.start
+        _local.stack.pop()
+
+        record = {'span': self.name, 'parent': self.parent, 'seconds': duration}
+        if exc_type is not None:
+            record['error'] = exc_type.__name__
+        if self.profiling:
+            record.update(self._stop_profiling())
+
+        with _lock:
+            stats = _spans.get(self.name)
+            if stats is None:
+                stats = _spans[self.name] = [0, 0.0, 0.0, 0]
+            stats[0] += 1
+            stats[1] += duration
+            stats[2] = max(stats[2], duration)
+            stats[3] += exc_type is not None
+            if _log_file is not None:
+                record['time'] = time.time()
+                record['thread'] = threading.current_thread().name
+                _log_file.write(json.dumps(record) + '\n')
+                _log_file.flush()
+
+        return False
+
+    def _start_profiling(self):
+        if _profile_mode == 'cprofile':
+            if not _profiler_lock.acquire(blocking=False):
+                return
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        elif tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        self.profiling = True
+
+    def _stop_profiling(self) -> dict:
+        if self.profiler is not None:
+            self.profiler.disable()
+            _profile_path.mkdir(parents=True, exist_ok=True)
+            profile_file = _profile_path / f'{self.name}.{os.getpid()}.{time.time_ns()}.prof'
+            self.profiler.dump_stats(profile_file)
+            _profiler_lock.release()
+            return {'profile': str(profile_file)}
+
+        if tracemalloc.is_tracing():
+            _, peak = tracemalloc.get_traced_memory()
+            top = tracemalloc.take_snapshot().statistics('lineno')[:5]
+            return {'traced_peak_mb': peak / 2 ** 20, 'top_allocations': [str(stat) for stat in top]}
+
+        return {}
+
+
+def span(name: str):
+    """Time a region of code, as in `with span('inference.fold_in'):`. Spans can be nested and every thread keeps its own stack of them.
+    While instrumentation is disabled, a shared no-op span is returned.
+
+    Args:
+        name (str): Name of the span
+
+    Returns:
+        Context manager that records the span
+    """
+    if not _enabled:
+        return _NULL_SPAN
+
+    return _Span(name)
+
+
+def instrumented(function: Callable = None, name: str = None) -> Callable:
+    """Decorator that records every call of a function as a span named after its module and name, e.g. model.inference.recommend.
+    While instrumentation is disabled, the only overhead of a call is checking a flag.
+
+    Args:
+        function (Callable, optional): Function to be instrumented. Defaults to None, to use the decorator with arguments.
+        name (str, optional): Name of the span. Defaults to None, in which case it is derived from the function.
+
+    Returns:
+        Callable: Instrumented function
+    """
+    if function is None:
+        return functools.partial(instrumented, name=name)
+
+    if name is None:
+        module = function.__module__[len('src.'):] if function.__module__.startswith('src.') else function.__module__
+        name = f'{module}.{function.__qualname__}'
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not _enabled:
+            return function(*args, **kwargs)
+        with _Span(name):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+def increment(name: str, value: float = 1):
+    """Increase a counter, e.g. the number of API requests or of processed ratings.
+
+    Args:
+        name (str): Name of the counter
+        value (float, optional): Amount to add. Defaults to 1.
+    """
+    if not _enabled:
+        return
+
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def snapshot() -> dict:
+    """Get the spans and counters recorded so far.
+
+    Returns:
+        dict: Count, total seconds, max seconds and errors of every span, and value of every counter
+    """
+    with _lock:
+        spans = {name: {'count': count, 'seconds': total, 'max_seconds': maximum, 'errors': errors}
+                 for name, (count, total, maximum, errors) in _spans.items()}
+        counters = dict(_counters)
+
+    return {'spans': spans, 'counters': counters}
+
+
+def prometheus_text() -> str:
+    """Export the spans and counters recorded so far in the Prometheus text exposition format.
+
+    Returns:
+        str: Metrics, one sample per line
+    """
+    metrics = snapshot()
+
+    lines = ['# TYPE animerec_span_seconds summary']
+    for name, stats in sorted(metrics['spans'].items()):
+        lines.append(f'animerec_span_seconds_count{{span="{name}"}} {stats["count"]}')
+        lines.append(f'animerec_span_seconds_sum{{span="{name}"}} {stats["seconds"]!r}')
+    lines.append('# TYPE animerec_span_max_seconds gauge')
+    for name, stats in sorted(metrics['spans'].items()):
+        lines.append(f'animerec_span_max_seconds{{span="{name}"}} {stats["max_seconds"]!r}')
+    lines.append('# TYPE animerec_span_errors_total counter')
+    for name, stats in sorted(metrics['spans'].items()):
+        lines.append(f'animerec_span_errors_total{{span="{name}"}} {stats["errors"]}')
+    lines.append('# TYPE animerec_events_total counter')
+    for name, value in sorted(metrics['counters'].items()):
+        lines.append(f'animerec_events_total{{name="{name}"}} {value}')
+
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(path: Path):
+    """Write the spans and counters recorded so far into a Prometheus text file, e.g. for the node exporter textfile collector.
+
+    Args:
+        path (Path): Metrics file
+    """
+    path = Path(path)
+    tmp_path = path.with_name(path.name + f'.tmp{os.getpid()}')
+    with open(tmp_path, 'w') as f:
+        f.write(prometheus_text())
+    os.replace(tmp_path, path)
+
+
+if os.environ.get(INSTRUMENT_ENV, '').lower() in ('1', 'true', 'yes') or os.environ.get(PROFILE_ENV):
+    enable(os.environ.get(METRICS_LOG_ENV), os.environ.get(PROFILE_ENV) or None, os.environ.get(PROFILE_DIR_ENV, PROFILES_PATH))
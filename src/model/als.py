@@ -0,0 +1,228 @@
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple, Union
+from surprise import Trainset
+from surprise.prediction_algorithms.predictions import Prediction
+
+from src.dataset.ratings import RatingsMatrix
+from src.model.factors import FactorModel
+
+
+class ALS:
+    """Biased matrix factorization recommender trained with alternating least squares over the arrays of a RatingsMatrix.
+    It estimates ratings as SVD from Surprise does, mu + bu + bi + qi @ pu, and exposes the same fit/predict/test surface,
+    but every epoch solves the regularized least squares problem of all the users and then of all the items with NumPy/BLAS,
+    instead of running one SGD step per rating.
+
+    Args:
+        n_factors (int, optional): Number of latent factors. Defaults to 20.
+        n_epochs (int, optional): Number of alternating user and item steps. Defaults to 10.
+        biased (bool, optional): Whether to use the global mean and the user and item biases. Defaults to True.
+        reg_all (float, optional): Regularization term of biases and factors, applied once per rating. Defaults to 0.1.
+        init_mean (float, optional): Mean of the normal distribution used to initialize the factors. Defaults to 0.
+        init_std_dev (float, optional): Standard deviation of the normal distribution used to initialize the factors. Defaults to 0.1.
+        random_state (int, optional): Seed of the factors initialization. Defaults to None.
+        n_jobs (int, optional): Number of threads solving blocks of users or items in parallel. Defaults to 1.
+        block_size (int, optional): Maximum number of users or items whose systems are solved at once. Defaults to 1024.
+        block_ratings (int, optional): Maximum number of ratings of the users or items whose systems are solved at once. Defaults to 262144.
+        verbose (bool, optional): Whether to print the current epoch. Defaults to False.
+    """
+    def __init__(self, n_factors: int = 20, n_epochs: int = 10, biased: bool = True, reg_all: float = 0.1, init_mean: float = 0,
+                 init_std_dev: float = 0.1, random_state: int = None, n_jobs: int = 1, block_size: int = 1024,
+                 block_ratings: int = 262144, verbose: bool = False):
+        """Initializes the hyper-parameters of the recommender
+        """
+        self.n_factors = n_factors
+        self.n_epochs = n_epochs
+        self.biased = biased
+        self.reg_all = reg_all
+        self.init_mean = init_mean
+        self.init_std_dev = init_std_dev
+        self.random_state = random_state
+        self.n_jobs = n_jobs
+        self.block_size = block_size
+        self.block_ratings = block_ratings
+        self.verbose = verbose
+
+    def fit(self, trainset: Union[RatingsMatrix, Trainset]) -> 'ALS':
+        """Train the recommender.
+
+        Args:
+            trainset (Union[RatingsMatrix, Trainset]): Training ratings, Surprise trainsets are converted into a RatingsMatrix
+
+        Returns:
+            ALS: Fitted recommender
+        """
+        if not isinstance(trainset, RatingsMatrix):
+            trainset = RatingsMatrix.from_trainset(trainset)
+        self.trainset = trainset
+
+        rng = np.random.default_rng(self.random_state)
+        self.pu = rng.normal(self.init_mean, self.init_std_dev, (trainset.n_users, self.n_factors))
+        self.qi = rng.normal(self.init_mean, self.init_std_dev, (trainset.n_items, self.n_factors))
+        self.bu = np.zeros(trainset.n_users)
+        self.bi = np.zeros(trainset.n_items)
+        self.global_mean = trainset.global_mean if self.biased else 0.0
+
+        # targets are computed block by block inside solve_factors, so that a memory mapped trainset is never loaded all at once
+        for epoch in range(self.n_epochs):
+            if self.verbose:
+                print(f"Processing epoch {epoch}")
+            self.bu, self.pu = self.solve_factors(trainset.user_indptr, trainset.items, trainset.ratings, self.qi, self.global_mean, self.bi)
+            self.bi, self.qi = self.solve_factors(trainset.item_indptr, trainset.item_users, trainset.item_scores, self.pu, self.global_mean, self.bu)
+
+        return self
+
+    def solve_factors(self, indptr: np.ndarray, indices: np.ndarray, targets: np.ndarray, fixed_factors: np.ndarray, offset: float = 0.0,
+                      fixed_biases: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Solve the regularized least squares problem of every row (user or item) with the factors of the other side fixed.
+        Besides the epochs of fit, it folds users or items into a trained model, e.g. the users unknown to it or the ones with new ratings.
+
+        Args:
+            indptr (np.ndarray): Offsets of the ratings of every row
+            indices (np.ndarray): Inner id on the fixed side of every rating
+            targets (np.ndarray): Rating of every rating minus the terms that do not depend on the row, except offset and fixed_biases
+            fixed_factors (np.ndarray): Factors of the fixed side
+            offset (float, optional): Term subtracted from every target, e.g. the global mean. Defaults to 0.0.
+            fixed_biases (np.ndarray, optional): Biases of the fixed side, subtracted from the targets of their ratings. Defaults to None.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Biases and factors of every row
+        """
+        if self.biased:
+            # the bias is solved along with the factors as an extra factor whose value on the fixed side is always 1
+            fixed_factors = np.hstack([np.ones((len(fixed_factors), 1)), fixed_factors])
+
+        n_rows = len(indptr) - 1
+        solution = np.zeros((n_rows, fixed_factors.shape[1]))
+
+        # blocks are bounded both in rows and in ratings, so that the gathered factors of a block always fit in memory
+        blocks = []
+        start = 0
+        while start < n_rows:
+            end = np.searchsorted(indptr, indptr[start] + self.block_ratings, side='right') - 1
+            end = min(max(end, start + 1), start + self.block_size, n_rows)
+            blocks.append((start, end))
+            start = end
+
+        def solve_block(block: Tuple[int, int]):
+            start, end = block
+            k = fixed_factors.shape[1]
+            offsets = indptr[start:end] - indptr[start]
+            counts = np.diff(indptr[start:end + 1])
+            block_indices = np.asarray(indices[indptr[start]:indptr[end]])
+            Y = fixed_factors[block_indices]
+            t = np.asarray(targets[indptr[start]:indptr[end]]).astype(np.float64) - offset
+            if fixed_biases is not None:
+                t -= fixed_biases[block_indices]
+
+            # rows without ratings get all their factors set to 0
+            A = np.zeros((end - start, k, k))
+            A[:, np.arange(k), np.arange(k)] = np.where(counts > 0, self.reg_all * counts, 1)[:, None]
+            b = np.zeros((end - start, k))
+
+            # rows with the same number of ratings are stacked and solved with batched products
+            for count in np.unique(counts[counts > 0]).tolist():
+                rows = np.flatnonzero(counts == count)
+                rating_indices = offsets[rows, None] + np.arange(count)
+                Z = Y[rating_indices]
+                A[rows] += Z.transpose(0, 2, 1) @ Z
+                b[rows] = (Z.transpose(0, 2, 1) @ t[rating_indices][..., None])[..., 0]
+
+            solution[start:end] = np.linalg.solve(A, b[..., None])[..., 0]
+
+        if self.n_jobs > 1:
+            with ThreadPoolExecutor(self.n_jobs) as executor:
+                list(executor.map(solve_block, blocks))
+        else:
+            for block in blocks:
+                solve_block(block)
+
+        if self.biased:
+            return solution[:, 0], solution[:, 1:]
+
+        return np.zeros(n_rows), solution
+
+    def estimate(self, inner_uids: np.ndarray, inner_iids: np.ndarray) -> np.ndarray:
+        """Estimate the ratings of several (user, item) pairs at once. Unknown users or items, with inner id -1, only get the known terms.
+
+        Args:
+            inner_uids (np.ndarray): Inner user ids
+            inner_iids (np.ndarray): Inner item ids
+
+        Returns:
+            np.ndarray: Estimated ratings, not clipped
+        """
+        known_users = inner_uids >= 0
+        known_items = inner_iids >= 0
+        known_both = known_users & known_items
+
+        est = np.full(len(inner_uids), self.global_mean)
+        est[known_users] += self.bu[inner_uids[known_users]]
+        est[known_items] += self.bi[inner_iids[known_items]]
+        est[known_both] += np.einsum('ij,ij->i', self.pu[inner_uids[known_both]], self.qi[inner_iids[known_both]])
+
+        return est
+
+    def predict(self, uid: int, iid: int, r_ui: float = None, clip: bool = True, verbose: bool = False) -> Prediction:
+        """Compute the rating prediction for a given user and item.
+
+        Args:
+            uid (int): Raw id of the user
+            iid (int): Raw id of the item
+            r_ui (float, optional): True rating. Defaults to None.
+            clip (bool, optional): Whether to clip the estimation into the rating scale. Defaults to True.
+            verbose (bool, optional): Whether to print the prediction. Defaults to False.
+
+        Returns:
+            Prediction: Surprise prediction
+        """
+        return self._predict([uid], [iid], [r_ui], clip, verbose)[0]
+
+    def test(self, testset: list, verbose: bool = False) -> list:
+        """Estimate all the ratings of a test set at once.
+
+        Args:
+            testset (list): List of (uid, iid, r_ui) tuples, as built by Surprise
+            verbose (bool, optional): Whether to print the predictions. Defaults to False.
+
+        Returns:
+            list: List of Surprise predictions
+        """
+        if len(testset) == 0:
+            return []
+        uids, iids, true_ratings = zip(*testset)
+
+        return self._predict(uids, iids, true_ratings, True, verbose)
+
+    def _predict(self, uids: list, iids: list, true_ratings: list, clip: bool, verbose: bool) -> list:
+        inner_uids = self.trainset.to_inner_uids(np.asarray(uids))
+        inner_iids = self.trainset.to_inner_iids(np.asarray(iids))
+
+        est = self.estimate(inner_uids, inner_iids)
+        if clip:
+            est = np.clip(est, *self.trainset.rating_scale)
+
+        predictions = [Prediction(uid, iid, r_ui, e, {'was_impossible': False}) for uid, iid, r_ui, e in zip(uids, iids, true_ratings, est.tolist())]
+        if verbose:
+            for prediction in predictions:
+                print(prediction)
+
+        return predictions
+
+    def to_factor_model(self) -> FactorModel:
+        """Extract the factors of the fitted recommender.
+
+        Returns:
+            FactorModel: Factors of the recommender
+        """
+        return FactorModel(
+            global_mean=float(self.global_mean),
+            bu=self.bu,
+            bi=self.bi,
+            pu=self.pu,
+            qi=self.qi,
+            user_ids=self.trainset.user_ids,
+            item_ids=self.trainset.item_ids,
+            rating_scale=tuple(self.trainset.rating_scale),
+        )
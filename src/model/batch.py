@@ -0,0 +1,276 @@
+import numpy as np
+import pandas as pd
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+from typing import Optional, Union
+from threadpoolctl import threadpool_limits
+
+from pathlib import Path
+abs_path = Path(__file__).parent
+
+from src.dataset.preprocessing import catalogue_fingerprint
+from src.dataset.cache import load_anime_data, load_ratings_matrix
+from src.dataset.ratings import RatingsMatrix
+from src.model.factors import FactorModel
+from src.model.registry import load_latest_model
+from src.model.scoring import BlockScorer, top_n, write_scoring_inputs
+from src.model.similarity import NeighbourTable, SimilarityIndex
+from src.instrumentation import instrumented
+
+BATCH_PATH = abs_path / '../../data/processed/batch'
+
+# state of the worker processes, set once per worker by _init_worker
+_worker = {}
+
+
+class BatchRecommendations:
+    """Top n recommendations of every user precomputed by recommend_all_users, read through memory mapping.
+    Rows are sorted by user_id, so the recommendations of a user are found with a binary search.
+
+    Args:
+        path (Path): Directory of the job that computed the recommendations
+    """
+    def __init__(self, path: Path):
+        """Initializes the recommendations by memory mapping their columns
+        """
+        self.path = Path(path)
+        self.user_ids = np.load(self.path / 'user_ids.npy', mmap_mode='r')
+        self.anime_ids = np.load(self.path / 'anime_ids.npy', mmap_mode='r')
+        self.scores = np.load(self.path / 'scores.npy', mmap_mode='r')
+
+    def __len__(self) -> int:
+        return len(self.user_ids)
+
+    def __contains__(self, user_id: int) -> bool:
+        row = np.searchsorted(self.user_ids, user_id)
+        return row < len(self) and self.user_ids[row] == user_id
+
+    def recommendations(self, user_id: int) -> list:
+        """Get the precomputed recommendations of a user.
+
+        Args:
+            user_id (int): Raw id of the user
+
+        Returns:
+            list: List of anime recommendations in the form of (anime_id, est_r_ui) tuples, sorted from highest to lowest estimated rating
+        """
+        if user_id not in self:
+            raise KeyError(user_id)
+
+        row = np.searchsorted(self.user_ids, user_id)
+        found = self.anime_ids[row] >= 0
+
+        return list(zip(self.anime_ids[row][found].tolist(), self.scores[row][found].tolist()))
+
+
+@instrumented
+def recommend_all_users(anime_df: pd.DataFrame, model: FactorModel, ratings: RatingsMatrix, path: Path = BATCH_PATH,
+                        index: Union[NeighbourTable, SimilarityIndex] = None, n: int = 10, k: int = 100, n_jobs: int = -1,
+                        shard_users: int = 20_000, block_users: int = 256, reg: float = 0.02) -> Path:
+    """Precompute the top n recommendations of every user of a ratings matrix, following the same steps as _get_recommendations:
+    candidates are the k most similar animes to the ones every user liked, minus the rated ones, ranked by estimated rating.
+    Users are split into shards that are processed on a pool of worker processes, which memory map the inputs of the job
+    and score blocks of users against all the items with a single matrix product per block. Users the model was not trained on
+    are folded into it. Every finished shard is saved on its own, so an interrupted job resumes from the missing shards
+    when it is run again with the same inputs. Once all of them are done, they are merged into one column file per field.
+
+    Args:
+        anime_df (pd.DataFrame): Processed anime dataframe
+        model (FactorModel): Factors of the trained recommender
+        ratings (RatingsMatrix): Ratings of the users, e.g. the memory mapped one of load_ratings_matrix
+        path (Path, optional): Directory of the job. Defaults to BATCH_PATH.
+        index (Union[NeighbourTable, SimilarityIndex], optional): Similarity index of anime_df. Defaults to None, in which case the precomputed neighbour table is used if available or an index is built on the fly.
+        n (int, optional): Number of recommendations per user. Defaults to 10.
+        k (int, optional): Number of similar animes per liked anime. Defaults to 100.
+        n_jobs (int, optional): Number of worker processes, -1 to use all cores. Defaults to -1.
+        shard_users (int, optional): Number of users per shard. Defaults to 20_000.
+        block_users (int, optional): Number of users scored at once by a worker. Defaults to 256.
+        reg (float, optional): Regularization term of the user bias and factors when folding in users. Defaults to 0.02.
+
+    Returns:
+        Path: Directory of the job, which can be read with BatchRecommendations
+    """
+    path = Path(path)
+    n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+    n_shards = -(-ratings.n_users // shard_users)
+
+    manifest = {
+        'fingerprint': catalogue_fingerprint(anime_df),
+        'model': _hash_arrays(model.bu, model.bi, model.pu, model.qi, model.user_ids, model.item_ids),
+        'ratings': _hash_arrays(ratings.user_ids, ratings.item_ids, ratings.user_indptr, ratings.items, ratings.ratings),
+        'n_ratings': ratings.n_ratings,
+        'n': n,
+        'k': k,
+        'shard_users': shard_users,
+        'reg': reg,
+    }
+    previous = _read_manifest(path)
+    if previous is not None and previous.get('complete') and {key: previous.get(key) for key in manifest} == manifest:
+        return path
+    if previous is None or {key: previous.get(key) for key in manifest} != manifest:
+        # the inputs changed, so the shards of a previous job cannot be reused
+        for name in ['inputs', 'shards']:
+            shutil.rmtree(path / name, ignore_errors=True)
+        path.mkdir(parents=True, exist_ok=True)
+        write_scoring_inputs(path / 'inputs', anime_df, model, ratings, index, k)
+        (path / 'shards').mkdir()
+        _write_manifest(path, dict(manifest, complete=False))
+
+    pending = [shard for shard in range(n_shards) if not (path / 'shards' / f'{shard:05d}.npz').exists()]
+    print(f"{n_shards - len(pending)} of {n_shards} shards already done")
+
+    start = time.perf_counter()
+    tasks = [(shard, shard * shard_users, min((shard + 1) * shard_users, ratings.n_users)) for shard in pending]
+    if n_jobs > 1 and len(tasks) > 1:
+        with multiprocessing.Pool(n_jobs, initializer=_init_worker, initargs=(path, n, block_users, reg, True)) as pool:
+            for i, _ in enumerate(pool.imap_unordered(_run_shard, tasks)):
+                print(f"{n_shards - len(pending) + i + 1} of {n_shards} shards done, {time.perf_counter() - start:.1f}s")
+    else:
+        _init_worker(path, n, block_users, reg)
+        for i, task in enumerate(tasks):
+            _run_shard(task)
+            print(f"{n_shards - len(pending) + i + 1} of {n_shards} shards done, {time.perf_counter() - start:.1f}s")
+        _worker.clear()
+
+    _merge_shards(path, n_shards, ratings.n_users, n)
+    _write_manifest(path, dict(_read_manifest(path), complete=True))
+    shutil.rmtree(path / 'shards')
+    shutil.rmtree(path / 'inputs')
+
+    return path
+
+
+def _init_worker(path: Path, n: int, block_users: int, reg: float, single_threaded: bool = False):
+    """Memory map the inputs of the job in a worker process, through the scorer of its users.
+
+    Args:
+        path (Path): Directory of the job
+        n (int): Number of recommendations per user
+        block_users (int): Number of users scored at once
+        reg (float): Regularization term of the user bias and factors when folding in users
+        single_threaded (bool, optional): Whether to limit BLAS to one thread. Defaults to False.
+    """
+    if single_threaded:
+        # every worker scores its own blocks, so BLAS threads would only compete with the other workers
+        _worker['threadpool_limits'] = threadpool_limits(limits=1)
+
+    _worker.update(scorer=BlockScorer(path / 'inputs', reg), path=path, n=n, block_users=block_users)
+
+
+def _run_shard(task: tuple):
+    """Compute the recommendations of the users of a shard and save them.
+
+    Args:
+        task (tuple): Shard index, first and last (excluded) inner user ids of the ratings matrix
+    """
+    shard, start, end = task
+    n, block_users = _worker['n'], _worker['block_users']
+
+    anime_ids = np.empty((end - start, n), dtype=np.int32)
+    scores = np.empty((end - start, n), dtype=np.float32)
+    for block_start in range(start, end, block_users):
+        block_end = min(block_start + block_users, end)
+        anime_ids[block_start - start:block_end - start], scores[block_start - start:block_end - start] = _recommend_block(block_start, block_end)
+
+    shard_path = _worker['path'] / 'shards' / f'{shard:05d}.npz'
+    tmp_path = shard_path.with_name(f'.tmp{os.getpid()}.npz')
+    np.savez(tmp_path, user_ids=np.asarray(_worker['scorer'].arrays['user_ids'][start:end]), anime_ids=anime_ids, scores=scores)
+    os.replace(tmp_path, shard_path)
+
+
+def _recommend_block(start: int, end: int) -> tuple:
+    """Compute the recommendations of a block of users with a single matrix product against all the items.
+
+    Args:
+        start (int): First inner user id of the block
+        end (int): Last inner user id of the block, excluded
+
+    Returns:
+        tuple: Recommended anime ids, -1 when there are less than n candidates, and their estimated ratings, both of shape (n_users, n)
+    """
+    scorer = _worker['scorer']
+    rows, items, model_items, ratings, _, estimated_ratings = scorer.score(start, end)
+
+    candidates = scorer.similar_candidates(rows, items, model_items, ratings, estimated_ratings.shape)
+    top_items, top_scores = top_n(estimated_ratings, candidates, _worker['n'])
+
+    found = np.isfinite(top_scores)
+    n = top_items.shape[1]
+    anime_ids = np.full((end - start, _worker['n']), -1, dtype=np.int32)
+    scores = np.full((end - start, _worker['n']), np.nan, dtype=np.float32)
+    anime_ids[:, :n] = np.where(found, np.asarray(scorer.arrays['model_item_ids'])[top_items], -1)
+    scores[:, :n] = np.where(found, np.clip(top_scores, *scorer.rating_scale), np.nan)
+
+    return anime_ids, scores
+
+
+def _merge_shards(path: Path, n_shards: int, n_users: int, n: int):
+    """Concatenate the shards into one column file per field.
+
+    Args:
+        path (Path): Directory of the job
+        n_shards (int): Number of shards
+        n_users (int): Number of users
+        n (int): Number of recommendations per user
+    """
+    columns = {
+        'user_ids': np.lib.format.open_memmap(path / 'user_ids.npy', mode='w+', dtype=np.int32, shape=(n_users,)),
+        'anime_ids': np.lib.format.open_memmap(path / 'anime_ids.npy', mode='w+', dtype=np.int32, shape=(n_users, n)),
+        'scores': np.lib.format.open_memmap(path / 'scores.npy', mode='w+', dtype=np.float32, shape=(n_users, n)),
+    }
+    start = 0
+    for shard in range(n_shards):
+        with np.load(path / 'shards' / f'{shard:05d}.npz') as shard_arrays:
+            end = start + len(shard_arrays['user_ids'])
+            for name, column in columns.items():
+                column[start:end] = shard_arrays[name]
+        start = end
+
+    for column in columns.values():
+        column.flush()
+
+
+def _hash_arrays(*arrays: np.ndarray) -> str:
+    hasher = hashlib.sha1()
+    # the buffers are hashed in place, as the rating arrays can be larger than the available memory
+    for array in arrays:
+        hasher.update(np.ascontiguousarray(array))
+
+    return hasher.hexdigest()[:16]
+
+
+def _read_manifest(path: Path) -> Optional[dict]:
+    try:
+        with open(Path(path) / 'manifest.json') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_manifest(path: Path, manifest: dict):
+    tmp_path = path / f'manifest.json.tmp{os.getpid()}'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(tmp_path, path / 'manifest.json')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Precompute the top n recommendations of every user of the ratings dataset')
+    parser.add_argument('--n', type=int, default=10, help='recommendations per user')
+    parser.add_argument('--jobs', type=int, default=-1, help='worker processes, all cores by default')
+    parser.add_argument('--output', type=Path, default=BATCH_PATH, help='directory of the job, an interrupted job is resumed from it')
+    args = parser.parse_args()
+
+    anime_df = load_anime_data()
+    model = load_latest_model(catalogue_fingerprint(anime_df))
+    if model is None:
+        sys.exit("There is no trained model for the current anime data, train one with python3 -m src.model.train")
+
+    path = recommend_all_users(anime_df, model, load_ratings_matrix(anime_df), args.output, n=args.n, n_jobs=args.jobs)
+    print(f"Recommendations of {len(BatchRecommendations(path))} users written into {path.resolve()}")
@@ -0,0 +1,330 @@
+import numpy as np
+import pandas as pd
+import argparse
+import multiprocessing
+import os
+import shutil
+import time
+from typing import Tuple, Union
+from threadpoolctl import threadpool_limits
+
+from pathlib import Path
+abs_path = Path(__file__).parent
+
+from src.dataset.cache import load_anime_data, load_ratings_matrix
+from src.dataset.ratings import RatingsMatrix, build_ratings_store
+from src.model.als import ALS
+from src.model.factors import FactorModel
+from src.model.scoring import BlockScorer, model_inner_ids, top_n, write_scoring_inputs
+from src.model.similarity import NeighbourTable, SimilarityIndex
+from src.model.train import simple_train, _holdout_mask
+from src.instrumentation import instrumented
+
+EVALUATION_PATH = abs_path / '../../data/processed/evaluation'
+
+# ratings from which a test anime counts as relevant to its user, the mean rating of rating.csv being close to 8
+RELEVANT_RATING = 8
+
+# animes the recommendations are chosen from: the whole catalogue, or the animes similar to the liked ones as in _get_recommendations
+CANDIDATES = ['all', 'similar']
+
+# arrays every worker memory maps from the inputs directory, along with the ones of its scorer
+TEST_ARRAYS = ['test_indptr', 'test_items', 'test_ratings']
+
+# state of the worker processes, set once per worker by _init_worker
+_worker = {}
+
+
+@instrumented
+def split_ratings(ratings: RatingsMatrix, path: Path = EVALUATION_PATH, test_size: float = 0.2, random_state: int = 5,
+                  block_ratings: int = 1_000_000) -> Tuple[RatingsMatrix, RatingsMatrix]:
+    """Split a ratings matrix into train and test ratings stores, block by block, with the same split as holdout_rmse.
+
+    Args:
+        ratings (RatingsMatrix): Ratings matrix, usually memory mapped
+        path (Path, optional): Directory of the train and test stores. Defaults to EVALUATION_PATH.
+        test_size (float, optional): Fraction of the ratings in the test split. Defaults to 0.2.
+        random_state (int, optional): Seed of the split. Defaults to 5.
+        block_ratings (int, optional): Number of ratings processed at once. Defaults to 1_000_000.
+
+    Returns:
+        Tuple[RatingsMatrix, RatingsMatrix]: Memory mapped train and test ratings matrices
+    """
+    path = Path(path)
+
+    def chunks(split: str):
+        for users, items, scores in ratings.iter_blocks(block_ratings):
+            user_ids, anime_ids = ratings.user_ids[users], ratings.item_ids[items]
+            keep = _holdout_mask(user_ids, anime_ids, test_size, random_state)
+            if split == 'train':
+                keep = ~keep
+            yield pd.DataFrame({'user_id': user_ids[keep], 'anime_id': anime_ids[keep], 'rating': scores[keep]})
+
+    train = build_ratings_store(chunks('train'), path / 'train', ratings.rating_scale, block_ratings)
+    test = build_ratings_store(chunks('test'), path / 'test', ratings.rating_scale, block_ratings)
+
+    return train, test
+
+
+@instrumented
+def evaluate(anime_df: pd.DataFrame, model: FactorModel, train: RatingsMatrix, test: RatingsMatrix, path: Path = EVALUATION_PATH,
+             index: Union[NeighbourTable, SimilarityIndex] = None, k: int = 10, candidates: list = CANDIDATES, similar_k: int = 100,
+             relevant_rating: int = RELEVANT_RATING, n_jobs: int = -1, shard_users: int = 20_000, block_users: int = 256,
+             reg: float = 0.02) -> pd.DataFrame:
+    """Evaluate the rating estimates and the top k recommendations of a recommender on held out ratings.
+    Users are scored by blocks against all the items with a BlockScorer, as in recommend_all_users, and every block
+    yields the RMSE of its test ratings along with the precision@k, recall@k and NDCG@k of its top k recommendations, which are chosen
+    from every candidate set in turn, excluding the animes rated in train. Blocks are grouped into shards of users that are
+    processed on a pool of worker processes. Only the users with relevant test ratings count towards the ranking metrics,
+    and test users without train ratings only count towards the RMSE.
+
+    Args:
+        anime_df (pd.DataFrame): Processed anime dataframe
+        model (FactorModel): Factors of a recommender trained on the train ratings
+        train (RatingsMatrix): Train ratings, whose users are folded into the model if it was not trained on them
+        test (RatingsMatrix): Test ratings
+        path (Path, optional): Directory the inputs of the workers are written into. Defaults to EVALUATION_PATH.
+        index (Union[NeighbourTable, SimilarityIndex], optional): Similarity index of anime_df. Defaults to None, in which case the precomputed neighbour table is used if available or an index is built on the fly.
+        k (int, optional): Number of recommendations per user. Defaults to 10.
+        candidates (list, optional): Candidate sets to be evaluated, among CANDIDATES. Defaults to CANDIDATES.
+        similar_k (int, optional): Number of similar animes per liked anime of the similar candidates. Defaults to 100.
+        relevant_rating (int, optional): Ratings from which a test anime is relevant. Defaults to RELEVANT_RATING.
+        n_jobs (int, optional): Number of worker processes, -1 to use all cores. Defaults to -1.
+        shard_users (int, optional): Number of users per shard. Defaults to 20_000.
+        block_users (int, optional): Number of users scored at once by a worker. Defaults to 256.
+        reg (float, optional): Regularization term of the user bias and factors when folding in users. Defaults to 0.02.
+
+    Returns:
+        pd.DataFrame: RMSE, precision@k, recall@k, NDCG@k, catalogue coverage (fraction of the animes of anime_df recommended to some user)
+            and number of evaluated users of every candidate set
+    """
+    path = Path(path)
+    n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+
+    shutil.rmtree(path / 'inputs', ignore_errors=True)
+    path.mkdir(parents=True, exist_ok=True)
+    write_scoring_inputs(path / 'inputs', anime_df, model, train, index, similar_k)
+    totals = _write_test_arrays(path / 'inputs', model, train, test)
+
+    tasks = [(start, min(start + shard_users, train.n_users)) for start in range(0, train.n_users, shard_users)]
+    initargs = (path, k, block_users, reg, list(candidates), relevant_rating)
+    if n_jobs > 1 and len(tasks) > 1:
+        with multiprocessing.Pool(n_jobs, initializer=_init_worker, initargs=initargs + (True,)) as pool:
+            results = pool.imap_unordered(_evaluate_shard, tasks)
+            for result in results:
+                totals = _add_totals(totals, result)
+    else:
+        _init_worker(*initargs)
+        for task in tasks:
+            totals = _add_totals(totals, _evaluate_shard(task))
+        _worker.clear()
+
+    shutil.rmtree(path / 'inputs')
+
+    rmse = float(np.sqrt(totals['squared_error'] / max(totals['n_ratings'], 1)))
+    metrics = []
+    for name in candidates:
+        users = max(totals[name]['users'], 1)
+        metrics.append({
+            'candidates': name,
+            'rmse': rmse,
+            f'precision@{k}': totals[name]['precision'] / users,
+            f'recall@{k}': totals[name]['recall'] / users,
+            f'ndcg@{k}': totals[name]['ndcg'] / users,
+            'coverage': float((totals[name]['recommended'] > 0).sum() / len(anime_df)),
+            'users': totals[name]['users'],
+        })
+
+    return pd.DataFrame(metrics).set_index('candidates')
+
+
+def _write_test_arrays(path: Path, model: FactorModel, train: RatingsMatrix, test: RatingsMatrix) -> dict:
+    """Write the test ratings of the train users, grouped by their inner user id in the train matrix, with model inner item ids.
+    The test ratings of the users without train ratings are only estimated here, for the RMSE.
+
+    Args:
+        path (Path): Directory of the inputs
+        model (FactorModel): Factors of the recommender
+        train (RatingsMatrix): Train ratings
+        test (RatingsMatrix): Test ratings
+
+    Returns:
+        dict: Squared error and number of the test ratings of the users without train ratings
+    """
+    counts = np.diff(test.user_indptr)
+    train_users = train.to_inner_uids(test.user_ids)
+    in_train = np.repeat(train_users >= 0, counts)
+    test_items = model_inner_ids(np.asarray(model.item_ids, dtype=np.int64), test.item_ids)[np.asarray(test.items)].astype(np.int32)
+    test_ratings = np.asarray(test.ratings)
+
+    # test users are sorted by raw id in both matrices, so their ratings are already grouped by train inner user id
+    train_counts = np.zeros(train.n_users, dtype=np.int64)
+    train_counts[train_users[train_users >= 0]] = counts[train_users >= 0]
+    np.save(path / 'test_indptr.npy', np.concatenate([[0], np.cumsum(train_counts)]))
+    np.save(path / 'test_items.npy', test_items[in_train])
+    np.save(path / 'test_ratings.npy', test_ratings[in_train])
+
+    model_users = model_inner_ids(np.asarray(model.user_ids, dtype=np.int64), test.user_ids)
+    users = np.repeat(model_users, counts)[~in_train]
+    items = test_items[~in_train]
+    known_user, known_item = users >= 0, items >= 0
+    both = known_user & known_item
+    est = np.full(len(users), model.global_mean)
+    est[known_user] += model.bu[users[known_user]]
+    est[known_item] += model.bi[items[known_item]]
+    est[both] += np.einsum('ij,ij->i', model.pu[users[both]], model.qi[items[both]])
+    est = np.clip(est, *model.rating_scale)
+
+    return {'squared_error': float(((est - test_ratings[~in_train]) ** 2).sum()), 'n_ratings': len(est)}
+
+
+def _init_worker(path: Path, k: int, block_users: int, reg: float, candidates: list, relevant_rating: int, single_threaded: bool = False):
+    """Memory map the inputs of the evaluation in a worker process.
+
+    Args:
+        path (Path): Directory of the evaluation
+        k (int): Number of recommendations per user
+        block_users (int): Number of users scored at once
+        reg (float): Regularization term of the user bias and factors when folding in users
+        candidates (list): Candidate sets to be evaluated
+        relevant_rating (int): Ratings from which a test anime is relevant
+        single_threaded (bool, optional): Whether to limit BLAS to one thread. Defaults to False.
+    """
+    if single_threaded:
+        # every worker scores its own blocks, so BLAS threads would only compete with the other workers
+        _worker['threadpool_limits'] = threadpool_limits(limits=1)
+
+    _worker.update({name: np.load(path / 'inputs' / f'{name}.npy', mmap_mode='r') for name in TEST_ARRAYS})
+    _worker.update(scorer=BlockScorer(path / 'inputs', reg), block_users=block_users, k=k, candidates=candidates, relevant_rating=relevant_rating)
+
+
+def _evaluate_shard(task: tuple) -> dict:
+    """Evaluate the users of a shard.
+
+    Args:
+        task (tuple): First and last (excluded) inner user ids of the train matrix
+
+    Returns:
+        dict: Totals of the metrics of the shard, see _add_totals
+    """
+    start, end = task
+    block_users = _worker['block_users']
+
+    totals = None
+    for block_start in range(start, end, block_users):
+        totals = _add_totals(totals, _evaluate_block(block_start, min(block_start + block_users, end)))
+
+    return totals
+
+
+def _evaluate_block(start: int, end: int) -> dict:
+    """Evaluate a block of users against their test ratings.
+
+    Args:
+        start (int): First inner user id of the block
+        end (int): Last inner user id of the block, excluded
+
+    Returns:
+        dict: Squared error and number of the test ratings, and sums of the precision, recall and NDCG of the evaluated users,
+            their number and the times every item was recommended, by candidate set
+    """
+    w = _worker
+    scorer = w['scorer']
+    rows, items, model_items, ratings, bu, estimated_ratings = scorer.score(start, end)
+
+    indptr = np.asarray(w['test_indptr'][start:end + 1])
+    test_rows = np.repeat(np.arange(end - start), np.diff(indptr))
+    test_items = np.asarray(w['test_items'][indptr[0]:indptr[-1]])
+    test_ratings = np.asarray(w['test_ratings'][indptr[0]:indptr[-1]])
+
+    # items unknown to the model are estimated from the biases only, as Surprise does
+    known = test_items >= 0
+    est = scorer.global_mean + bu[test_rows]
+    est[known] = estimated_ratings[test_rows[known], test_items[known]]
+    est = np.clip(est, *scorer.rating_scale)
+    totals = {'squared_error': float(((est - test_ratings) ** 2).sum()), 'n_ratings': len(test_ratings)}
+
+    relevant = np.zeros(estimated_ratings.shape, dtype=bool)
+    is_relevant = test_ratings >= w['relevant_rating']
+    relevant[test_rows[is_relevant & known], test_items[is_relevant & known]] = True
+    # relevant items unknown to the model can never be recommended, but they still count as missed. Duplicated ratings only count once
+    n_relevant = relevant.sum(axis=1) + np.bincount(test_rows[is_relevant & ~known], minlength=end - start)
+    evaluated = n_relevant > 0
+
+    k = w['k']
+    discounts = 1 / np.log2(np.arange(2, k + 2))
+    ideal_dcg = np.cumsum(discounts)[np.clip(n_relevant, 1, k) - 1]
+    for i, name in enumerate(w['candidates']):
+        if name == 'similar':
+            candidates = scorer.similar_candidates(rows, items, model_items, ratings, estimated_ratings.shape)
+        else:
+            candidates = scorer.unrated_candidates(rows, model_items, estimated_ratings.shape)
+        # the last candidate set can overwrite the estimated ratings
+        scores = estimated_ratings if i == len(w['candidates']) - 1 else estimated_ratings.copy()
+        top_k, top_scores = top_n(scores, candidates, k)
+
+        found = np.isfinite(top_scores)
+        hits = np.take_along_axis(relevant, top_k, axis=1) & found
+        n_hits = hits.sum(axis=1)
+        dcg = (hits * discounts[:top_k.shape[1]]).sum(axis=1)
+
+        totals[name] = {
+            'precision': float((n_hits / k)[evaluated].sum()),
+            'recall': float((n_hits / np.maximum(n_relevant, 1))[evaluated].sum()),
+            'ndcg': float((dcg / ideal_dcg)[evaluated].sum()),
+            'users': int(evaluated.sum()),
+            'recommended': np.bincount(top_k[evaluated][found[evaluated]], minlength=estimated_ratings.shape[1]),
+        }
+
+    return totals
+
+
+def _add_totals(totals: dict, other: dict) -> dict:
+    """Add up the totals of two groups of users, either of which can be missing.
+
+    Args:
+        totals (dict): Totals of the first group, None if there is none
+        other (dict): Totals of the second group
+
+    Returns:
+        dict: Totals of both groups
+    """
+    if totals is None:
+        return other
+
+    merged = dict(totals)
+    for key, value in other.items():
+        merged[key] = _add_totals(totals.get(key), value) if isinstance(value, dict) else totals.get(key, 0) + value
+
+    return merged
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Evaluate the rating estimates and the top k recommendations of recommenders on a holdout split')
+    parser.add_argument('--algorithms', nargs='+', choices=['svd', 'als'], default=['svd', 'als'], help='recommenders trained on the train split')
+    parser.add_argument('--k', type=int, default=10, help='recommendations per user')
+    parser.add_argument('--candidates', nargs='+', choices=CANDIDATES, default=CANDIDATES, help='candidate sets the recommendations are chosen from')
+    parser.add_argument('--relevant-rating', type=int, default=RELEVANT_RATING, help='ratings from which a test anime is relevant')
+    parser.add_argument('--jobs', type=int, default=-1, help='worker processes, all cores by default')
+    parser.add_argument('--output', type=Path, default=EVALUATION_PATH, help='directory of the train and test splits')
+    args = parser.parse_args()
+
+    anime_df = load_anime_data()
+    train, test = split_ratings(load_ratings_matrix(anime_df), args.output)
+
+    results = []
+    for algorithm in args.algorithms:
+        start = time.perf_counter()
+        if algorithm == 'svd':
+            model = FactorModel.from_surprise(simple_train(train))
+        else:
+            model = ALS(random_state=5).fit(train).to_factor_model()
+        fit_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        metrics = evaluate(anime_df, model, train, test, args.output, k=args.k, candidates=args.candidates,
+                           relevant_rating=args.relevant_rating, n_jobs=args.jobs)
+        print(f"{algorithm}: fit {fit_time:.1f}s, evaluation {time.perf_counter() - start:.1f}s")
+        results.append(metrics.assign(algorithm=algorithm).set_index('algorithm', append=True).swaplevel())
+
+    print(pd.concat(results).to_string())
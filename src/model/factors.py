@@ -0,0 +1,92 @@
+import numpy as np
+from dataclasses import dataclass, field
+from typing import Tuple
+
+
+@dataclass
+class FactorModel:
+    """Plain NumPy view of a fitted matrix factorization recommender, where the estimated rating of user u on item i is
+    global_mean + bu[u] + bi[i] + qi[i] @ pu[u]. Rows of the factor arrays are indexed by inner ids, which are mapped to the raw
+    user_id and anime_id of the ratings dataset through user_ids and item_ids.
+
+    Args:
+        global_mean (float): Mean of all the training ratings
+        bu (np.ndarray): User biases, of shape (n_users,)
+        bi (np.ndarray): Item biases, of shape (n_items,)
+        pu (np.ndarray): User factors, of shape (n_users, n_factors)
+        qi (np.ndarray): Item factors, of shape (n_items, n_factors)
+        user_ids (np.ndarray): Raw user id of every inner user id
+        item_ids (np.ndarray): Raw anime id of every inner item id
+        rating_scale (Tuple[int, int], optional): Minimum and maximum ratings. Defaults to (1, 10).
+    """
+    global_mean: float
+    bu: np.ndarray
+    bi: np.ndarray
+    pu: np.ndarray
+    qi: np.ndarray
+    user_ids: np.ndarray
+    item_ids: np.ndarray
+    rating_scale: Tuple[int, int] = (1, 10)
+    user_to_inner: dict = field(init=False, repr=False)
+    item_to_inner: dict = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self.user_to_inner = {user_id: inner_id for inner_id, user_id in enumerate(np.asarray(self.user_ids).tolist())}
+        self.item_to_inner = {item_id: inner_id for inner_id, item_id in enumerate(np.asarray(self.item_ids).tolist())}
+
+    @property
+    def n_factors(self) -> int:
+        return self.qi.shape[1]
+
+    def extend(self, user_ids: np.ndarray = None, item_ids: np.ndarray = None, init_std_dev: float = 0.1, random_state: int = None):
+        """Add users and items the model was not trained on, with zero biases and small random factors, keeping the inner ids of the existing ones.
+
+        Args:
+            user_ids (np.ndarray, optional): Raw ids of the new users. Defaults to None.
+            item_ids (np.ndarray, optional): Raw ids of the new items. Defaults to None.
+            init_std_dev (float, optional): Standard deviation of the normal distribution used to initialize the new factors. Defaults to 0.1.
+            random_state (int, optional): Seed of the factors initialization. Defaults to None.
+        """
+        rng = np.random.default_rng(random_state)
+
+        if user_ids is not None and len(user_ids) > 0:
+            self.user_to_inner.update({user_id: len(self.user_ids) + i for i, user_id in enumerate(np.asarray(user_ids).tolist())})
+            self.user_ids = np.concatenate([self.user_ids, np.asarray(user_ids, dtype=np.asarray(self.user_ids).dtype)])
+            self.bu = np.concatenate([self.bu, np.zeros(len(user_ids))])
+            self.pu = np.vstack([self.pu, rng.normal(0, init_std_dev, (len(user_ids), self.n_factors))])
+
+        if item_ids is not None and len(item_ids) > 0:
+            self.item_to_inner.update({item_id: len(self.item_ids) + i for i, item_id in enumerate(np.asarray(item_ids).tolist())})
+            self.item_ids = np.concatenate([self.item_ids, np.asarray(item_ids, dtype=np.asarray(self.item_ids).dtype)])
+            self.bi = np.concatenate([self.bi, np.zeros(len(item_ids))])
+            self.qi = np.vstack([self.qi, rng.normal(0, init_std_dev, (len(item_ids), self.n_factors))])
+
+    @classmethod
+    def from_surprise(cls, algo) -> 'FactorModel':
+        """Extract the factors of a fitted Surprise SVD model.
+
+        Args:
+            algo (SVD): Surprise SVD model fitted on a trainset
+
+        Returns:
+            FactorModel: Factors of the model
+        """
+        trainset = algo.trainset
+        user_ids = np.array([trainset.to_raw_uid(inner_id) for inner_id in trainset.all_users()])
+        item_ids = np.array([trainset.to_raw_iid(inner_id) for inner_id in trainset.all_items()])
+
+        if algo.biased:
+            global_mean, bu, bi = trainset.global_mean, algo.bu, algo.bi
+        else:
+            global_mean, bu, bi = 0.0, np.zeros(trainset.n_users), np.zeros(trainset.n_items)
+
+        return cls(
+            global_mean=float(global_mean),
+            bu=np.asarray(bu, dtype=np.float64),
+            bi=np.asarray(bi, dtype=np.float64),
+            pu=np.asarray(algo.pu, dtype=np.float64),
+            qi=np.asarray(algo.qi, dtype=np.float64),
+            user_ids=user_ids,
+            item_ids=item_ids,
+            rating_scale=tuple(trainset.rating_scale),
+        )
@@ -0,0 +1,267 @@
+import numpy as np
+import pandas as pd
+import sys
+from typing import Optional, Tuple
+
+from pathlib import Path
+abs_path = Path(__file__).parent
+
+from src.dataset.preprocessing import preprocess_ratings_matrix, filter_ratings_data, catalogue_fingerprint
+from src.dataset.cache import load_anime_data, load_ratings_data
+from src.dataset.ratings import RatingsMatrix
+from src.model.als import ALS
+from src.model.factors import FactorModel
+from src.model.registry import MODELS_PATH, save_model, find_latest_version, load_model, read_manifest
+
+# directory of the ratings history within a version of the registry saved by IncrementalUpdater.checkpoint
+HISTORY_DIR = 'ratings'
+
+
+class IncrementalUpdater:
+    """Absorbs batches of new ratings into a trained model without retraining it from scratch.
+    Every batch runs a few warm-started alternating least squares epochs restricted to the users and items that received ratings,
+    solving each of them against all of their ratings while the factors of every other user and item stay fixed.
+    Users and items the model has never seen are added to it first.
+
+    The ratings history is kept as a RatingsMatrix plus a log of the batches received since it was built,
+    which is merged into it whenever the model is checkpointed into the registry, where the merged history is saved along with the model
+    so that the next updater starts from it. A full retrain remains the way
+    to refresh the global mean and the factors of the users and items that did not receive any rating.
+
+    Args:
+        model (FactorModel): Factors of the trained recommender, updated in place
+        ratings (RatingsMatrix): Ratings the model was trained on
+        fingerprint (str): Fingerprint of the catalogue the model was trained on
+        n_epochs (int, optional): Number of alternating user and item steps per batch. Defaults to 3.
+        reg (float, optional): Regularization term of biases and factors, applied once per rating as in fold_in_user. Defaults to 0.02.
+        checkpoint_every (int, optional): Number of batches between checkpoints, 0 to only checkpoint explicitly. Defaults to 10.
+        path (Path, optional): Root directory of the model registry. Defaults to MODELS_PATH.
+        init_std_dev (float, optional): Standard deviation of the initial factors of new users and items. Defaults to 0.1.
+        random_state (int, optional): Seed of the factors initialization. Defaults to None.
+    """
+    def __init__(self, model: FactorModel, ratings: RatingsMatrix, fingerprint: str, n_epochs: int = 3, reg: float = 0.02,
+                 checkpoint_every: int = 10, path: Path = MODELS_PATH, init_std_dev: float = 0.1, random_state: int = None):
+        """Initializes the updater with an empty log of new ratings
+        """
+        # factors loaded through memory mapping are read-only
+        for name in ['bu', 'bi', 'pu', 'qi']:
+            setattr(model, name, np.array(getattr(model, name), dtype=np.float64))
+
+        self.model = model
+        self.ratings = ratings
+        self.fingerprint = fingerprint
+        self.n_epochs = n_epochs
+        self.checkpoint_every = checkpoint_every
+        self.path = path
+        self.init_std_dev = init_std_dev
+        self.rng = np.random.default_rng(random_state)
+        self.solver = ALS(n_factors=model.n_factors, biased=True, reg_all=reg)
+
+        self.log_users = np.empty(0, dtype=np.int64)
+        self.log_items = np.empty(0, dtype=np.int64)
+        self.log_ratings = np.empty(0, dtype=np.uint8)
+        self.n_updates = 0
+        self._index_ids()
+
+    def update(self, delta: pd.DataFrame) -> FactorModel:
+        """Absorb a batch of new ratings. A new rating of an already rated anime replaces the previous one.
+
+        Args:
+            delta (pd.DataFrame): Filtered ratings dataframe with user_id, anime_id and rating columns
+
+        Returns:
+            FactorModel: Updated model
+        """
+        user_ids = delta.user_id.to_numpy(dtype=np.int64)
+        anime_ids = delta.anime_id.to_numpy(dtype=np.int64)
+        if len(user_ids) == 0:
+            return self.model
+
+        self.log_users = np.concatenate([self.log_users, user_ids])
+        self.log_items = np.concatenate([self.log_items, anime_ids])
+        self.log_ratings = np.concatenate([self.log_ratings, delta.rating.to_numpy().astype(np.uint8)])
+
+        affected_users = np.unique(user_ids)
+        affected_items = np.unique(anime_ids)
+        new_users = affected_users[self._to_inner(affected_users, users=True) < 0]
+        new_items = affected_items[self._to_inner(affected_items, users=False) < 0]
+        if len(new_users) > 0 or len(new_items) > 0:
+            self.model.extend(new_users, new_items, self.init_std_dev, self.rng.integers(2 ** 32))
+            self._index_ids()
+
+        # the rows of every step and all of their ratings only change when a new batch arrives
+        user_problem = self._build_problem(affected_users, users=True)
+        item_problem = self._build_problem(affected_items, users=False)
+
+        model = self.model
+        for _ in range(self.n_epochs):
+            rows, indptr, others, ratings = user_problem
+            targets = ratings - model.global_mean - model.bi[others]
+            model.bu[rows], model.pu[rows] = self.solver.solve_factors(indptr, others, targets, model.qi)
+
+            rows, indptr, others, ratings = item_problem
+            targets = ratings - model.global_mean - model.bu[others]
+            model.bi[rows], model.qi[rows] = self.solver.solve_factors(indptr, others, targets, model.pu)
+
+        self.n_updates += 1
+        if self.checkpoint_every > 0 and self.n_updates % self.checkpoint_every == 0:
+            self.checkpoint()
+
+        return model
+
+    def checkpoint(self) -> Path:
+        """Merge the log of new ratings into the ratings history and save the current model as a new version of the registry, along with the merged history.
+
+        Returns:
+            Path: Directory of the saved version
+        """
+        users = self.ratings.users()
+        user_ids = np.concatenate([self.ratings.user_ids[users].astype(np.int64), self.log_users])
+        anime_ids = np.concatenate([self.ratings.item_ids[self.ratings.items].astype(np.int64), self.log_items])
+        ratings = np.concatenate([self.ratings.ratings, self.log_ratings])
+        keep = _last_occurrences(user_ids, anime_ids)
+        self.ratings = RatingsMatrix.from_arrays(user_ids[keep], anime_ids[keep], ratings[keep], self.ratings.rating_scale)
+
+        version_path = save_model(self.model, self.fingerprint, self.path, metadata={'algorithm': 'incremental', 'updates': self.n_updates},
+                                  write_extra=lambda version_path: self.ratings.save(version_path / HISTORY_DIR))
+
+        self.log_users = self.log_users[:0]
+        self.log_items = self.log_items[:0]
+        self.log_ratings = self.log_ratings[:0]
+
+        return version_path
+
+    def _build_problem(self, raw_ids: np.ndarray, users: bool) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Gather all the current ratings of the given users (or items) into a compact CSR layout indexed by model inner ids.
+
+        Args:
+            raw_ids (np.ndarray): Sorted raw ids of the users or items to be solved
+            users (bool): Whether the ids are users, or items otherwise
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]: Inner ids of the rows, offsets of their ratings,
+            inner ids on the other side of every rating and rating values
+        """
+        history = self.ratings
+        if users:
+            inner = history.to_inner_uids(raw_ids)
+            indptr, others, scores, other_ids = history.user_indptr, history.items, history.ratings, history.item_ids
+            log_rows, log_others = self.log_users, self.log_items
+        else:
+            inner = history.to_inner_iids(raw_ids)
+            indptr, others, scores, other_ids = history.item_indptr, history.item_users, history.item_scores, history.user_ids
+            log_rows, log_others = self.log_items, self.log_users
+
+        # ratings of the history, gathered from the slices of the rows without any Python loop
+        found = inner >= 0
+        starts = indptr[inner[found]]
+        counts = indptr[inner[found] + 1] - starts
+        positions = np.repeat(starts - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+
+        in_log = np.isin(log_rows, raw_ids)
+        row_ids = np.concatenate([np.repeat(raw_ids[found], counts), log_rows[in_log]])
+        col_ids = np.concatenate([other_ids[others[positions]].astype(np.int64), log_others[in_log]])
+        ratings = np.concatenate([scores[positions], self.log_ratings[in_log]]).astype(np.float64)
+
+        keep = _last_occurrences(row_ids, col_ids)
+        rows = self._to_inner(row_ids[keep], users)
+        cols = self._to_inner(col_ids[keep], not users)
+        ratings = ratings[keep]
+
+        # ratings of users or items unknown to the model cannot be used, their factors do not exist
+        known = cols >= 0
+        rows, cols, ratings = rows[known], cols[known], ratings[known]
+
+        order = np.argsort(rows, kind='stable')
+        row_inner, counts = np.unique(rows[order], return_counts=True)
+        problem_indptr = np.zeros(len(row_inner) + 1, dtype=np.int64)
+        np.cumsum(counts, out=problem_indptr[1:])
+
+        return row_inner, problem_indptr, cols[order], ratings[order]
+
+    def _index_ids(self):
+        self.user_order = np.argsort(self.model.user_ids, kind='stable')
+        self.sorted_user_ids = np.asarray(self.model.user_ids)[self.user_order].astype(np.int64)
+        self.item_order = np.argsort(self.model.item_ids, kind='stable')
+        self.sorted_item_ids = np.asarray(self.model.item_ids)[self.item_order].astype(np.int64)
+
+    def _to_inner(self, raw_ids: np.ndarray, users: bool) -> np.ndarray:
+        """Map raw ids to model inner ids, -1 for the ones unknown to the model.
+
+        Args:
+            raw_ids (np.ndarray): Raw user or anime ids
+            users (bool): Whether the ids are users, or items otherwise
+
+        Returns:
+            np.ndarray: Model inner ids
+        """
+        sorted_ids, order = (self.sorted_user_ids, self.user_order) if users else (self.sorted_item_ids, self.item_order)
+        if len(sorted_ids) == 0:
+            return np.full(len(raw_ids), -1, dtype=np.int64)
+
+        positions = np.minimum(np.searchsorted(sorted_ids, raw_ids), len(sorted_ids) - 1)
+
+        return np.where(sorted_ids[positions] == raw_ids, order[positions], -1)
+
+
+def _last_occurrences(user_ids: np.ndarray, anime_ids: np.ndarray) -> np.ndarray:
+    """Find the positions of the last rating of every (user, anime) pair.
+
+    Args:
+        user_ids (np.ndarray): Raw user id of every rating
+        anime_ids (np.ndarray): Raw anime id of every rating
+
+    Returns:
+        np.ndarray: Sorted positions of the ratings to be kept
+    """
+    keys = user_ids.astype(np.int64) * (int(anime_ids.max(initial=0)) + 1) + anime_ids
+    _, reversed_positions = np.unique(keys[::-1], return_index=True)
+
+    return np.sort(len(keys) - 1 - reversed_positions)
+
+
+def load_updater(anime_df: pd.DataFrame, ratings_df: Optional[pd.DataFrame] = None, path: Path = MODELS_PATH, **kwargs) -> Optional[IncrementalUpdater]:
+    """Load the latest model trained on the given catalogue along with its ratings history, ready to absorb new ratings.
+    The history is the one saved with the model by the last checkpoint, which includes every rating absorbed so far,
+    or the ratings the model was trained on for a version that was not saved by an updater.
+
+    Args:
+        anime_df (pd.DataFrame): Processed anime dataframe
+        ratings_df (Optional[pd.DataFrame], optional): Raw ratings dataframe the model was trained on, only used when the version has no saved history.
+            Defaults to None, in which case the cached ratings dataset is loaded if needed.
+        path (Path, optional): Root directory of the model registry. Defaults to MODELS_PATH.
+        kwargs: Update settings, as accepted by IncrementalUpdater
+
+    Returns:
+        Optional[IncrementalUpdater]: Updater of the latest model, or None if there is no model for this catalogue
+    """
+    fingerprint = catalogue_fingerprint(anime_df)
+    version_path = find_latest_version(fingerprint, path)
+    if version_path is None:
+        return None
+
+    if (version_path / HISTORY_DIR).exists():
+        ratings = RatingsMatrix.load(version_path / HISTORY_DIR)
+    else:
+        if ratings_df is None:
+            ratings_df = load_ratings_data(anime_df)
+        ratings = preprocess_ratings_matrix(ratings_df, anime_df)
+
+    updater = IncrementalUpdater(load_model(version_path), ratings, fingerprint, path=path, **kwargs)
+    updater.n_updates = read_manifest(version_path)['metadata'].get('updates', 0)
+
+    return updater
+
+
+if __name__ == "__main__":
+    # usage: python3 -m src.model.incremental <new ratings csv>
+    anime_df = load_anime_data()
+
+    updater = load_updater(anime_df, checkpoint_every=0)
+    if updater is None:
+        sys.exit("There is no trained model for the current anime data, train one with python3 -m src.model.train")
+
+    delta = filter_ratings_data(pd.read_csv(sys.argv[1]), anime_df)
+    updater.update(delta)
+    version_path = updater.checkpoint()
+    print(f"{len(delta)} new ratings absorbed into {version_path.resolve()}")
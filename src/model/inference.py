@@ -1,9 +1,17 @@
+import weakref
 import numpy as np
 import pandas as pd
-from sklearn.metrics.pairwise import cosine_similarity
-from sklearn.preprocessing import MinMaxScaler, StandardScaler, QuantileTransformer
+from typing import Iterable, Optional, Tuple, Union
 
-def _get_recommendations(anime_df: pd.DataFrame, ratings_dataset, model, user_id: int) -> list:
+from src.model.factors import FactorModel
+from src.model.similarity import NeighbourTable, SimilarityIndex, get_similarity_index
+from src.instrumentation import instrumented
+
+# factors of the Surprise recommenders passed to _get_recommendations, converted once per recommender
+_factor_models = weakref.WeakKeyDictionary()
+
+@instrumented
+def _get_recommendations(anime_df: pd.DataFrame, ratings_dataset, model, user_id: int, index: Union[NeighbourTable, SimilarityIndex] = None) -> list:
     """Generate anime recommendations for our app user, taking into account the ratings added into our platform, the anime dataset to search for similar
     animes to the ones the user has liked and the trained recommender to estimate the ratings of our user on the similar animes.
     Steps:
@@ -15,70 +23,275 @@ def _get_recommendations(anime_df: pd.DataFrame, ratings_dataset, model, user_id
     Args:
         anime_df (pd.DataFrame): Anime dataset with info of all the animes
         ratings_dataset (_type_): Ratings dataset with info of user ratings of the animes
-        model (_type_): SVD recommender trained on ratings dataset
-        user_id (int): User for which we want to generate the recommendations
+        model (_type_): SVD recommender trained on ratings dataset, or its FactorModel
+        user_id (int): User for which we want to generate the recommendations, who is folded into the model if it was not trained on the user ratings
+        index (Union[NeighbourTable, SimilarityIndex], optional): Similarity index of anime_df. Defaults to None, in which case the precomputed neighbour table is used if available or an index is built on the fly.
 
     Returns:
-        list: List of anime recommendations in the form of (anime_id, est_r_ui) tuples
+        list: List of anime recommendations in the form of (anime_id, est_r_ui) tuples, empty if the user has no ratings
     """
     
-    # new user ratings
-    new_user_id = ratings_dataset.df.user_id.max()
+    # user ratings
+    new_user_id = user_id
     new_user_ratings = ratings_dataset.df[ratings_dataset.df.user_id == new_user_id]
+    if len(new_user_ratings) == 0:
+        print(f"User {new_user_id} has not rated any anime")
+        return []
+    ratings = dict(zip(new_user_ratings.anime_id.values.tolist(), new_user_ratings.rating.values.tolist()))
+    
+    if index is None:
+        index = get_similarity_index(anime_df)
     
     # we first get similar animes to the ones liked by the user
-    similar_animes = []
-    for user_id, anime_id, rating in new_user_ratings.values:
-        if rating >= 5:
-            partial_result = get_top_k_most_similar_animes(anime_df, anime_id)
-            similar_animes.extend(partial_result)  
-        
-    similar_animes = list(set(similar_animes))
-    already_watched = list(new_user_ratings.anime_id.values)
-    similar_animes = [x for x in similar_animes if x not in already_watched]
-        
-    # we now estimate our user ratings on these animes
-    results = []
-    for anime_id in similar_animes:
-        estimated_rating = model.predict(new_user_id, anime_id)
-        results.append((anime_id, estimated_rating.est))
+    similar_animes = _get_candidate_animes(ratings, index)
         
-    sorted_results = sorted(results, key=lambda x: x[1], reverse=True)
+    # we now estimate our user ratings on these animes and sort them
+    if not isinstance(model, FactorModel):
+        if model not in _factor_models:
+            _factor_models[model] = FactorModel.from_surprise(model)
+        model = _factor_models[model]
+    user = new_user_id if new_user_id in model.user_to_inner else ratings
+    sorted_results = recommend(model, user, n=None, candidates=similar_animes, seen=new_user_ratings.anime_id.values)
     
     return sorted_results
     
     
-def get_top_k_most_similar_animes(anime_df: pd.DataFrame, anime_id: int, k: int = 100) -> list:
+@instrumented
+def get_new_user_recommendations(anime_df: pd.DataFrame, model: FactorModel, new_ratings: dict, index: Union[NeighbourTable, SimilarityIndex] = None, reg: float = 0.02) -> list:
+    """Generate anime recommendations for a user the model was not trained on, without retraining it.
+    Same steps as _get_recommendations, but the ratings are estimated by folding the user into the pre-trained model.
+
+    Args:
+        anime_df (pd.DataFrame): Anime dataset with info of all the animes
+        model (FactorModel): Factors of a recommender trained on the ratings dataset
+        new_ratings (dict): Ratings of the new user in the form of {anime_id: rating}
+        index (Union[NeighbourTable, SimilarityIndex], optional): Similarity index of anime_df. Defaults to None, in which case the precomputed neighbour table is used if available or an index is built on the fly.
+        reg (float, optional): Regularization term of the user bias and factors. Defaults to 0.02.
+
+    Returns:
+        list: List of anime recommendations in the form of (anime_id, est_r_ui) tuples
+    """
+    
+    if index is None:
+        index = get_similarity_index(anime_df)
+    
+    similar_animes = _get_candidate_animes(new_ratings, index)
+    
+    sorted_results = recommend(model, new_ratings, n=None, candidates=similar_animes, reg=reg)
+    
+    return sorted_results
+
+
+@instrumented
+def recommend(model: FactorModel, user: Union[int, dict], n: Optional[int] = 10, exclude_seen: bool = True, candidates: Iterable[int] = None,
+              seen: Iterable[int] = None, reg: float = 0.02) -> list:
+    """Get the top n animes for a user by estimating the user ratings on all the candidate animes with a single matrix-vector product.
+
+    Args:
+        model (FactorModel): Factors of the trained recommender
+        user (Union[int, dict]): Raw id of a user known to the model, or ratings of a new user in the form of {anime_id: rating}, who is folded into the model
+        n (Optional[int], optional): Number of recommendations, None to sort all the candidates. A ValueError is raised if it is negative. Defaults to 10.
+        exclude_seen (bool, optional): Whether to exclude the animes already seen by the user. Defaults to True.
+        candidates (Iterable[int], optional): Animes the recommendations are chosen from, animes unknown to the model are ignored. Defaults to None, in which case the whole catalogue is used.
+        seen (Iterable[int], optional): Animes already seen by the user. Defaults to None, in which case they are the rated animes of a new user.
+            The model does not keep the ratings of the users it was trained on, so a ValueError is raised if they have to be excluded for a known user and are not given.
+        reg (float, optional): Regularization term of the user bias and factors when folding in a new user. Defaults to 0.02.
+
+    Returns:
+        list: List of anime recommendations in the form of (anime_id, est_r_ui) tuples, sorted from highest to lowest estimated rating
+    """
+    bu, pu, seen = _get_user_factors(model, user, seen, exclude_seen, reg)
+    
+    estimated_ratings = model.global_mean + bu + model.bi + model.qi @ pu
+    
+    return _select_top_n(model, estimated_ratings, n, exclude_seen, candidates, seen)
+
+
+@instrumented
+def recommend_many(model: FactorModel, users: list, n: Optional[int] = 10, exclude_seen: bool = True, candidates: list = None,
+                   seen: list = None, reg: float = 0.02) -> list:
+    """Get the top n animes for several users at once, estimating the ratings of all of them on the whole catalogue with a single matrix product.
+
+    Args:
+        model (FactorModel): Factors of the trained recommender
+        users (list): Users as accepted by recommend, either raw ids of users known to the model or ratings of new users
+        n (Optional[int], optional): Number of recommendations per user, None to sort all the candidates. Defaults to 10.
+        exclude_seen (bool, optional): Whether to exclude the animes already seen by every user. Defaults to True.
+        candidates (list, optional): Candidate animes of every user, as accepted by recommend. Defaults to None, in which case the whole catalogue is used for all of them.
+        seen (list, optional): Animes already seen by every user, as accepted by recommend, which are required for known users if exclude_seen is set. Defaults to None.
+        reg (float, optional): Regularization term of the user bias and factors when folding in new users. Defaults to 0.02.
+
+    Returns:
+        list: Recommendations of every user, as returned by recommend
+    """
+    if len(users) == 0:
+        return []
+    
+    biases, factors, users_seen = [], [], []
+    for i, user in enumerate(users):
+        bu, pu, user_seen = _get_user_factors(model, user, seen[i] if seen is not None else None, exclude_seen, reg)
+        biases.append(bu)
+        factors.append(pu)
+        users_seen.append(user_seen)
+    
+    estimated_ratings = model.global_mean + np.array(biases)[:, None] + model.bi + np.array(factors) @ model.qi.T
+    
+    return [
+        _select_top_n(model, estimated_ratings[i], n, exclude_seen, candidates[i] if candidates is not None else None, users_seen[i])
+        for i in range(len(users))
+    ]
+
+
+def _get_user_factors(model: FactorModel, user: Union[int, dict], seen: Optional[Iterable[int]], exclude_seen: bool, reg: float) -> Tuple[float, np.ndarray, Optional[Iterable[int]]]:
+    """Get the bias and factors of a user known to the model, or fold in a new one, along with the animes already seen by the user.
+
+    Args:
+        model (FactorModel): Factors of the trained recommender
+        user (Union[int, dict]): Raw id of a user known to the model, or ratings of a new user in the form of {anime_id: rating}
+        seen (Optional[Iterable[int]]): Animes already seen by the user, None to use the rated animes of a new user
+        exclude_seen (bool): Whether the seen animes are going to be excluded, in which case they must be given for a known user
+        reg (float): Regularization term of the user bias and factors when folding in a new user
+
+    Returns:
+        Tuple[float, np.ndarray, Optional[Iterable[int]]]: User bias, user factors and seen animes
+    """
+    if isinstance(user, dict):
+        bu, pu = fold_in_user(model, user, reg)
+        if seen is None:
+            seen = user.keys()
+    else:
+        if exclude_seen and seen is None:
+            raise ValueError(f'The animes seen by user {user} are required to exclude them from the recommendations')
+        inner_uid = model.user_to_inner[user]
+        bu, pu = model.bu[inner_uid], model.pu[inner_uid]
+    
+    return bu, pu, seen
+
+
+def _select_top_n(model: FactorModel, estimated_ratings: np.ndarray, n: Optional[int], exclude_seen: bool, candidates: Optional[Iterable[int]],
+                  seen: Optional[Iterable[int]]) -> list:
+    """Pick the top n candidates of a user from the estimated ratings on the whole catalogue.
+
+    Args:
+        model (FactorModel): Factors of the trained recommender
+        estimated_ratings (np.ndarray): Estimated ratings of the user indexed by inner item id
+        n (Optional[int]): Number of recommendations, None to sort all the candidates, a ValueError is raised if it is negative
+        exclude_seen (bool): Whether to exclude the seen animes
+        candidates (Optional[Iterable[int]]): Animes the recommendations are chosen from, None for the whole catalogue
+        seen (Optional[Iterable[int]]): Animes already seen by the user
+
+    Returns:
+        list: List of anime recommendations in the form of (anime_id, est_r_ui) tuples, sorted from highest to lowest estimated rating
+    """
+    if n is not None and n < 0:
+        raise ValueError(f'The number of recommendations must not be negative, got {n}')
+    
+    if candidates is None:
+        mask = np.ones(len(model.item_ids), dtype=bool)
+    else:
+        mask = np.zeros(len(model.item_ids), dtype=bool)
+        mask[_to_inner_iids(model, candidates)] = True
+    if exclude_seen and seen is not None:
+        mask[_to_inner_iids(model, seen)] = False
+    
+    inner_iids = np.flatnonzero(mask)
+    scores = estimated_ratings[inner_iids]
+    if n is not None and n < len(inner_iids):
+        top_n = np.argpartition(-scores, n - 1)[:n]
+        inner_iids, scores = inner_iids[top_n], scores[top_n]
+    
+    order = np.argsort(-scores, kind='stable')
+    scores = np.clip(scores[order], *model.rating_scale)
+    
+    return list(zip(model.item_ids[inner_iids[order]].tolist(), scores.tolist()))
+
+
+def _to_inner_iids(model: FactorModel, anime_ids: Iterable[int]) -> np.ndarray:
+    inner_iids = [model.item_to_inner.get(anime_id) for anime_id in np.asarray(list(anime_ids)).tolist()]
+    
+    return np.array([inner_iid for inner_iid in inner_iids if inner_iid is not None], dtype=np.int64)
+
+
+@instrumented
+def _get_candidate_animes(ratings: dict, index: Union[NeighbourTable, SimilarityIndex]) -> list:
+    """Get the animes similar to the ones liked by a user (those with a rating equal or higher than 5) that the user has not watched yet.
+
+    Args:
+        ratings (dict): Ratings of the user in the form of {anime_id: rating}
+        index (Union[NeighbourTable, SimilarityIndex]): Similarity index of the anime dataset
+
+    Returns:
+        list: Candidate anime ids
+    """
+    liked_animes = [anime_id for anime_id, rating in ratings.items() if rating >= 5]
+    similar_animes = index.most_similar(liked_animes)
+    
+    return [x for x in similar_animes if x not in ratings]
+
+
+@instrumented
+def fold_in_user(model: FactorModel, ratings: dict, reg: float = 0.02) -> Tuple[float, np.ndarray]:
+    """Estimate the bias and latent factors of a user the model was not trained on, keeping the item factors fixed.
+    It solves the same regularized least squares problem SGD minimizes for that user, with the regularization applied once per rating.
+
+    Args:
+        model (FactorModel): Factors of the pre-trained recommender
+        ratings (dict): Ratings of the user in the form of {anime_id: rating}, animes unknown to the model are ignored
+        reg (float, optional): Regularization term of the user bias and factors. Defaults to 0.02.
+
+    Returns:
+        Tuple[float, np.ndarray]: User bias and user factors
+    """
+    rated = [(model.item_to_inner[anime_id], rating) for anime_id, rating in ratings.items() if anime_id in model.item_to_inner]
+    if len(rated) == 0:
+        return 0.0, np.zeros(model.n_factors)
+    
+    inner_ids, user_ratings = map(np.array, zip(*rated))
+    
+    # the bias is solved along with the factors as an extra factor whose item value is always 1
+    X = np.hstack([np.ones((len(inner_ids), 1)), model.qi[inner_ids]])
+    y = user_ratings - model.global_mean - model.bi[inner_ids]
+    A = X.T @ X + reg * len(inner_ids) * np.eye(X.shape[1])
+    solution = np.linalg.solve(A, X.T @ y)
+    
+    return float(solution[0]), solution[1:]
+
+
+@instrumented
+def predict_new_user(model: FactorModel, ratings: dict, reg: float = 0.02) -> np.ndarray:
+    """Estimate the ratings of a user the model was not trained on for every item known to the model.
+
+    Args:
+        model (FactorModel): Factors of the pre-trained recommender
+        ratings (dict): Ratings of the user in the form of {anime_id: rating}
+        reg (float, optional): Regularization term of the user bias and factors. Defaults to 0.02.
+
+    Returns:
+        np.ndarray: Estimated ratings indexed by inner item id
+    """
+    bu, pu = fold_in_user(model, ratings, reg)
+    estimated_ratings = model.global_mean + bu + model.bi + model.qi @ pu
+    
+    return np.clip(estimated_ratings, *model.rating_scale)
+
+
+@instrumented
+def get_top_k_most_similar_animes(anime_df: pd.DataFrame, anime_id: int, k: int = 100, index: Union[NeighbourTable, SimilarityIndex] = None) -> list:
     """Find the top k most similar animes to a given anime based on several anime features and cosine similarity.
 
     Args:
         anime_df (pd.DataFrame): Anime dataset with several numerical and categorical features
         anime_id (int): Query anime from which we want to find the similarities
         k (int, optional): Number of similar animes to be found. Defaults to 100.
+        index (Union[NeighbourTable, SimilarityIndex], optional): Similarity index of anime_df. Defaults to None, in which case the precomputed neighbour table is used if available or an index is built on the fly.
 
     Returns:
         list: Top k most similar animes to the given anime
     """
     
-    df = anime_df.copy()
-    
-    df.loc[:, 'episodes'] = StandardScaler().fit_transform(np.array(df.episodes).reshape(-1, 1))
-    df.loc[:, 'rating'] = StandardScaler().fit_transform(np.array(df.rating).reshape(-1, 1))
-    df.loc[:, 'members'] = QuantileTransformer(output_distribution='normal').fit_transform(np.array(df.members).reshape(-1, 1))
-    df.loc[:, 'year'] = StandardScaler().fit_transform(np.array(df.year).reshape(-1, 1))
-    
-    df = df.drop(columns=['name', 'episodes'])
-    df.reset_index(inplace=True)
-    
-    anime_index = df[df.anime_id==anime_id].index[0]
-    
-    sims = cosine_similarity(df[df.anime_id==anime_id].values.reshape(1,-1), df)
-    result = sims[0]
-    result[anime_index] = -1
+    if index is None:
+        index = get_similarity_index(anime_df)
     
-    sorted_indices = np.argsort(-result)
-    top_k_indices = sorted_indices[:k]
-    top_k_values = result[top_k_indices]
+    top_k_ids, _ = index.top_k([anime_id], k)
     
-    return list(df.loc[top_k_indices].anime_id)
-    
\ No newline at end of file
+    return top_k_ids[0].tolist()
@@ -0,0 +1,142 @@
+import numpy as np
+import json
+import os
+import time
+from typing import Callable, Optional
+
+from pathlib import Path
+abs_path = Path(__file__).parent
+
+from src.model.factors import FactorModel
+
+MODELS_PATH = abs_path / '../../models'
+
+# bumped whenever the layout of the saved artifacts changes
+FORMAT_VERSION = 1
+
+FACTOR_ARRAYS = ['bu', 'bi', 'pu', 'qi', 'user_ids', 'item_ids']
+
+
+def save_model(model: FactorModel, fingerprint: str, path: Path = MODELS_PATH, metadata: dict = None, write_extra: Callable[[Path], None] = None) -> Path:
+    """Save the factors of a fitted model as a new version of the model registry.
+    Every array is saved as a plain .npy file next to a manifest with the scalar parameters of the model.
+
+    Args:
+        model (FactorModel): Factors of the fitted model
+        fingerprint (str): Fingerprint of the preprocessed catalogue the model was trained on
+        path (Path, optional): Root directory of the registry. Defaults to MODELS_PATH.
+        metadata (dict, optional): Additional JSON-serializable info to be stored with the model, such as its hyper-parameters. Defaults to None.
+        write_extra (Callable[[Path], None], optional): Function that writes additional artifacts into the version directory,
+            which is called before the version becomes visible. Defaults to None.
+
+    Returns:
+        Path: Directory of the saved version
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+
+    tmp_path = path / f'.tmp{os.getpid()}'
+    tmp_path.mkdir(exist_ok=True)
+    for name in FACTOR_ARRAYS:
+        np.save(tmp_path / f'{name}.npy', np.ascontiguousarray(getattr(model, name)), allow_pickle=False)
+
+    manifest = {
+        'format_version': FORMAT_VERSION,
+        'fingerprint': fingerprint,
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'global_mean': model.global_mean,
+        'rating_scale': list(model.rating_scale),
+        'n_factors': model.n_factors,
+        'metadata': metadata or {},
+    }
+    with open(tmp_path / 'manifest.json', 'w') as f:
+        json.dump(manifest, f, indent=4)
+    if write_extra is not None:
+        write_extra(tmp_path)
+
+    # the version is only visible once it is complete
+    while True:
+        version_path = path / f'v{_latest_version(path) + 1:04d}'
+        try:
+            os.rename(tmp_path, version_path)
+            break
+        except OSError:
+            if not version_path.exists():
+                raise
+
+    return version_path
+
+
+def load_model(version_path: Path, mmap_mode: Optional[str] = None) -> FactorModel:
+    """Load a model saved in the registry.
+
+    Args:
+        version_path (Path): Directory of the saved version
+        mmap_mode (Optional[str], optional): Memory mapping mode of the factor arrays, as in np.load. Defaults to None.
+
+    Returns:
+        FactorModel: Factors of the saved model
+    """
+    version_path = Path(version_path)
+    manifest = read_manifest(version_path)
+
+    arrays = {name: np.load(version_path / f'{name}.npy', mmap_mode=mmap_mode) for name in FACTOR_ARRAYS}
+
+    return FactorModel(global_mean=manifest['global_mean'], rating_scale=tuple(manifest['rating_scale']), **arrays)
+
+
+def load_latest_model(fingerprint: str, path: Path = MODELS_PATH) -> Optional[FactorModel]:
+    """Load the most recent model of the registry that was trained on the given catalogue.
+
+    Args:
+        fingerprint (str): Fingerprint of the preprocessed catalogue
+        path (Path, optional): Root directory of the registry. Defaults to MODELS_PATH.
+
+    Returns:
+        Optional[FactorModel]: Factors of the model, or None if there is no compatible model
+    """
+    version_path = find_latest_version(fingerprint, path)
+    if version_path is None:
+        return None
+
+    return load_model(version_path)
+
+
+def find_latest_version(fingerprint: str, path: Path = MODELS_PATH) -> Optional[Path]:
+    """Find the most recent version of the registry that was trained on the given catalogue and can be loaded by this code.
+
+    Args:
+        fingerprint (str): Fingerprint of the preprocessed catalogue
+        path (Path, optional): Root directory of the registry. Defaults to MODELS_PATH.
+
+    Returns:
+        Optional[Path]: Directory of the version, or None if there is no compatible version
+    """
+    for version_path in sorted(Path(path).glob('v[0-9]*'), reverse=True):
+        try:
+            manifest = read_manifest(version_path)
+        except (OSError, ValueError):
+            continue
+        if manifest['format_version'] == FORMAT_VERSION and manifest['fingerprint'] == fingerprint:
+            return version_path
+
+    return None
+
+
+def read_manifest(version_path: Path) -> dict:
+    """Read the manifest of a saved version.
+
+    Args:
+        version_path (Path): Directory of the saved version
+
+    Returns:
+        dict: Manifest of the version
+    """
+    with open(Path(version_path) / 'manifest.json') as f:
+        return json.load(f)
+
+
+def _latest_version(path: Path) -> int:
+    versions = [int(version_path.name[1:]) for version_path in path.glob('v[0-9]*') if version_path.name[1:].isdigit()]
+
+    return max(versions, default=0)
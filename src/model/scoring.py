@@ -0,0 +1,231 @@
+import numpy as np
+import pandas as pd
+import json
+from typing import Union
+
+from pathlib import Path
+
+from src.dataset.ratings import RatingsMatrix
+from src.model.als import ALS
+from src.model.factors import FactorModel
+from src.model.similarity import NeighbourTable, SimilarityIndex, get_similarity_index
+
+# ratings from which an anime counts as liked, as in _get_candidate_animes
+LIKED_RATING = 5
+
+# arrays memory mapped by BlockScorer from the inputs directory
+INPUT_ARRAYS = ['user_indptr', 'items', 'ratings', 'user_ids', 'user_to_model', 'item_to_model', 'item_neighbours', 'bu', 'bi', 'pu', 'qi', 'model_item_ids']
+
+
+class BlockScorer:
+    """Scores blocks of users of a ratings matrix against all the items known to a recommender with a single matrix product per block,
+    folding the users the model was not trained on into it as fold_in_user does. The inputs written by write_scoring_inputs are
+    memory mapped, so that the worker processes of a job share them instead of holding a copy each.
+
+    Args:
+        path (Path): Directory of the inputs
+        reg (float, optional): Regularization term of the user bias and factors when folding in users. Defaults to 0.02.
+    """
+    def __init__(self, path: Path, reg: float = 0.02):
+        """Initializes the scorer by memory mapping its inputs
+        """
+        self.path = Path(path)
+        with open(self.path / 'scoring.json') as f:
+            settings = json.load(f)
+        self.global_mean = settings['global_mean']
+        self.rating_scale = tuple(settings['rating_scale'])
+        self.arrays = {name: np.load(self.path / f'{name}.npy', mmap_mode='r') for name in INPUT_ARRAYS}
+        self.solver = ALS(n_factors=self.arrays['qi'].shape[1], biased=True, reg_all=reg)
+
+    @property
+    def n_users(self) -> int:
+        return len(self.arrays['user_ids'])
+
+    @property
+    def n_items(self) -> int:
+        return len(self.arrays['model_item_ids'])
+
+    def score(self, start: int, end: int) -> tuple:
+        """Estimate the ratings of a block of users on all the items known to the model with a single matrix product.
+
+        Args:
+            start (int): First inner user id of the block
+            end (int): Last inner user id of the block, excluded
+
+        Returns:
+            tuple: Row of the block, inner item id, model inner item id (-1 for items unknown to the model) and score of every rating of the block,
+                user biases, and estimated ratings of shape (n_users, n_model_items)
+        """
+        indptr = np.asarray(self.arrays['user_indptr'][start:end + 1])
+        rows = np.repeat(np.arange(end - start), np.diff(indptr))
+        items = np.asarray(self.arrays['items'][indptr[0]:indptr[-1]])
+        ratings = np.asarray(self.arrays['ratings'][indptr[0]:indptr[-1]])
+        model_items = np.asarray(self.arrays['item_to_model'])[items]
+
+        bu, pu = self._user_factors(start, end, rows, model_items, ratings)
+        estimated_ratings = self.global_mean + bu[:, None] + np.asarray(self.arrays['bi'])[None, :] + pu @ np.asarray(self.arrays['qi']).T
+
+        return rows, items, model_items, ratings, bu, estimated_ratings
+
+    def similar_candidates(self, rows: np.ndarray, items: np.ndarray, model_items: np.ndarray, ratings: np.ndarray, shape: tuple) -> np.ndarray:
+        """Find the candidates of a block of users as _get_candidate_animes does: the neighbours of the animes every user liked that the user has not rated.
+
+        Args:
+            rows (np.ndarray): Row of the block of every rating
+            items (np.ndarray): Inner item id of every rating
+            model_items (np.ndarray): Model inner item id of every rating, -1 for items unknown to the model
+            ratings (np.ndarray): Score of every rating
+            shape (tuple): Number of users of the block and of items known to the model
+
+        Returns:
+            np.ndarray: Whether every model item is a candidate of every user, of the given shape
+        """
+        candidates = np.zeros(shape, dtype=bool)
+        liked = ratings >= LIKED_RATING
+        neighbours = np.asarray(self.arrays['item_neighbours'])[items[liked]]
+        neighbour_rows = np.repeat(rows[liked], neighbours.shape[1])
+        neighbours = neighbours.ravel()
+        candidates[neighbour_rows[neighbours >= 0], neighbours[neighbours >= 0]] = True
+        candidates[rows[model_items >= 0], model_items[model_items >= 0]] = False
+
+        return candidates
+
+    def unrated_candidates(self, rows: np.ndarray, model_items: np.ndarray, shape: tuple) -> np.ndarray:
+        """Find the candidates of a block of users among the whole catalogue: every item known to the model that the user has not rated.
+
+        Args:
+            rows (np.ndarray): Row of the block of every rating
+            model_items (np.ndarray): Model inner item id of every rating, -1 for items unknown to the model
+            shape (tuple): Number of users of the block and of items known to the model
+
+        Returns:
+            np.ndarray: Whether every model item is a candidate of every user, of the given shape
+        """
+        candidates = np.ones(shape, dtype=bool)
+        candidates[rows[model_items >= 0], model_items[model_items >= 0]] = False
+
+        return candidates
+
+    def _user_factors(self, start: int, end: int, rows: np.ndarray, model_items: np.ndarray, ratings: np.ndarray) -> tuple:
+        """Get the biases and factors of a block of users, folding the ones the model was not trained on into it.
+
+        Args:
+            start (int): First inner user id of the block
+            end (int): Last inner user id of the block, excluded
+            rows (np.ndarray): Row of the block of every rating
+            model_items (np.ndarray): Model inner item id of every rating, -1 for items unknown to the model
+            ratings (np.ndarray): Score of every rating
+
+        Returns:
+            tuple: User biases, of shape (n_users,), and user factors, of shape (n_users, n_factors)
+        """
+        model_users = np.asarray(self.arrays['user_to_model'][start:end])
+        known = model_users >= 0
+        bu = np.zeros(end - start)
+        pu = np.zeros((end - start, self.arrays['qi'].shape[1]))
+        bu[known] = np.asarray(self.arrays['bu'])[model_users[known]]
+        pu[known] = np.asarray(self.arrays['pu'])[model_users[known]]
+
+        if not known.all():
+            unknown = np.flatnonzero(~known)
+            # ratings of the unknown users on items known to the model, grouped by user as they already are
+            keep = ~known[rows] & (model_items >= 0)
+            fold_counts = np.bincount(rows[keep], minlength=end - start)[unknown]
+            fold_indptr = np.concatenate([[0], np.cumsum(fold_counts)])
+            bu[unknown], pu[unknown] = self.solver.solve_factors(fold_indptr, model_items[keep], ratings[keep], np.asarray(self.arrays['qi']),
+                                                                  self.global_mean, np.asarray(self.arrays['bi']))
+
+        return bu, pu
+
+
+def write_scoring_inputs(path: Path, anime_df: pd.DataFrame, model: FactorModel, ratings: RatingsMatrix,
+                         index: Union[NeighbourTable, SimilarityIndex] = None, k: int = 100):
+    """Write the inputs of BlockScorer, with every id already mapped to model inner ids.
+
+    Args:
+        path (Path): Directory of the inputs, which must not exist yet
+        anime_df (pd.DataFrame): Processed anime dataframe
+        model (FactorModel): Factors of the trained recommender
+        ratings (RatingsMatrix): Ratings of the users to be scored
+        index (Union[NeighbourTable, SimilarityIndex], optional): Similarity index of anime_df. Defaults to None, in which case the precomputed neighbour table is used if available or an index is built on the fly.
+        k (int, optional): Number of similar animes per liked anime of the similar candidates. Defaults to 100.
+    """
+    path = Path(path)
+    path.mkdir(parents=True)
+    if index is None:
+        index = get_similarity_index(anime_df)
+
+    model_item_ids = np.asarray(model.item_ids, dtype=np.int64)
+
+    # neighbours of every rated anime, as model inner ids, -1 for the ones unknown to the model or to the index
+    k = min(k, len(index) - 1)
+    item_neighbours = np.full((ratings.n_items, k), -1, dtype=np.int32)
+    indexed = np.flatnonzero([anime_id in index for anime_id in ratings.item_ids.tolist()])
+    for start in range(0, len(indexed), 1024):
+        rows = indexed[start:start + 1024]
+        neighbour_ids, _ = index.top_k(ratings.item_ids[rows], k)
+        item_neighbours[rows] = model_inner_ids(model_item_ids, neighbour_ids.ravel()).reshape(len(rows), k)
+
+    arrays = {
+        'user_indptr': ratings.user_indptr,
+        'items': ratings.items,
+        'ratings': ratings.ratings,
+        'user_ids': ratings.user_ids,
+        'user_to_model': model_inner_ids(np.asarray(model.user_ids, dtype=np.int64), ratings.user_ids).astype(np.int32),
+        'item_to_model': model_inner_ids(model_item_ids, ratings.item_ids).astype(np.int32),
+        'item_neighbours': item_neighbours,
+        'bu': model.bu,
+        'bi': model.bi,
+        'pu': model.pu,
+        'qi': model.qi,
+        'model_item_ids': model_item_ids.astype(np.int32),
+    }
+    for name in INPUT_ARRAYS:
+        np.save(path / f'{name}.npy', np.ascontiguousarray(arrays[name]))
+    with open(path / 'scoring.json', 'w') as f:
+        json.dump({'global_mean': model.global_mean, 'rating_scale': list(model.rating_scale)}, f, indent=4)
+
+
+def top_n(estimated_ratings: np.ndarray, candidates: np.ndarray, n: int) -> tuple:
+    """Pick the top n candidates of every user of a block, overwriting the estimated ratings of the other items.
+
+    Args:
+        estimated_ratings (np.ndarray): Estimated ratings of shape (n_users, n_model_items)
+        candidates (np.ndarray): Whether every model item is a candidate of every user
+        n (int): Number of recommendations per user
+
+    Returns:
+        tuple: Model inner item ids and estimated ratings of the top candidates, sorted from highest to lowest estimated rating,
+            with a -inf rating when there are less than n candidates. Both have n columns, or less if there are less items, and none if n is not positive
+    """
+    estimated_ratings[~candidates] = -np.inf
+
+    n = max(min(n, estimated_ratings.shape[1]), 0)
+    if n == 0:
+        return np.empty((len(estimated_ratings), 0), dtype=np.int64), np.empty((len(estimated_ratings), 0), dtype=estimated_ratings.dtype)
+    top = np.argpartition(-estimated_ratings, n - 1, axis=1)[:, :n]
+    top_scores = np.take_along_axis(estimated_ratings, top, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind='stable')
+
+    return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+
+def model_inner_ids(model_ids: np.ndarray, raw_ids: np.ndarray) -> np.ndarray:
+    """Map raw ids to the inner ids of a model, whose raw ids are not necessarily sorted.
+
+    Args:
+        model_ids (np.ndarray): Raw id of every model inner id
+        raw_ids (np.ndarray): Raw ids to be mapped
+
+    Returns:
+        np.ndarray: Model inner ids, -1 for the ids unknown to the model
+    """
+    raw_ids = np.asarray(raw_ids, dtype=np.int64)
+    if len(model_ids) == 0:
+        return np.full(len(raw_ids), -1, dtype=np.int64)
+
+    order = np.argsort(model_ids, kind='stable')
+    sorted_ids = model_ids[order]
+    positions = np.minimum(np.searchsorted(sorted_ids, raw_ids), len(sorted_ids) - 1)
+
+    return np.where(sorted_ids[positions] == raw_ids, order[positions], -1)
@@ -0,0 +1,265 @@
+import numpy as np
+import pandas as pd
+import os
+import re
+import unicodedata
+from typing import Optional
+
+from pathlib import Path
+abs_path = Path(__file__).parent
+
+from src.dataset.preprocessing import catalogue_fingerprint
+from src.dataset.cache import load_anime_data
+
+SEARCH_PATH = abs_path / '../../data/processed/search'
+TITLES_PATH = abs_path / '../../data/raw/anime_metadata.csv'
+
+# query tokens shorter than this are only matched as prefixes, never fuzzily
+FUZZY_MIN_LENGTH = 4
+
+
+def tokenize(text: str) -> list:
+    """Split a title or a query into lowercase ascii tokens, ignoring accents and punctuation.
+
+    Args:
+        text (str): Text to be tokenized
+
+    Returns:
+        list: Tokens of the text
+    """
+    text = unicodedata.normalize('NFKD', text).encode('ascii', 'ignore').decode()
+
+    return re.findall(r'[a-z0-9]+', text.lower())
+
+
+class SearchIndex:
+    """Inverted index from title tokens to the animes whose name or english title contains them.
+    Rows are sorted from most to least popular, so the animes matching a query come out ranked by members
+    just by being returned in row order. Every query token matches the title tokens it is a prefix of and,
+    when it matches none, the ones within one edit of it, found through a table of single-character deletions.
+
+    Args:
+        anime_ids (np.ndarray): Anime id of every row, from most to least members
+        vocabulary (np.ndarray): Sorted title tokens
+        indptr (np.ndarray): Offsets of the rows of every token in postings, of shape (n_tokens + 1,)
+        postings (np.ndarray): Sorted rows containing every token, grouped by token
+        deletes (np.ndarray): Sorted tokens and tokens with one character deleted
+        delete_tokens (np.ndarray): Token every entry of deletes comes from
+    """
+    def __init__(self, anime_ids: np.ndarray, vocabulary: np.ndarray, indptr: np.ndarray, postings: np.ndarray,
+                 deletes: np.ndarray, delete_tokens: np.ndarray):
+        """Initializes the index from its already built arrays
+        """
+        self.anime_ids = anime_ids
+        self.vocabulary = vocabulary
+        self.indptr = indptr
+        self.postings = postings
+        self.deletes = deletes
+        self.delete_tokens = delete_tokens
+
+    @classmethod
+    def from_catalogue(cls, anime_df: pd.DataFrame, titles: pd.DataFrame = None) -> 'SearchIndex':
+        """Build the index of a catalogue.
+
+        Args:
+            anime_df (pd.DataFrame): Processed anime dataframe
+            titles (pd.DataFrame, optional): Dataframe with anime_id and en_title columns, whose titles are indexed along with the names. Defaults to None.
+
+        Returns:
+            SearchIndex: Search index of the catalogue
+        """
+        anime_df = anime_df.sort_values(by='members', ascending=False, kind='stable')
+        anime_ids = anime_df.anime_id.values.astype(np.int64)
+
+        texts = anime_df.name.astype(object).fillna('')
+        if titles is not None:
+            en_titles = titles.drop_duplicates('anime_id').set_index('anime_id').en_title
+            texts = texts + ' ' + en_titles.reindex(anime_ids).fillna('').values
+
+        token_rows = {}
+        for row, text in enumerate(texts.tolist()):
+            for token in set(tokenize(text)):
+                token_rows.setdefault(token, []).append(row)
+
+        vocabulary = sorted(token_rows)
+        lengths = [len(token_rows[token]) for token in vocabulary]
+        indptr = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        postings = np.fromiter((row for token in vocabulary for row in token_rows[token]), dtype=np.int32, count=indptr[-1])
+
+        deletes, delete_tokens = [], []
+        for token_id, token in enumerate(vocabulary):
+            variants = _deletes(token) if len(token) >= FUZZY_MIN_LENGTH else {token}
+            deletes.extend(variants)
+            delete_tokens.extend([token_id] * len(variants))
+        deletes = np.array(deletes, dtype=str)
+        order = np.argsort(deletes, kind='stable')
+
+        return cls(
+            anime_ids=anime_ids,
+            vocabulary=np.array(vocabulary, dtype=str),
+            indptr=indptr,
+            postings=postings,
+            deletes=deletes[order],
+            delete_tokens=np.array(delete_tokens, dtype=np.int32)[order],
+        )
+
+    @classmethod
+    def load(cls, path: Path) -> 'SearchIndex':
+        """Load an index saved with save.
+
+        Args:
+            path (Path): .npz file of the index
+
+        Returns:
+            SearchIndex: Search index
+        """
+        with np.load(path) as arrays:
+            return cls(**{name: arrays[name] for name in ['anime_ids', 'vocabulary', 'indptr', 'postings', 'deletes', 'delete_tokens']})
+
+    def save(self, path: Path, **extra_arrays):
+        """Save the index arrays into a single .npz file, replacing any previous one at once.
+
+        Args:
+            path (Path): .npz file of the index
+            extra_arrays: Additional arrays to be stored along with the index
+        """
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(path.name + f'.tmp{os.getpid()}')
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, anime_ids=self.anime_ids, vocabulary=self.vocabulary, indptr=self.indptr, postings=self.postings,
+                     deletes=self.deletes, delete_tokens=self.delete_tokens, **extra_arrays)
+        os.replace(tmp_path, path)
+
+    def __len__(self) -> int:
+        return len(self.anime_ids)
+
+    def search(self, query: str, limit: int = 50) -> np.ndarray:
+        """Find the animes whose titles match every token of the query.
+
+        Args:
+            query (str): Text typed by the user, an empty query matches every anime
+            limit (int, optional): Maximum number of results. Defaults to 50.
+
+        Returns:
+            np.ndarray: Anime ids of the matching animes, from most to least members
+        """
+        rows = None
+        for token in tokenize(query):
+            token_rows = self._match(token)
+            rows = token_rows if rows is None else np.intersect1d(rows, token_rows, assume_unique=True)
+            if len(rows) == 0:
+                break
+
+        if rows is None:
+            return self.anime_ids[:limit]
+
+        return self.anime_ids[rows[:limit]]
+
+    def _match(self, token: str) -> np.ndarray:
+        """Find the sorted rows with a title token that starts with the given one or, if there is none, that is within one edit of it.
+
+        Args:
+            token (str): Query token
+
+        Returns:
+            np.ndarray: Matching rows
+        """
+        # tokens sharing a prefix are contiguous in the sorted vocabulary, and so are their postings
+        start = np.searchsorted(self.vocabulary, token, side='left')
+        end = np.searchsorted(self.vocabulary, token + '\uffff', side='left')
+        if end > start:
+            if end - start == 1:
+                return self.postings[self.indptr[start]:self.indptr[start + 1]]
+            return np.unique(self.postings[self.indptr[start]:self.indptr[end]])
+
+        if len(token) < FUZZY_MIN_LENGTH:
+            return np.empty(0, dtype=self.postings.dtype)
+
+        variants = np.array(sorted(_deletes(token)), dtype=str)
+        starts = np.searchsorted(self.deletes, variants, side='left')
+        ends = np.searchsorted(self.deletes, variants, side='right')
+        token_ids = np.unique(np.concatenate([self.delete_tokens[s:e] for s, e in zip(starts, ends)]))
+        if len(token_ids) == 0:
+            return np.empty(0, dtype=self.postings.dtype)
+
+        return np.unique(np.concatenate([self.postings[self.indptr[t]:self.indptr[t + 1]] for t in token_ids]))
+
+
+def build_search_index(anime_df: pd.DataFrame, titles_path: Path = TITLES_PATH, path: Path = SEARCH_PATH) -> SearchIndex:
+    """Build the search index of a catalogue and save it keyed by the catalogue fingerprint.
+
+    Args:
+        anime_df (pd.DataFrame): Processed anime dataframe
+        titles_path (Path, optional): Side table with the english titles. Defaults to TITLES_PATH.
+        path (Path, optional): Root directory of the search indexes. Defaults to SEARCH_PATH.
+
+    Returns:
+        SearchIndex: Search index of the catalogue
+    """
+    titles = pd.read_csv(titles_path) if Path(titles_path).exists() else None
+    index = SearchIndex.from_catalogue(anime_df, titles)
+    index.save(Path(path) / f'{catalogue_fingerprint(anime_df)}.npz', titles_signature=_titles_signature(titles_path))
+
+    return index
+
+
+def load_search_index(anime_df: pd.DataFrame, titles_path: Path = TITLES_PATH, path: Path = SEARCH_PATH) -> Optional[SearchIndex]:
+    """Load the search index built for the given catalogue, if any and if the english titles have not changed since.
+
+    Args:
+        anime_df (pd.DataFrame): Processed anime dataframe
+        titles_path (Path, optional): Side table with the english titles. Defaults to TITLES_PATH.
+        path (Path, optional): Root directory of the search indexes. Defaults to SEARCH_PATH.
+
+    Returns:
+        Optional[SearchIndex]: Search index, or None if it has not been built for this catalogue
+    """
+    index_path = Path(path) / f'{catalogue_fingerprint(anime_df)}.npz'
+    if not index_path.exists():
+        return None
+
+    with np.load(index_path) as arrays:
+        if not np.array_equal(arrays['titles_signature'], _titles_signature(titles_path)):
+            return None
+
+    return SearchIndex.load(index_path)
+
+
+def get_search_index(anime_df: pd.DataFrame, titles_path: Path = TITLES_PATH, path: Path = SEARCH_PATH) -> SearchIndex:
+    """Get the search index of the given catalogue, building and saving it only if it is missing or outdated.
+
+    Args:
+        anime_df (pd.DataFrame): Processed anime dataframe
+        titles_path (Path, optional): Side table with the english titles. Defaults to TITLES_PATH.
+        path (Path, optional): Root directory of the search indexes. Defaults to SEARCH_PATH.
+
+    Returns:
+        SearchIndex: Search index of the catalogue
+    """
+    index = load_search_index(anime_df, titles_path, path)
+    if index is not None:
+        return index
+
+    return build_search_index(anime_df, titles_path, path)
+
+
+def _deletes(token: str) -> set:
+    return {token} | {token[:i] + token[i + 1:] for i in range(len(token))}
+
+
+def _titles_signature(titles_path: Path) -> np.ndarray:
+    if not Path(titles_path).exists():
+        return np.zeros(2, dtype=np.int64)
+
+    stat = os.stat(titles_path)
+
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+if __name__ == "__main__":
+    anime_df = load_anime_data()
+
+    index = build_search_index(anime_df)
+    print(f"Search index of {len(index)} animes written to {SEARCH_PATH.resolve()}")
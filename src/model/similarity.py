@@ -0,0 +1,234 @@
+import numpy as np
+import pandas as pd
+import os
+import shutil
+from typing import Iterable, Optional, Tuple, Union
+
+from pathlib import Path
+abs_path = Path(__file__).parent
+
+from src.dataset.preprocessing import catalogue_fingerprint, build_feature_matrix
+from src.dataset.cache import load_anime_data
+
+NEIGHBOURS_PATH = abs_path / '../../data/processed/neighbours'
+
+
+class SimilarityIndex:
+    """Content-based similarity index over the anime catalogue.
+    The feature matrix is built once and top k queries for any number of animes are answered with a single matrix product.
+
+    Args:
+        anime_df (pd.DataFrame): Processed anime dataframe, indexed either by position or by anime_id
+        features (np.ndarray, optional): Feature matrix of the catalogue, as returned by preprocess_anime_data. Defaults to None, in which case it is built.
+    """
+    def __init__(self, anime_df: pd.DataFrame, features: np.ndarray = None):
+        """Initializes the index by building the feature matrix and the anime_id to row map
+        """
+        if 'anime_id' in anime_df.columns:
+            anime_ids = anime_df.anime_id.values
+        else:
+            anime_ids = anime_df.index.values
+
+        self.anime_ids = np.ascontiguousarray(anime_ids, dtype=np.int64)
+        self.id_to_row = {anime_id: row for row, anime_id in enumerate(self.anime_ids.tolist())}
+        self.features = features if features is not None else build_feature_matrix(anime_df)
+
+    def __len__(self) -> int:
+        return len(self.anime_ids)
+
+    def __contains__(self, anime_id: int) -> bool:
+        return int(anime_id) in self.id_to_row
+
+    def top_k(self, anime_ids: Iterable[int], k: int = 100) -> Tuple[np.ndarray, np.ndarray]:
+        """Find the top k most similar animes to each of the given animes.
+
+        Args:
+            anime_ids (Iterable[int]): Query animes, all of them must be part of the index
+            k (int, optional): Number of similar animes to be found per query. Defaults to 100.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Neighbour anime ids and cosine similarities, both of shape (n_queries, k) and sorted from most to least similar
+        """
+        rows = np.array([self.id_to_row[int(anime_id)] for anime_id in anime_ids], dtype=np.int64)
+        k = min(k, len(self) - 1)
+
+        sims = self.features[rows] @ self.features.T
+        # an anime is never similar to itself
+        sims[np.arange(len(rows)), rows] = -np.inf
+
+        top_k_indices = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+        top_k_values = np.take_along_axis(sims, top_k_indices, axis=1)
+
+        order = np.argsort(-top_k_values, axis=1, kind='stable')
+        top_k_indices = np.take_along_axis(top_k_indices, order, axis=1)
+        top_k_values = np.take_along_axis(top_k_values, order, axis=1)
+
+        return self.anime_ids[top_k_indices], top_k_values
+
+    def most_similar(self, anime_ids: Iterable[int], k: int = 100) -> list:
+        """Get the union of the top k most similar animes to each of the given animes.
+
+        Args:
+            anime_ids (Iterable[int]): Query animes, all of them must be part of the index
+            k (int, optional): Number of similar animes to be found per query. Defaults to 100.
+
+        Returns:
+            list: Unique similar anime ids
+        """
+        anime_ids = list(anime_ids)
+        if len(anime_ids) == 0:
+            return []
+
+        neighbour_ids, _ = self.top_k(anime_ids, k)
+
+        return pd.unique(neighbour_ids.ravel()).tolist()
+
+
+class NeighbourTable:
+    """Precomputed top K neighbours of every anime in the catalogue, read through memory mapping.
+    It answers the same queries as SimilarityIndex without computing any similarity at request time,
+    and several processes loading the same table share a single page-cache copy of it.
+
+    Args:
+        path (Path): Directory where the table was written by build_neighbour_table
+    """
+    def __init__(self, path: Path):
+        """Initializes the table by memory mapping its arrays, nothing is read from disk until it is queried
+        """
+        self.path = Path(path)
+        self.anime_ids = np.load(self.path / 'anime_ids.npy', mmap_mode='r')
+        self.neighbour_ids = np.load(self.path / 'neighbour_ids.npy', mmap_mode='r')
+        self.scores = np.load(self.path / 'scores.npy', mmap_mode='r')
+
+    def __len__(self) -> int:
+        return len(self.anime_ids)
+
+    def __contains__(self, anime_id: int) -> bool:
+        row = np.searchsorted(self.anime_ids, anime_id)
+        return row < len(self) and self.anime_ids[row] == anime_id
+
+    @property
+    def k(self) -> int:
+        return self.neighbour_ids.shape[1]
+
+    def top_k(self, anime_ids: Iterable[int], k: int = 100) -> Tuple[np.ndarray, np.ndarray]:
+        """Find the top k most similar animes to each of the given animes.
+
+        Args:
+            anime_ids (Iterable[int]): Query animes, all of them must be part of the table
+            k (int, optional): Number of similar animes to be found per query, at most the K the table was built with. Defaults to 100.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Neighbour anime ids and cosine similarities, both of shape (n_queries, k) and sorted from most to least similar
+        """
+        anime_ids = np.asarray(list(anime_ids), dtype=np.int64)
+        rows = np.searchsorted(self.anime_ids, anime_ids)
+        rows = np.minimum(rows, len(self) - 1)
+        missing = anime_ids[self.anime_ids[rows] != anime_ids]
+        if len(missing) > 0:
+            raise KeyError(f"Animes {missing.tolist()} are not part of the neighbour table")
+        if k > self.k and self.k < len(self) - 1:
+            raise ValueError(f"Neighbour table was built with K={self.k} but {k} neighbours were requested")
+
+        return np.asarray(self.neighbour_ids[rows, :k], dtype=np.int64), np.asarray(self.scores[rows, :k])
+
+    def most_similar(self, anime_ids: Iterable[int], k: int = 100) -> list:
+        """Get the union of the top k most similar animes to each of the given animes.
+
+        Args:
+            anime_ids (Iterable[int]): Query animes, all of them must be part of the table
+            k (int, optional): Number of similar animes to be found per query. Defaults to 100.
+
+        Returns:
+            list: Unique similar anime ids
+        """
+        anime_ids = list(anime_ids)
+        if len(anime_ids) == 0:
+            return []
+
+        neighbour_ids, _ = self.top_k(anime_ids, k)
+
+        return pd.unique(neighbour_ids.ravel()).tolist()
+
+
+def build_neighbour_table(anime_df: pd.DataFrame, k: int = 100, path: Path = NEIGHBOURS_PATH, block_size: int = 1024) -> Path:
+    """Precompute the top k neighbours of every anime and save them as .npy files keyed by the catalogue fingerprint.
+    Rows are sorted by anime_id so that the loaded table can be queried with a binary search.
+
+    Args:
+        anime_df (pd.DataFrame): Processed anime dataframe
+        k (int, optional): Number of neighbours to be kept per anime. Defaults to 100.
+        path (Path, optional): Root directory of the neighbour tables. Defaults to NEIGHBOURS_PATH.
+        block_size (int, optional): Number of animes whose similarities are computed at once. Defaults to 1024.
+
+    Returns:
+        Path: Directory where the table was written
+    """
+    index = SimilarityIndex(anime_df)
+    k = min(k, len(index) - 1)
+
+    order = np.argsort(index.anime_ids, kind='stable')
+    anime_ids = index.anime_ids[order]
+
+    neighbour_ids = np.empty((len(index), k), dtype=np.int32)
+    scores = np.empty((len(index), k), dtype=np.float32)
+    for start in range(0, len(index), block_size):
+        block_ids, block_scores = index.top_k(anime_ids[start:start + block_size], k)
+        neighbour_ids[start:start + block_size] = block_ids
+        scores[start:start + block_size] = block_scores
+
+    table_path = Path(path) / catalogue_fingerprint(anime_df)
+    tmp_path = table_path.with_name(table_path.name + f'.tmp{os.getpid()}')
+    tmp_path.mkdir(parents=True, exist_ok=True)
+    np.save(tmp_path / 'anime_ids.npy', anime_ids)
+    np.save(tmp_path / 'neighbour_ids.npy', neighbour_ids)
+    np.save(tmp_path / 'scores.npy', scores)
+
+    # swap the complete table in place so that readers never see a partially written one
+    if table_path.exists():
+        shutil.rmtree(table_path)
+    os.replace(tmp_path, table_path)
+
+    return table_path
+
+
+def load_neighbour_table(anime_df: pd.DataFrame, path: Path = NEIGHBOURS_PATH) -> Optional[NeighbourTable]:
+    """Load the neighbour table built for the given catalogue, if any.
+
+    Args:
+        anime_df (pd.DataFrame): Processed anime dataframe
+        path (Path, optional): Root directory of the neighbour tables. Defaults to NEIGHBOURS_PATH.
+
+    Returns:
+        Optional[NeighbourTable]: Memory mapped neighbour table, or None if it has not been built for this catalogue
+    """
+    table_path = Path(path) / catalogue_fingerprint(anime_df)
+    if not (table_path / 'neighbour_ids.npy').exists():
+        return None
+
+    return NeighbourTable(table_path)
+
+
+def get_similarity_index(anime_df: pd.DataFrame, path: Path = NEIGHBOURS_PATH) -> Union[NeighbourTable, SimilarityIndex]:
+    """Get the cheapest available similarity index for the given catalogue:
+    the precomputed neighbour table if it has been built, or an in-memory similarity index otherwise.
+
+    Args:
+        anime_df (pd.DataFrame): Processed anime dataframe
+        path (Path, optional): Root directory of the neighbour tables. Defaults to NEIGHBOURS_PATH.
+
+    Returns:
+        Union[NeighbourTable, SimilarityIndex]: Similarity index of the catalogue
+    """
+    table = load_neighbour_table(anime_df, path)
+    if table is not None:
+        return table
+
+    return SimilarityIndex(anime_df)
+
+
+if __name__ == "__main__":
+    anime_df = load_anime_data()
+
+    table_path = build_neighbour_table(anime_df)
+    print(f"Neighbour table written to {table_path.resolve()}")
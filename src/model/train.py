@@ -1,14 +1,26 @@
+import numpy as np
 import pandas as pd
+import argparse
+import time
+from typing import Union
 
 from surprise.model_selection import train_test_split
 from surprise.prediction_algorithms import SVD
-from surprise import accuracy, dump
+from surprise import accuracy
 
 from pathlib import Path
 abs_path = Path(__file__).parent
     
-from src.dataset.preprocessing import preprocess_anime_data, preprocess_ratings_data
+from src.dataset.preprocessing import preprocess_ratings_data, preprocess_ratings_matrix, catalogue_fingerprint
+from src.dataset.cache import CACHE_PATH, load_anime_data, load_ratings_data, load_ratings_matrix
+from src.dataset.ratings import RatingsMatrix, build_ratings_store
+from src.model.als import ALS
+from src.model.factors import FactorModel
+from src.model.registry import save_model
+from src.model.tuning import ParallelSearch
+from src.instrumentation import instrumented, span
 
+@instrumented
 def _train(model):
     """Train a Surprise model on the anime dataset and evaluate it.
 
@@ -18,19 +30,20 @@ def _train(model):
     Returns:
         _type_: Fitted model RMSE on test set
     """
-    anime_df = pd.read_csv(abs_path / ('../../data/external/anime.csv'))
-    anime_df = preprocess_anime_data(anime_df)
+    anime_df = load_anime_data()
+    ratings_df = load_ratings_data(anime_df)
     
     anime_df.set_index('anime_id', drop=True, inplace=True)
 
-    ratings_df = pd.read_csv(abs_path / ('../../data/external/rating.csv'))
     ratings_dataset = preprocess_ratings_data(ratings_df, anime_df)
     
     trainset, testset = train_test_split(ratings_dataset, test_size=0.2, random_state=5)
     
-    model.fit(trainset)
+    with span('model.train.fit'):
+        model.fit(trainset)
     
-    predictions = model.test(testset)
+    with span('model.train.test'):
+        predictions = model.test(testset)
     
     metrics = accuracy.rmse(predictions, verbose=False)
     print(metrics)
@@ -38,20 +51,58 @@ def _train(model):
     return metrics
     
 
+def _benchmark(models: dict) -> pd.DataFrame:
+    """Train and evaluate several models on the anime dataset following the same protocol as _train, measuring their wall time.
+
+    Args:
+        models (dict): Models to be compared, in the form of {name: model}. Any model with the Surprise fit/test interface is accepted, e.g. SVD or ALS
+
+    Returns:
+        pd.DataFrame: RMSE on test set, fit time and test time in seconds of every model
+    """
+    anime_df = load_anime_data()
+    ratings_df = load_ratings_data(anime_df)
+    
+    anime_df.set_index('anime_id', drop=True, inplace=True)
+
+    ratings_dataset = preprocess_ratings_data(ratings_df, anime_df)
+    
+    trainset, testset = train_test_split(ratings_dataset, test_size=0.2, random_state=5)
+    
+    results = []
+    for name, model in models.items():
+        start = time.perf_counter()
+        model.fit(trainset)
+        fit_time = time.perf_counter() - start
+        
+        start = time.perf_counter()
+        predictions = model.test(testset)
+        test_time = time.perf_counter() - start
+        
+        rmse = accuracy.rmse(predictions, verbose=False)
+        print(f"{name}: RMSE {rmse:.4f}, fit {fit_time:.1f}s, test {test_time:.1f}s")
+        results.append({'model': name, 'rmse': rmse, 'fit_time': fit_time, 'test_time': test_time})
+    
+    return pd.DataFrame(results).set_index('model')
+    
+
+@instrumented
 def simple_train(dataset):
     """Train a SVD model from Surprise on a given dataset
 
     Args:
-        dataset (_type_): Surprise dataset for recommendation
+        dataset (_type_): Surprise dataset or RatingsMatrix for recommendation
 
     Returns:
         _type_: Fitted model
     """
 
-    trainset = dataset.build_full_trainset()
+    with span('model.train.build_full_trainset'):
+        trainset = dataset.build_full_trainset()
     
     model = SVD()
-    model.fit(trainset)
+    with span('model.train.fit'):
+        model.fit(trainset)
     
     return model
 
@@ -60,20 +111,134 @@ def _grid_search(gs):
     """Perform a grid search on a Surprise model with a recommendation dataset
 
     Args:
-        gs (_type_): GridSearchCV Surprise object
+        gs (_type_): GridSearchCV Surprise object or ParallelSearch object
 
     Returns:
         _type_: Fitted grid search object
     """
-    anime_df = pd.read_csv(abs_path / ('../../data/external/anime.csv'))
-    anime_df = preprocess_anime_data(anime_df)
+    anime_df = load_anime_data()
+    ratings_df = load_ratings_data(anime_df)
     
     anime_df.set_index('anime_id', drop=True, inplace=True)
 
-    ratings_df = pd.read_csv(abs_path / ('../../data/external/rating.csv'))
-    ratings_dataset = preprocess_ratings_data(ratings_df, anime_df)
+    if isinstance(gs, ParallelSearch):
+        ratings_dataset = preprocess_ratings_matrix(ratings_df, anime_df)
+    else:
+        ratings_dataset = preprocess_ratings_data(ratings_df, anime_df)
     
     gs.fit(ratings_dataset)
     algo = gs.best_estimator["rmse"]
     
-    return gs
\ No newline at end of file
+    return gs
+
+
+@instrumented
+def train_and_save(anime_df: pd.DataFrame, ratings: Union[pd.DataFrame, RatingsMatrix], algo: ALS = None) -> FactorModel:
+    """Train a model on the full ratings dataset and save it as a new version of the model registry.
+
+    Args:
+        anime_df (pd.DataFrame): Processed anime dataframe
+        ratings (Union[pd.DataFrame, RatingsMatrix]): Raw ratings dataframe, or ratings matrix already filtered against the catalogue,
+            e.g. the memory mapped one of load_ratings_matrix
+        algo (ALS, optional): ALS recommender to be trained, which reads a memory mapped matrix block by block.
+            Defaults to None, in which case a SVD model from Surprise is trained, which needs all the ratings in memory.
+
+    Returns:
+        FactorModel: Factors of the fitted model
+    """
+    if isinstance(ratings, RatingsMatrix):
+        ratings_matrix = ratings
+    else:
+        ratings_matrix = preprocess_ratings_matrix(ratings, anime_df)
+    
+    if algo is None:
+        model = FactorModel.from_surprise(simple_train(ratings_matrix))
+        metadata = {'algorithm': 'SVD'}
+    else:
+        with span('model.train.fit'):
+            model = algo.fit(ratings_matrix).to_factor_model()
+        metadata = {'algorithm': 'ALS', 'n_factors': algo.n_factors, 'n_epochs': algo.n_epochs, 'reg_all': algo.reg_all}
+    save_model(model, catalogue_fingerprint(anime_df), metadata=metadata)
+    
+    return model
+
+
+@instrumented
+def holdout_rmse(algo: ALS, ratings: RatingsMatrix, path: Path = CACHE_PATH / 'holdout', test_size: float = 0.2, random_state: int = 5,
+                 block_ratings: int = 1_000_000) -> float:
+    """Train a recommender on a random split of a ratings matrix and compute its RMSE on the rest of the ratings, block by block,
+    so that neither the ratings nor the split are ever loaded in memory all at once. The train ratings are written into a ratings store.
+
+    Args:
+        algo (ALS): Recommender to be evaluated
+        ratings (RatingsMatrix): Ratings matrix, usually memory mapped
+        path (Path, optional): Directory of the ratings store of the train split. Defaults to CACHE_PATH / 'holdout'.
+        test_size (float, optional): Fraction of the ratings in the test split. Defaults to 0.2.
+        random_state (int, optional): Seed of the split. Defaults to 5.
+        block_ratings (int, optional): Number of ratings processed at once. Defaults to 1_000_000.
+
+    Returns:
+        float: RMSE on the test split
+    """
+    def raw_blocks():
+        for users, items, scores in ratings.iter_blocks(block_ratings):
+            user_ids, anime_ids = ratings.user_ids[users], ratings.item_ids[items]
+            yield user_ids, anime_ids, scores, _holdout_mask(user_ids, anime_ids, test_size, random_state)
+
+    train_chunks = (pd.DataFrame({'user_id': user_ids[~test], 'anime_id': anime_ids[~test], 'rating': scores[~test]})
+                    for user_ids, anime_ids, scores, test in raw_blocks())
+    train_matrix = build_ratings_store(train_chunks, path, ratings.rating_scale, block_ratings)
+
+    with span('model.train.fit'):
+        algo.fit(train_matrix)
+
+    squared_error, n_test = 0.0, 0
+    for user_ids, anime_ids, scores, test in raw_blocks():
+        est = algo.estimate(train_matrix.to_inner_uids(user_ids[test]), train_matrix.to_inner_iids(anime_ids[test]))
+        est = np.clip(est, *train_matrix.rating_scale)
+        squared_error += float(((est - scores[test]) ** 2).sum())
+        n_test += int(test.sum())
+
+    return float(np.sqrt(squared_error / max(n_test, 1)))
+
+
+def _holdout_mask(user_ids: np.ndarray, anime_ids: np.ndarray, test_size: float, random_state: int) -> np.ndarray:
+    """Decide which ratings belong to the test split by hashing their (user, anime) pair, so that the split of a rating
+    does not depend on the block it is processed in.
+
+    Args:
+        user_ids (np.ndarray): Raw user id of every rating
+        anime_ids (np.ndarray): Raw anime id of every rating
+        test_size (float): Fraction of the ratings in the test split
+        random_state (int): Seed of the split
+
+    Returns:
+        np.ndarray: Whether every rating belongs to the test split
+    """
+    with np.errstate(over='ignore'):
+        keys = (user_ids.astype(np.uint64) << np.uint64(32)) | anime_ids.astype(np.uint32).astype(np.uint64)
+        keys = keys + np.uint64(random_state) * np.uint64(0x9E3779B97F4A7C15)
+        # splitmix64 finalizer
+        keys = (keys ^ (keys >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        keys = (keys ^ (keys >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        keys = keys ^ (keys >> np.uint64(31))
+
+    return (keys >> np.uint64(11)).astype(np.float64) / 2 ** 53 < test_size
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Train a recommender on the full ratings dataset and save it into the model registry')
+    parser.add_argument('--chunked', action='store_true',
+                        help='ingest the ratings chunk by chunk into a memory mapped store and train ALS on it, for datasets larger than memory')
+    parser.add_argument('--evaluate', action='store_true', help='with --chunked, print the RMSE of ALS on a holdout split first')
+    args = parser.parse_args()
+
+    anime_df = load_anime_data()
+    if args.chunked:
+        ratings_matrix = load_ratings_matrix(anime_df)
+        if args.evaluate:
+            print(f"Holdout RMSE: {holdout_rmse(ALS(random_state=5), ratings_matrix):.4f}")
+        train_and_save(anime_df, ratings_matrix, ALS(random_state=5))
+    else:
+        ratings_df = load_ratings_data(anime_df)
+        train_and_save(anime_df, ratings_df)
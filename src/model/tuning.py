@@ -0,0 +1,276 @@
+import numpy as np
+import pandas as pd
+import itertools
+import json
+import multiprocessing
+import os
+import time
+from multiprocessing.shared_memory import SharedMemory
+from pathlib import Path
+from typing import Union
+from surprise import Dataset
+from surprise.prediction_algorithms import SVD
+
+from src.dataset.ratings import MATRIX_ARRAYS, RatingsMatrix
+from src.model.als import ALS
+
+# arrays of the test fold shared along with its train matrix, with the test users and items as inner ids of the train matrix
+TEST_ARRAYS = ['test_users', 'test_items', 'test_ratings']
+
+# arrays shared with the worker processes, attached once per worker by _init_worker
+_shared = {}
+
+
+class ParallelSearch:
+    """Hyper-parameter search that evaluates every (parameters, fold) combination on a process pool.
+    The train matrix and the test ratings of every fold are built once and copied into shared memory, where every worker reads them from,
+    instead of being pickled for every combination or rebuilt by every worker.
+    Optionally, candidates are trained with successive halving: all of them start with a small number of epochs and only the best
+    1 / halving_factor of them are trained further at every rung. Every evaluated combination is appended to results_path as a JSON line.
+    Its interface follows GridSearchCV from Surprise, so it can be passed to _grid_search.
+
+    Args:
+        algo_class (type, optional): Recommender to be tuned, either ALS or a Surprise algorithm. Defaults to ALS.
+        param_grid (dict, optional): Values to be tried for every hyper-parameter. Defaults to None.
+        measures (list, optional): Measures to be computed, among 'rmse' and 'mae'. Candidates are selected by the first one. Defaults to ['rmse', 'mae'].
+        cv (int, optional): Number of folds. Defaults to 3.
+        n_jobs (int, optional): Number of worker processes, -1 to use all cores. Defaults to -1.
+        halving_factor (int, optional): Factor by which candidates are discarded and epochs are increased at every rung, 0 to disable successive halving. Defaults to 0.
+        min_epochs (int, optional): Number of epochs of the first rung of successive halving. Defaults to 2.
+        results_path (Path, optional): JSON lines file where every evaluated combination is appended. Defaults to None.
+        random_state (int, optional): Seed of the folds split. Defaults to None.
+    """
+    def __init__(self, algo_class: type = ALS, param_grid: dict = None, measures: list = ['rmse', 'mae'], cv: int = 3, n_jobs: int = -1,
+                 halving_factor: int = 0, min_epochs: int = 2, results_path: Path = None, random_state: int = None):
+        """Initializes the search settings
+        """
+        self.algo_class = algo_class
+        self.param_grid = param_grid or {}
+        self.measures = [measure.lower() for measure in measures]
+        self.cv = cv
+        self.n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+        self.halving_factor = halving_factor
+        self.min_epochs = min_epochs
+        self.results_path = results_path
+        self.random_state = random_state
+
+    def fit(self, data: Union[RatingsMatrix, Dataset]) -> 'ParallelSearch':
+        """Run the search.
+
+        Args:
+            data (Union[RatingsMatrix, Dataset]): Ratings to be split into folds, Surprise datasets loaded from a dataframe are also accepted
+
+        Returns:
+            ParallelSearch: Fitted search, with its results in cv_results, best_params, best_score and best_estimator
+        """
+        if not isinstance(data, RatingsMatrix):
+            data = RatingsMatrix.from_frame(data.df.set_axis(['user_id', 'anime_id', 'rating'], axis=1), data.reader.rating_scale)
+
+        candidates = [dict(zip(self.param_grid, values)) for values in itertools.product(*self.param_grid.values())]
+        max_epochs = max([params.get('n_epochs', self.algo_class().n_epochs) for params in candidates])
+
+        blocks = []
+        try:
+            specs = {}
+            for fold, arrays in enumerate(_split_folds(data, self.cv, self.random_state)):
+                for name, array in arrays.items():
+                    block = SharedMemory(create=True, size=max(array.nbytes, 1))
+                    blocks.append(block)
+                    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[:] = array
+                    specs[f'fold{fold}_{name}'] = (block.name, array.shape, array.dtype.str)
+
+            with multiprocessing.Pool(self.n_jobs, initializer=_init_worker, initargs=(specs, data.rating_scale)) as pool:
+                results = self._run(pool, candidates, max_epochs)
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+
+        self.cv_results = pd.DataFrame(results)
+        self._select_best(candidates, max_epochs)
+
+        return self
+
+    def _run(self, pool: multiprocessing.Pool, candidates: list, max_epochs: int) -> list:
+        """Evaluate the candidates rung by rung, keeping only the best of every rung when successive halving is enabled.
+
+        Args:
+            pool (multiprocessing.Pool): Pool of workers with the shared ratings attached
+            candidates (list): Hyper-parameters of every candidate
+            max_epochs (int): Number of epochs of the last rung
+
+        Returns:
+            list: Metrics of every evaluated combination
+        """
+        if self.halving_factor > 1:
+            n_rungs = int(np.floor(np.log(max(max_epochs / self.min_epochs, 1)) / np.log(self.halving_factor))) + 1
+            rung_epochs = [min(self.min_epochs * self.halving_factor ** rung, max_epochs) for rung in range(n_rungs)]
+            rung_epochs[-1] = max_epochs
+        else:
+            rung_epochs = [None]
+
+        results = []
+        alive = list(range(len(candidates)))
+        for rung, n_epochs in enumerate(rung_epochs):
+            tasks = []
+            for fold in range(self.cv):
+                for candidate in alive:
+                    params = dict(candidates[candidate])
+                    if n_epochs is not None:
+                        params['n_epochs'] = n_epochs
+                    tasks.append((self.algo_class, rung, candidate, params, fold, self.measures))
+
+            rung_results = []
+            for result in pool.imap_unordered(_evaluate, tasks):
+                rung_results.append(result)
+                self._write_result(result)
+            results.extend(rung_results)
+
+            if rung < len(rung_epochs) - 1:
+                scores = pd.DataFrame(rung_results).groupby('candidate')[self.measures[0]].mean()
+                n_kept = max(1, int(np.ceil(len(alive) / self.halving_factor)))
+                alive = scores.nsmallest(n_kept).index.tolist()
+
+        return results
+
+    def _write_result(self, result: dict):
+        if self.results_path is None:
+            return
+
+        with open(self.results_path, 'a') as f:
+            f.write(json.dumps(result) + '\n')
+
+    def _select_best(self, candidates: list, max_epochs: int):
+        last_rung = self.cv_results[self.cv_results.rung == self.cv_results.rung.max()]
+        mean_scores = last_rung.groupby('candidate')[self.measures].mean()
+
+        self.best_params, self.best_score, self.best_estimator = {}, {}, {}
+        for measure in self.measures:
+            best_candidate = mean_scores[measure].idxmin()
+            params = dict(candidates[best_candidate])
+            if self.halving_factor > 1:
+                params['n_epochs'] = max_epochs
+            self.best_params[measure] = params
+            self.best_score[measure] = float(mean_scores.loc[best_candidate, measure])
+            self.best_estimator[measure] = self.algo_class(**params)
+
+
+def _split_folds(data: RatingsMatrix, cv: int, random_state: int):
+    """Split the ratings into folds at random and build the train matrix and the test arrays of every fold, one fold at a time.
+
+    Args:
+        data (RatingsMatrix): Ratings to be split
+        cv (int): Number of folds
+        random_state (int): Seed of the split
+
+    Yields:
+        dict: Arrays of the train matrix and of the test ratings of a fold, by name
+    """
+    rng = np.random.default_rng(random_state)
+    folds = (rng.permutation(data.n_ratings) % cv).astype(np.uint8)
+    user_ids, anime_ids = data.user_ids[data.users()], data.item_ids[data.items]
+
+    for fold in range(cv):
+        test = folds == fold
+        train_matrix = RatingsMatrix.from_arrays(user_ids[~test], anime_ids[~test], data.ratings[~test], data.rating_scale)
+        arrays = {name: getattr(train_matrix, name) for name in MATRIX_ARRAYS}
+        arrays.update(
+            test_users=train_matrix.to_inner_uids(user_ids[test]),
+            test_items=train_matrix.to_inner_iids(anime_ids[test]),
+            test_ratings=data.ratings[test],
+        )
+
+        yield arrays
+
+
+def _init_worker(specs: dict, rating_scale: tuple):
+    """Attach the shared arrays of every fold in a worker process.
+
+    Args:
+        specs (dict): Name, shape and dtype of the shared memory block of every array
+        rating_scale (tuple): Minimum and maximum ratings
+    """
+    for name, (block_name, shape, dtype) in specs.items():
+        block = SharedMemory(name=block_name)
+        _shared[name + '_block'] = block
+        _shared[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+    _shared['rating_scale'] = rating_scale
+
+
+def _get_fold(fold: int) -> tuple:
+    """Get the train matrix and the test arrays of a fold as views of the shared arrays, without copying them.
+
+    Args:
+        fold (int): Fold to be used as test set
+
+    Returns:
+        tuple: Train ratings matrix and test inner user ids, inner item ids and ratings, -1 for the ids unknown to the train matrix
+    """
+    train_matrix = RatingsMatrix(**{name: _shared[f'fold{fold}_{name}'] for name in MATRIX_ARRAYS}, rating_scale=_shared['rating_scale'])
+
+    return train_matrix, tuple(_shared[f'fold{fold}_{name}'] for name in TEST_ARRAYS)
+
+
+def _estimate_svd(algo: SVD, inner_uids: np.ndarray, inner_iids: np.ndarray) -> np.ndarray:
+    """Estimate the ratings of several (user, item) pairs at once from the factors of a fitted Surprise SVD model, as its predict method does.
+
+    Args:
+        algo (SVD): Surprise SVD model fitted on a trainset with the inner ids of the train matrix
+        inner_uids (np.ndarray): Inner user ids, -1 for unknown users
+        inner_iids (np.ndarray): Inner item ids, -1 for unknown items
+
+    Returns:
+        np.ndarray: Estimated ratings, not clipped
+    """
+    known_users = inner_uids >= 0
+    known_items = inner_iids >= 0
+    known_both = known_users & known_items
+
+    # Surprise falls back to the global mean when an unbiased model cannot estimate a rating
+    est = np.full(len(inner_uids), algo.trainset.global_mean)
+    if algo.biased:
+        est[known_users] += algo.bu[inner_uids[known_users]]
+        est[known_items] += algo.bi[inner_iids[known_items]]
+    else:
+        est[known_both] = 0
+    est[known_both] += np.einsum('ij,ij->i', algo.pu[inner_uids[known_both]], algo.qi[inner_iids[known_both]])
+
+    return est
+
+
+def _evaluate(task: tuple) -> dict:
+    """Train a candidate on the train folds and compute its metrics on the test fold.
+
+    Args:
+        task (tuple): Algorithm class, rung, candidate index, hyper-parameters, fold and measures
+
+    Returns:
+        dict: Metrics of the combination
+    """
+    algo_class, rung, candidate, params, fold, measures = task
+    train_matrix, (inner_uids, inner_iids, ratings) = _get_fold(fold)
+
+    algo = algo_class(**params)
+    start = time.perf_counter()
+    if isinstance(algo, ALS):
+        algo.fit(train_matrix)
+        fit_time = time.perf_counter() - start
+        est = np.clip(algo.estimate(inner_uids, inner_iids), *train_matrix.rating_scale)
+    else:
+        algo.fit(train_matrix.build_full_trainset())
+        fit_time = time.perf_counter() - start
+        if isinstance(algo, SVD):
+            est = np.clip(_estimate_svd(algo, inner_uids, inner_iids), *train_matrix.rating_scale)
+        else:
+            # -1 is not a raw id of the trainset, so Surprise predicts it as an unknown user or item
+            user_ids = np.where(inner_uids >= 0, train_matrix.user_ids[inner_uids], -1)
+            anime_ids = np.where(inner_iids >= 0, train_matrix.item_ids[inner_iids], -1)
+            est = np.array([algo.predict(uid, iid).est for uid, iid in zip(user_ids.tolist(), anime_ids.tolist())])
+
+    errors = est - ratings
+    metrics = {'rmse': float(np.sqrt(np.mean(errors ** 2))), 'mae': float(np.mean(np.abs(errors)))}
+
+    result = {'rung': rung, 'candidate': candidate, 'params': params, 'fold': fold, 'fit_time': fit_time}
+    result.update({measure: metrics[measure] for measure in measures})
+
+    return result
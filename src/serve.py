@@ -0,0 +1,348 @@
+import argparse
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Optional, Union
+from urllib.parse import parse_qs, urlparse
+import pandas as pd
+
+from src.dataset.preprocessing import catalogue_fingerprint
+from src.dataset.cache import load_anime_data, load_ratings_data
+from src.model.factors import FactorModel
+from src.model.inference import _get_candidate_animes, recommend_many
+from src.model.registry import load_latest_model
+from src.model.search import SearchIndex, get_search_index
+from src.model.similarity import NeighbourTable, SimilarityIndex, get_similarity_index
+from src.model.train import train_and_save
+from src.instrumentation import prometheus_text
+
+# maximum number of results of a single query, larger requested counts are capped to it
+MAX_RESULTS = 100
+
+
+class RecommendBatcher:
+    """Groups the recommendation requests that arrive close in time and answers each group with a single call to recommend_many,
+    so that concurrent requests share one matrix product against the item factors instead of running one each.
+    A request waits at most max_wait seconds for others to join its group.
+
+    Args:
+        model (FactorModel): Factors of the trained recommender
+        max_batch_size (int, optional): Maximum number of requests per group. Defaults to 64.
+        max_wait (float, optional): Maximum number of seconds a request waits for others. Defaults to 0.002.
+        reg (float, optional): Regularization term of the user bias and factors when folding in new users. Defaults to 0.02.
+    """
+    def __init__(self, model: FactorModel, max_batch_size: int = 64, max_wait: float = 0.002, reg: float = 0.02):
+        """Initializes the batcher and starts the thread that answers the requests
+        """
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.reg = reg
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, ratings: dict, candidates: list, n: int) -> Future:
+        """Queue a recommendation request.
+
+        Args:
+            ratings (dict): Ratings of the user in the form of {anime_id: rating}
+            candidates (list): Animes the recommendations are chosen from
+            n (int): Number of recommendations
+
+        Returns:
+            Future: Future of the list of (anime_id, est_r_ui) tuples
+        """
+        future = Future()
+        self.requests.put((ratings, candidates, n, future))
+
+        return future
+
+    def close(self):
+        """Stop answering requests once the queued ones are answered.
+        """
+        self.requests.put(None)
+        self.thread.join()
+
+    def _run(self):
+        closing = False
+        while not closing:
+            request = self.requests.get()
+            if request is None:
+                break
+
+            batch = [request]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if request is None:
+                    closing = True
+                    break
+                batch.append(request)
+
+            self._answer(batch)
+
+    def _answer(self, batch: list):
+        ratings, candidates, n, futures = zip(*batch)
+        try:
+            recommendations = recommend_many(self.model, list(ratings), n=max(n), candidates=list(candidates), reg=self.reg)
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            return
+
+        for future, user_recommendations, user_n in zip(futures, recommendations, n):
+            future.set_result(user_recommendations[:user_n])
+
+
+class RecommenderService:
+    """Search, similarity and recommendation queries over a catalogue and a trained recommender that are loaded once.
+    It is the logic behind the HTTP API, and it can also be used directly, e.g. to benchmark it without any HTTP overhead.
+
+    Args:
+        anime_df (pd.DataFrame): Processed anime dataframe
+        model (FactorModel): Factors of the trained recommender
+        search_index (SearchIndex): Search index of anime_df
+        similarity_index (Union[NeighbourTable, SimilarityIndex]): Similarity index of anime_df
+        max_batch_size (int, optional): Maximum number of recommendation requests answered at once. Defaults to 64.
+        max_wait (float, optional): Maximum number of seconds a recommendation request waits for others. Defaults to 0.002.
+    """
+    def __init__(self, anime_df: pd.DataFrame, model: FactorModel, search_index: SearchIndex, similarity_index: Union[NeighbourTable, SimilarityIndex],
+                 max_batch_size: int = 64, max_wait: float = 0.002):
+        """Initializes the service and starts batching recommendation requests
+        """
+        self.anime_by_id = anime_df.set_index('anime_id', drop=False)
+        self.model = model
+        self.search_index = search_index
+        self.similarity_index = similarity_index
+        self.batcher = RecommendBatcher(model, max_batch_size, max_wait)
+
+    @classmethod
+    def load(cls, **kwargs) -> 'RecommenderService':
+        """Load the processed anime data, its indexes and the latest recommender trained on it, training one if there is none.
+
+        Args:
+            kwargs: Batching settings, as accepted by RecommenderService
+
+        Returns:
+            RecommenderService: Loaded service
+        """
+        anime_df = load_anime_data()
+        search_index = get_search_index(anime_df)
+        similarity_index = get_similarity_index(anime_df)
+
+        model = load_latest_model(catalogue_fingerprint(anime_df))
+        if model is None:
+            ratings_df = load_ratings_data(anime_df)
+            model = train_and_save(anime_df, ratings_df)
+
+        return cls(anime_df, model, search_index, similarity_index, **kwargs)
+
+    def close(self):
+        self.batcher.close()
+
+    def search(self, query: str, limit: int = 20) -> list:
+        """Search animes by title.
+
+        Args:
+            query (str): Words of the title
+            limit (int, optional): Maximum number of results. Defaults to 20.
+
+        Returns:
+            list: Animes found, from most to least popular
+        """
+        anime_ids = self.search_index.search(query, limit)
+
+        return [self._describe(anime_id) for anime_id in anime_ids.tolist()]
+
+    def similar(self, anime_id: int, k: int = 10) -> list:
+        """Find the most similar animes to a given one.
+
+        Args:
+            anime_id (int): Query anime, a KeyError is raised if it is not part of the catalogue
+            k (int, optional): Number of similar animes. Defaults to 10.
+
+        Returns:
+            list: Similar animes with their cosine similarity, from most to least similar
+        """
+        neighbour_ids, scores = self.similarity_index.top_k([anime_id], k)
+
+        return [dict(self._describe(neighbour_id), score=score) for neighbour_id, score in zip(neighbour_ids[0].tolist(), scores[0].tolist())]
+
+    def recommend(self, ratings: dict, n: int = 10, timeout: Optional[float] = None) -> list:
+        """Recommend animes to a user given the ratings, folding the user into the recommender.
+        Candidates are the animes similar to the ones the user liked, as in the app.
+
+        Args:
+            ratings (dict): Ratings of the user in the form of {anime_id: rating}
+            n (int, optional): Number of recommendations. Defaults to 10.
+            timeout (Optional[float], optional): Maximum number of seconds to wait for the recommendations. Defaults to None.
+
+        Returns:
+            list: Recommended animes with their estimated rating, from most to least recommended
+        """
+        candidates = _get_candidate_animes(ratings, self.similarity_index)
+        recommendations = self.batcher.submit(ratings, candidates, n).result(timeout)
+
+        return [dict(self._describe(anime_id), rating=rating) for anime_id, rating in recommendations]
+
+    def _describe(self, anime_id: int) -> dict:
+        return {'anime_id': anime_id, 'name': self.anime_by_id.at[anime_id, 'name']}
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """Handler of the JSON API:
+        GET /search?q=<query>&limit=<limit>
+        GET /similar/<anime_id>?k=<k>
+        POST /recommend with a {"ratings": {"<anime_id>": <rating>, ...}, "n": <n>} body
+        GET /metrics, spans and counters in the Prometheus text format, empty unless ANIMEREC_INSTRUMENT=1
+    Errors are answered with a {"error": <message>} body: 400 for invalid requests, 404 for unknown endpoints or animes and 500 for anything else.
+    """
+    service: RecommenderService = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        parts = url.path.strip('/').split('/')
+
+        try:
+            if parts == ['search']:
+                self._send(200, self.service.search(params.get('q', ''), _result_count(params.get('limit', 20), 'limit')))
+            elif len(parts) == 2 and parts[0] == 'similar':
+                self._send(200, self.service.similar(int(parts[1]), _result_count(params.get('k', 10), 'k')))
+            elif parts == ['metrics']:
+                self._send(200, prometheus_text(), 'text/plain; version=0.0.4')
+            else:
+                self._send(404, {'error': f'Unknown endpoint {url.path}'})
+        except KeyError as e:
+            self._send(404, {'error': f'Unknown anime {e}'})
+        except ValueError as e:
+            self._send(400, {'error': str(e)})
+        except Exception as e:
+            self._send_internal_error(e)
+
+    def do_POST(self):
+        if urlparse(self.path).path.strip('/') != 'recommend':
+            self._send(404, {'error': f'Unknown endpoint {self.path}'})
+            return
+
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            ratings = {int(anime_id): int(rating) for anime_id, rating in body['ratings'].items()}
+            if not all(1 <= rating <= 10 for rating in ratings.values()):
+                raise ValueError('Ratings must be between 1 and 10')
+            self._send(200, self.service.recommend(ratings, _result_count(body.get('n', 10), 'n')))
+        except (KeyError, TypeError, AttributeError, ValueError) as e:
+            self._send(400, {'error': f'Invalid request: {e}'})
+        except Exception as e:
+            self._send_internal_error(e)
+
+    def _send(self, status: int, payload, content_type: str = 'application/json'):
+        body = payload.encode() if isinstance(payload, str) else json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_internal_error(self, e: Exception):
+        # the client gets an answer instead of a dropped connection, and the server keeps serving
+        print(f"Error answering {self.command} {self.path}: {e!r}")
+        self._send(500, {'error': f'Internal error: {e}'})
+
+    def log_message(self, format: str, *args):
+        # one log line per request would dominate the cost of the requests when load testing
+        pass
+
+
+def _result_count(value, name: str) -> int:
+    """Parse the requested number of results of a query, capped to MAX_RESULTS.
+
+    Args:
+        value: Requested number of results
+        name (str): Name of the parameter, for the error message
+
+    Returns:
+        int: Number of results
+    """
+    count = int(value)
+    if count < 1:
+        raise ValueError(f'{name} must be at least 1')
+
+    return min(count, MAX_RESULTS)
+
+
+class PooledHTTPServer(HTTPServer):
+    """HTTP server that handles every connection on a fixed pool of worker threads, instead of one new thread per connection.
+
+    Args:
+        server_address (tuple): Host and port
+        handler_class (type): Request handler class
+        workers (int, optional): Number of worker threads. Defaults to 8.
+    """
+    daemon_threads = True
+
+    def __init__(self, server_address: tuple, handler_class: type, workers: int = 8):
+        """Initializes the server and its workers
+        """
+        super().__init__(server_address, handler_class)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=True)
+
+
+def serve(host: str = '127.0.0.1', port: int = 8000, workers: int = 8, max_batch_size: int = 64, max_wait: float = 0.002):
+    """Load the service and answer requests until interrupted.
+
+    Args:
+        host (str, optional): Address to listen on. Defaults to '127.0.0.1'.
+        port (int, optional): Port to listen on. Defaults to 8000.
+        workers (int, optional): Number of worker threads. Defaults to 8.
+        max_batch_size (int, optional): Maximum number of recommendation requests answered at once. Defaults to 64.
+        max_wait (float, optional): Maximum number of seconds a recommendation request waits for others. Defaults to 0.002.
+    """
+    RequestHandler.service = RecommenderService.load(max_batch_size=max_batch_size, max_wait=max_wait)
+
+    server = PooledHTTPServer((host, port), RequestHandler, workers)
+    print(f"Serving on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        RequestHandler.service.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve search, similarity and recommendation queries over HTTP')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--max-batch-size', type=int, default=64)
+    parser.add_argument('--max-wait', type=float, default=0.002)
+    args = parser.parse_args()
+
+    serve(args.host, args.port, args.workers, args.max_batch_size, args.max_wait)
@@ -0,0 +1,99 @@
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+from src.benchmark.synthetic import generate_anime, generate_ratings
+from src.dataset.preprocessing import filter_ratings_data, preprocess_anime_data
+from src.dataset.ratings import RatingsMatrix
+from src.model import batch
+from src.model.als import ALS
+from src.model.factors import FactorModel
+from src.model.inference import _get_recommendations
+from src.model.similarity import SimilarityIndex
+
+# users of the ratings left out of the model, so that they are folded into it
+UNKNOWN_USERS = 20
+
+
+class RecommendAllUsersTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        raw_anime_df = generate_anime()
+        cls.anime_df = preprocess_anime_data(raw_anime_df)
+        cls.index = SimilarityIndex(cls.anime_df)
+
+        raw_ratings_df = pd.concat(generate_ratings(raw_anime_df, 20_000, n_users=200))
+        cls.ratings_df = filter_ratings_data(raw_ratings_df, cls.anime_df)
+        cls.ratings = RatingsMatrix.from_frame(cls.ratings_df)
+
+        full = ALS(n_factors=5, n_epochs=3, random_state=0).fit(cls.ratings).to_factor_model()
+        cls.model = FactorModel(full.global_mean, full.bu[UNKNOWN_USERS:], full.bi, full.pu[UNKNOWN_USERS:], full.qi,
+                                full.user_ids[UNKNOWN_USERS:], full.item_ids, full.rating_scale)
+        cls.known_user = int(cls.model.user_ids[0])
+        cls.unknown_user = int(cls.ratings.user_ids[0])
+
+    def setUp(self):
+        self.path = Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def recommend_all_users(self, ratings: RatingsMatrix) -> batch.BatchRecommendations:
+        path = batch.recommend_all_users(self.anime_df, self.model, ratings, self.path, self.index, n_jobs=1, shard_users=50, block_users=16)
+
+        return batch.BatchRecommendations(path)
+
+    def assertMatchesInference(self, recommendations: batch.BatchRecommendations, ratings_df: pd.DataFrame, user_id: int):
+        expected = _get_recommendations(self.anime_df, SimpleNamespace(df=ratings_df), self.model, user_id, self.index)[:10]
+        anime_ids, scores = zip(*recommendations.recommendations(user_id))
+
+        self.assertEqual(list(anime_ids), [anime_id for anime_id, _ in expected])
+        np.testing.assert_allclose(scores, [score for _, score in expected], rtol=1e-5)
+
+    def test_matches_inference(self):
+        recommendations = self.recommend_all_users(self.ratings)
+
+        self.assertEqual(len(recommendations), self.ratings.n_users)
+        self.assertNotIn(self.unknown_user, self.model.user_to_inner)
+        for user_id in [self.known_user, self.unknown_user]:
+            self.assertMatchesInference(recommendations, self.ratings_df, user_id)
+
+    def test_resumes_interrupted_job(self):
+        run_shard = batch._run_shard
+        shards = []
+
+        def interrupted(task: tuple):
+            if len(shards) == 2:
+                raise KeyboardInterrupt
+            shards.append(task[0])
+            run_shard(task)
+
+        with mock.patch.object(batch, '_run_shard', interrupted), self.assertRaises(KeyboardInterrupt):
+            self.recommend_all_users(self.ratings)
+
+        with mock.patch.object(batch, '_run_shard', side_effect=lambda task: shards.append(task[0]) or run_shard(task)):
+            recommendations = self.recommend_all_users(self.ratings)
+
+        self.assertEqual(shards, [0, 1, 2, 3])
+        self.assertMatchesInference(recommendations, self.ratings_df, self.unknown_user)
+
+    def test_changed_ratings_rebuild_shards(self):
+        self.recommend_all_users(self.ratings)
+
+        # the unknown user now rates every anime the other way around, which changes its folded in factors
+        changed_df = self.ratings_df.copy()
+        of_user = changed_df.user_id == self.unknown_user
+        changed_df.loc[of_user, 'rating'] = 11 - changed_df.loc[of_user, 'rating']
+        recommendations = self.recommend_all_users(RatingsMatrix.from_frame(changed_df))
+
+        self.assertMatchesInference(recommendations, changed_df, self.unknown_user)
+
+
+if __name__ == '__main__':
+    unittest.main()
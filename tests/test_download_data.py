@@ -0,0 +1,96 @@
+import json
+import threading
+import time
+import unittest
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from jikanpy.exceptions import APIException
+
+from src.dataset.download_data import MetadataFetcher, RateLimiter
+
+# status codes answered by the stub before a successful response, by anime id
+FAILURES = {2: [429, 500], 3: [404]}
+# anime answered only after the timeout of the fetcher
+SLOW_ANIME_ID = 4
+
+
+class StubJikanHandler(BaseHTTPRequestHandler):
+    """Local stand-in of the Jikan API, which records the time of every request by anime id."""
+    def do_GET(self):
+        anime_id = int(self.path.rstrip('/').split('/')[-1])
+        with self.server.lock:
+            attempt = len(self.server.requests[anime_id])
+            self.server.requests[anime_id].append(time.monotonic())
+
+        if anime_id == SLOW_ANIME_ID:
+            time.sleep(1.5)
+        failures = FAILURES.get(anime_id, [])
+        status = failures[attempt] if attempt < len(failures) else 200
+        body = json.dumps({'data': {'mal_id': anime_id, 'synopsis': f'synopsis {anime_id}'}} if status == 200 else {'error': 'stub'}).encode()
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except OSError:
+            # the client already gave up on the slow anime
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetadataFetcherTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubJikanHandler)
+        self.server.daemon_threads = True
+        self.server.requests = defaultdict(list)
+        self.server.lock = threading.Lock()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = f'http://127.0.0.1:{self.server.server_port}/v4'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_rate_limit(self):
+        with MetadataFetcher(self.base_url, max_workers=4, limiter=RateLimiter([(3, 1.0)])) as fetcher:
+            for future in fetcher.fetch_many(range(100, 107)):
+                future.result()
+
+        times = sorted(t for anime_times in self.server.requests.values() for t in anime_times)
+        self.assertEqual(len(times), 7)
+        # no more than 3 requests in any 1 second window, the first 3 ones going through right away
+        for i in range(len(times) - 3):
+            self.assertGreaterEqual(times[i + 3] - times[i], 0.95)
+        self.assertLess(times[2] - times[0], 0.5)
+
+    def test_retries_rate_limited_and_server_errors(self):
+        with MetadataFetcher(self.base_url, limiter=RateLimiter([(100, 1.0)]), max_retries=2) as fetcher:
+            anime_info = fetcher.get_anime(2)
+
+        self.assertEqual(anime_info['data']['synopsis'], 'synopsis 2')
+        self.assertEqual(len(self.server.requests[2]), 3)
+
+    def test_does_not_retry_client_errors(self):
+        with MetadataFetcher(self.base_url, limiter=RateLimiter([(100, 1.0)]), max_retries=2) as fetcher:
+            with self.assertRaises(APIException):
+                fetcher.get_anime(3)
+
+        self.assertEqual(len(self.server.requests[3]), 1)
+
+    def test_timeout(self):
+        with MetadataFetcher(self.base_url, limiter=RateLimiter([(100, 1.0)]), timeout=0.3, max_retries=0) as fetcher:
+            start = time.monotonic()
+            with self.assertRaises(requests.Timeout):
+                fetcher.get_anime(SLOW_ANIME_ID)
+
+        self.assertLess(time.monotonic() - start, 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+
+from src.dataset.preprocessing import catalogue_fingerprint
+from src.dataset.ratings import RatingsMatrix
+from src.model.als import ALS
+from src.model.incremental import load_updater
+from src.model.registry import find_latest_version, save_model
+
+
+def ratings_frame(ratings: RatingsMatrix) -> pd.DataFrame:
+    frame = pd.DataFrame({
+        'user_id': ratings.user_ids[ratings.users()].astype(np.int64),
+        'anime_id': ratings.item_ids[np.asarray(ratings.items)].astype(np.int64),
+        'rating': np.asarray(ratings.ratings).astype(np.int64),
+    })
+
+    return frame.sort_values(['user_id', 'anime_id']).reset_index(drop=True)
+
+
+def apply_delta(ratings_df: pd.DataFrame, delta: pd.DataFrame) -> pd.DataFrame:
+    # a new rating of an already rated anime replaces the previous one
+    merged = pd.concat([ratings_df, delta]).drop_duplicates(['user_id', 'anime_id'], keep='last').astype(np.int64)
+
+    return merged.sort_values(['user_id', 'anime_id']).reset_index(drop=True)
+
+
+class IncrementalUpdaterTest(unittest.TestCase):
+    def setUp(self):
+        self.path = Path(tempfile.mkdtemp())
+        rng = np.random.default_rng(0)
+
+        self.anime_df = pd.DataFrame({'anime_id': np.arange(100, 130)})
+        self.fingerprint = catalogue_fingerprint(self.anime_df)
+        rows = [(user_id, anime_id, int(rng.integers(1, 11)))
+                for user_id in range(40) for anime_id in rng.choice(self.anime_df.anime_id, 8, replace=False).tolist()]
+        self.ratings_df = pd.DataFrame(rows, columns=['user_id', 'anime_id', 'rating'])
+
+        model = ALS(n_factors=4, n_epochs=3, random_state=0).fit(RatingsMatrix.from_frame(self.ratings_df)).to_factor_model()
+        save_model(model, self.fingerprint, self.path)
+
+        # a new user, and an existing one rating a new anime and rating again an already rated one
+        rated = int(self.ratings_df[self.ratings_df.user_id == 0].anime_id.iloc[0])
+        unrated = int(np.setdiff1d(self.anime_df.anime_id, self.ratings_df[self.ratings_df.user_id == 0].anime_id)[0])
+        self.delta = pd.DataFrame({'user_id': [1000, 1000, 0, 0], 'anime_id': [100, 101, rated, unrated], 'rating': [9, 3, 6, 7]})
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_checkpoint_round_trip(self):
+        updater = load_updater(self.anime_df, self.ratings_df, self.path, checkpoint_every=0, random_state=0)
+        updater.update(self.delta)
+        version_path = updater.checkpoint()
+        self.assertEqual(find_latest_version(self.fingerprint, self.path), version_path)
+
+        # the saved history is used instead of the ratings dataset
+        with mock.patch('src.model.incremental.load_ratings_data', side_effect=AssertionError('the ratings dataset was loaded')):
+            reloaded = load_updater(self.anime_df, path=self.path, checkpoint_every=0)
+
+        self.assertEqual(reloaded.n_updates, 1)
+        self.assertEqual(reloaded.model.global_mean, updater.model.global_mean)
+        for name in ['bu', 'bi', 'pu', 'qi', 'user_ids', 'item_ids']:
+            np.testing.assert_array_equal(getattr(reloaded.model, name), getattr(updater.model, name))
+        self.assertIn(1000, reloaded.model.user_to_inner)
+
+        expected = apply_delta(self.ratings_df, self.delta)
+        pd.testing.assert_frame_equal(ratings_frame(reloaded.ratings), expected)
+
+        # the history keeps growing across updaters
+        second_delta = pd.DataFrame({'user_id': [1001, 1000], 'anime_id': [102, 100], 'rating': [8, 2]})
+        reloaded.update(second_delta)
+        reloaded.checkpoint()
+        latest = load_updater(self.anime_df, path=self.path)
+
+        self.assertEqual(latest.n_updates, 2)
+        pd.testing.assert_frame_equal(ratings_frame(latest.ratings), apply_delta(expected, second_delta))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+from surprise import Dataset, Reader
+from surprise.prediction_algorithms import SVD
+
+from src.model.factors import FactorModel
+from src.model.inference import fold_in_user, recommend, recommend_many
+
+
+def random_ratings(n_users: int = 40, n_items: int = 30, per_user: int = 10, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    rows = [(user_id, anime_id, int(rng.integers(1, 11)))
+            for user_id in range(n_users) for anime_id in rng.choice(np.arange(100, 100 + n_items), per_user, replace=False).tolist()]
+
+    return pd.DataFrame(rows, columns=['user_id', 'anime_id', 'rating'])
+
+
+class RecommendTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.ratings_df = random_ratings()
+        trainset = Dataset.load_from_df(cls.ratings_df, Reader(rating_scale=(1, 10))).build_full_trainset()
+        cls.algo = SVD(n_factors=5, n_epochs=5, random_state=0).fit(trainset)
+        cls.model = FactorModel.from_surprise(cls.algo)
+        cls.anime_ids = np.sort(cls.ratings_df.anime_id.unique()).tolist()
+
+        cls.user_id = 3
+        cls.seen = cls.ratings_df[cls.ratings_df.user_id == cls.user_id].anime_id.tolist()
+        cls.new_ratings = {100: 9, 105: 2, 111: 7, 120: 10}
+
+    def known_user_loop(self) -> dict:
+        return {anime_id: self.algo.predict(self.user_id, anime_id).est for anime_id in self.anime_ids if anime_id not in self.seen}
+
+    def new_user_loop(self) -> dict:
+        bu, pu = fold_in_user(self.model, self.new_ratings)
+        estimated = {}
+        for anime_id in self.anime_ids:
+            if anime_id in self.new_ratings:
+                continue
+            inner_iid = self.model.item_to_inner[anime_id]
+            estimate = self.model.global_mean + bu + self.model.bi[inner_iid] + self.model.qi[inner_iid] @ pu
+            estimated[anime_id] = float(np.clip(estimate, *self.model.rating_scale))
+
+        return estimated
+
+    def assertMatchesLoop(self, recommendations: list, expected: dict, n: int = None):
+        scores = [score for _, score in recommendations]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+        np.testing.assert_allclose(scores, sorted(expected.values(), reverse=True)[:n])
+        for anime_id, score in recommendations:
+            self.assertAlmostEqual(score, expected[anime_id])
+
+    def test_known_user(self):
+        expected = self.known_user_loop()
+        self.assertMatchesLoop(recommend(self.model, self.user_id, n=None, seen=self.seen), expected)
+        self.assertMatchesLoop(recommend(self.model, self.user_id, n=5, seen=self.seen), expected, 5)
+
+    def test_folded_in_user(self):
+        expected = self.new_user_loop()
+        self.assertMatchesLoop(recommend(self.model, self.new_ratings, n=None), expected)
+        self.assertMatchesLoop(recommend(self.model, self.new_ratings, n=5), expected, 5)
+
+    def test_recommend_many(self):
+        known, new = recommend_many(self.model, [self.user_id, self.new_ratings], n=5, seen=[self.seen, None])
+        self.assertMatchesLoop(known, self.known_user_loop(), 5)
+        self.assertMatchesLoop(new, self.new_user_loop(), 5)
+
+    def test_known_user_requires_seen(self):
+        with self.assertRaises(ValueError):
+            recommend(self.model, self.user_id)
+        with self.assertRaises(ValueError):
+            recommend_many(self.model, [self.new_ratings, self.user_id])
+        self.assertEqual(len(recommend(self.model, self.user_id, n=None, exclude_seen=False)), len(self.anime_ids))
+
+    def test_negative_n(self):
+        with self.assertRaises(ValueError):
+            recommend(self.model, self.new_ratings, n=-1)
+        self.assertEqual(recommend(self.model, self.new_ratings, n=0), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
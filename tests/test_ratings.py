@@ -0,0 +1,119 @@
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from src.dataset.ratings import MATRIX_ARRAYS, RatingsMatrix, build_ratings_store
+
+
+def random_ratings(n_ratings: int = 300, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    frame = pd.DataFrame({
+        'user_id': rng.integers(1, 60, n_ratings) * 7,
+        'anime_id': rng.integers(1, 40, n_ratings) * 3,
+        'rating': rng.integers(1, 11, n_ratings),
+    })
+
+    # one rating per user and anime, in no particular order
+    return frame.drop_duplicates(['user_id', 'anime_id']).reset_index(drop=True)
+
+
+def user_triples(ratings: RatingsMatrix) -> list:
+    users = ratings.user_ids[ratings.users()]
+    return sorted(zip(users.tolist(), ratings.item_ids[np.asarray(ratings.items)].tolist(), np.asarray(ratings.ratings).tolist()))
+
+
+def item_triples(ratings: RatingsMatrix) -> list:
+    items = np.repeat(np.arange(ratings.n_items), np.diff(ratings.item_indptr))
+    return sorted(zip(ratings.user_ids[np.asarray(ratings.item_users)].tolist(), ratings.item_ids[items].tolist(), np.asarray(ratings.item_scores).tolist()))
+
+
+class RatingsMatrixTest(unittest.TestCase):
+    def setUp(self):
+        self.path = Path(tempfile.mkdtemp())
+        self.frame = random_ratings()
+        self.ratings = RatingsMatrix.from_frame(self.frame)
+        self.expected = sorted(zip(self.frame.user_id.tolist(), self.frame.anime_id.tolist(), self.frame.rating.tolist()))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_from_frame(self):
+        ratings = self.ratings
+        self.assertEqual((ratings.n_users, ratings.n_items, ratings.n_ratings), (self.frame.user_id.nunique(), self.frame.anime_id.nunique(), len(self.frame)))
+        np.testing.assert_array_equal(ratings.user_ids, np.unique(self.frame.user_id))
+        np.testing.assert_array_equal(ratings.item_ids, np.unique(self.frame.anime_id))
+        self.assertEqual(user_triples(ratings), self.expected)
+        self.assertEqual(item_triples(ratings), self.expected)
+        self.assertAlmostEqual(ratings.global_mean, self.frame.rating.mean())
+
+        inner_uid = 3
+        items, scores = ratings.user_ratings(inner_uid)
+        of_user = self.frame[self.frame.user_id == ratings.user_ids[inner_uid]].sort_values('anime_id')
+        np.testing.assert_array_equal(ratings.item_ids[items], of_user.anime_id)
+        np.testing.assert_array_equal(scores, of_user.rating)
+
+    def test_save_load(self):
+        self.ratings.save(self.path / 'matrix')
+        loaded = RatingsMatrix.load(self.path / 'matrix')
+
+        self.assertIsInstance(loaded.items, np.memmap)
+        self.assertEqual(loaded.rating_scale, self.ratings.rating_scale)
+        for name in MATRIX_ARRAYS:
+            np.testing.assert_array_equal(getattr(loaded, name), getattr(self.ratings, name))
+
+    def test_build_ratings_store(self):
+        chunks = (self.frame.iloc[start:start + 37] for start in range(0, len(self.frame), 37))
+        store = build_ratings_store(chunks, self.path / 'store', block_ratings=50)
+
+        self.assertEqual(sorted(path.name for path in self.path.iterdir()), ['store'])
+        self.assertEqual(store.n_ratings, len(self.frame))
+        np.testing.assert_array_equal(store.user_ids, self.ratings.user_ids)
+        np.testing.assert_array_equal(store.item_ids, self.ratings.item_ids)
+        np.testing.assert_array_equal(store.user_indptr, self.ratings.user_indptr)
+        np.testing.assert_array_equal(store.item_indptr, self.ratings.item_indptr)
+        self.assertEqual(user_triples(store), self.expected)
+        self.assertEqual(item_triples(store), self.expected)
+
+        # a rebuild replaces the previous store
+        store = build_ratings_store([self.frame.iloc[:10]], self.path / 'store')
+        self.assertEqual(store.n_ratings, 10)
+
+    def test_iter_blocks(self):
+        blocks = list(self.ratings.iter_blocks(block_ratings=25))
+
+        users, items, scores = map(np.concatenate, zip(*blocks))
+        np.testing.assert_array_equal(users, self.ratings.users())
+        np.testing.assert_array_equal(items, self.ratings.items)
+        np.testing.assert_array_equal(scores, self.ratings.ratings)
+        for block_users, _, _ in blocks:
+            # blocks hold whole users, and only exceed the limit with a single user
+            self.assertTrue(len(block_users) <= 25 or len(np.unique(block_users)) == 1)
+        self.assertEqual(len(np.intersect1d(blocks[0][0], blocks[1][0])), 0)
+
+    def test_build_full_trainset(self):
+        trainset = self.ratings.build_full_trainset()
+
+        self.assertEqual((trainset.n_users, trainset.n_items, trainset.n_ratings), (self.ratings.n_users, self.ratings.n_items, self.ratings.n_ratings))
+        for inner_uid, user_id in enumerate(self.ratings.user_ids.tolist()):
+            self.assertEqual(trainset.to_inner_uid(user_id), inner_uid)
+        triples = sorted((trainset.to_raw_uid(u), trainset.to_raw_iid(i), int(r)) for u, i, r in trainset.all_ratings())
+        self.assertEqual(triples, self.expected)
+        self.assertEqual(user_triples(RatingsMatrix.from_trainset(trainset)), self.expected)
+
+    def test_to_inner_ids(self):
+        user_ids = np.array([self.ratings.user_ids[5], 1, self.ratings.user_ids[0], 10 ** 6])
+        np.testing.assert_array_equal(self.ratings.to_inner_uids(user_ids), [5, -1, 0, -1])
+        np.testing.assert_array_equal(self.ratings.to_inner_iids([self.ratings.item_ids[-1]]), [self.ratings.n_items - 1])
+
+        self.assertEqual(len(self.ratings.to_inner_uids(np.empty(0, dtype=np.int64))), 0)
+        self.assertEqual(len(self.ratings.to_inner_iids([])), 0)
+        empty = RatingsMatrix.from_frame(self.frame.iloc[:0])
+        np.testing.assert_array_equal(empty.to_inner_uids(user_ids), [-1, -1, -1, -1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import threading
+import unittest
+from unittest import mock
+
+import pandas as pd
+import requests
+
+from src.benchmark.synthetic import generate_anime, generate_ratings
+from src.dataset.preprocessing import filter_ratings_data, preprocess_anime_data
+from src.dataset.ratings import RatingsMatrix
+from src.model.als import ALS
+from src.model.search import SearchIndex
+from src.model.similarity import SimilarityIndex
+from src.serve import MAX_RESULTS, PooledHTTPServer, RecommenderService, RequestHandler
+
+
+class ServeTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        raw_anime_df = generate_anime()
+        anime_df = preprocess_anime_data(raw_anime_df)
+        ratings_df = filter_ratings_data(pd.concat(generate_ratings(raw_anime_df, 20_000, n_users=200)), anime_df)
+        model = ALS(n_factors=5, n_epochs=3, random_state=0).fit(RatingsMatrix.from_frame(ratings_df)).to_factor_model()
+
+        cls.service = RecommenderService(anime_df, model, SearchIndex.from_catalogue(anime_df), SimilarityIndex(anime_df))
+        cls.server = PooledHTTPServer(('127.0.0.1', 0), type('Handler', (RequestHandler,), {'service': cls.service}), workers=2)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = f'http://127.0.0.1:{cls.server.server_port}'
+
+        of_user = ratings_df[ratings_df.user_id == ratings_df.user_id.iloc[0]]
+        cls.ratings = dict(zip(of_user.anime_id.tolist(), of_user.rating.tolist()))
+        cls.most_popular = anime_df.loc[anime_df.members.idxmax()]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        cls.service.close()
+
+    def test_search(self):
+        query = self.most_popular['name'].split()[0]
+        response = requests.get(f'{self.base_url}/search', params={'q': query, 'limit': 5})
+
+        self.assertEqual(response.status_code, 200)
+        results = response.json()
+        self.assertTrue(0 < len(results) <= 5)
+        self.assertEqual(results[0], {'anime_id': int(self.most_popular.anime_id), 'name': self.most_popular['name']})
+
+        response = requests.get(f'{self.base_url}/search', params={'q': query, 'limit': MAX_RESULTS + 1})
+        self.assertLessEqual(len(response.json()), MAX_RESULTS)
+
+    def test_recommend(self):
+        response = requests.post(f'{self.base_url}/recommend', json={'ratings': self.ratings, 'n': 5})
+
+        self.assertEqual(response.status_code, 200)
+        recommendations = response.json()
+        self.assertEqual(recommendations, self.service.recommend(self.ratings, 5))
+        self.assertEqual(len(recommendations), 5)
+        self.assertFalse({recommendation['anime_id'] for recommendation in recommendations} & set(self.ratings))
+
+    def test_invalid_n(self):
+        for n in [0, -3, 'many']:
+            response = requests.post(f'{self.base_url}/recommend', json={'ratings': self.ratings, 'n': n})
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('error', response.json())
+
+        response = requests.get(f'{self.base_url}/similar/{int(self.most_popular.anime_id)}', params={'k': 0})
+        self.assertEqual(response.status_code, 400)
+
+    def test_unknown(self):
+        self.assertEqual(requests.get(f'{self.base_url}/similar/-1').status_code, 404)
+        self.assertEqual(requests.get(f'{self.base_url}/unknown').status_code, 404)
+
+    def test_internal_error(self):
+        with mock.patch.object(self.service, 'search', side_effect=RuntimeError('broken index')), \
+                mock.patch.object(self.service, 'recommend', side_effect=RuntimeError('broken model')), \
+                mock.patch('builtins.print'):
+            search = requests.get(f'{self.base_url}/search', params={'q': 'a'})
+            recommend = requests.post(f'{self.base_url}/recommend', json={'ratings': self.ratings})
+
+        self.assertEqual((search.status_code, search.json()), (500, {'error': 'Internal error: broken index'}))
+        self.assertEqual((recommend.status_code, recommend.json()), (500, {'error': 'Internal error: broken model'}))
+
+        # the server keeps answering afterwards
+        self.assertEqual(requests.post(f'{self.base_url}/recommend', json={'ratings': self.ratings}).status_code, 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
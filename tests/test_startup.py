@@ -0,0 +1,19 @@
+import unittest
+
+from src.benchmark.startup import DEFERRED_MODULES, IMPORT_BUDGET_MS, measure_import_time
+
+
+class StartupTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.import_time, cls.packages = measure_import_time('gui.app', repeats=3)
+
+    def test_import_budget(self):
+        self.assertLessEqual(self.import_time, IMPORT_BUDGET_MS)
+
+    def test_deferred_modules(self):
+        self.assertEqual([package for package in DEFERRED_MODULES if package in self.packages], [])
+
+
+if __name__ == '__main__':
+    unittest.main()